@@ -6,6 +6,15 @@ from gridfs import GridFS
 
 from pyramid.renderers import JSON
 from pyramid.config import Configurator
+from pyramid.settings import asbool
+
+from carltour.change_log import stamp_unsequenced_events
+from carltour.event_index import EventIntervalIndex
+from carltour.indexes import ensure_indexes
+from carltour.metrics import Metrics, TimedDatabase
+from carltour.reresolve import ReresolveJobTracker
+from carltour.response_cache import DEFAULT_VERSION_TTL, ResponseCache, VersionCache
+from carltour.scrape_daemon import DEFAULT_DEMAND_FLUSH_INTERVAL, DemandRecorder
 
 
 def main(global_config, **settings):
@@ -32,8 +41,16 @@ def main(global_config, **settings):
     config.add_route('home_page', '/')
     config.add_route('events_view', 'events')
     config.add_route('update_building_alias', 'api/v1.0/update_building_alias')
+    config.add_route('update_building_aliases', 'api/v1.0/update_building_aliases')
+    config.add_route('reresolve_jobs', 'api/v1.0/reresolve_jobs')
+    config.add_route('metrics', 'api/v1.0/metrics')
+    config.add_route('events_sync', 'api/v1.0/events/sync')
     config.scan()
 
+    # Request latencies and Mongo stats, served at /api/v1.0/metrics
+    config.registry.metrics = Metrics()
+    config.add_tween('carltour.metrics.metrics_tween_factory')
+
     # db_url is stored in .ini files 
     db_url = urlparse(settings['mongo_uri'])
 
@@ -43,18 +60,44 @@ def main(global_config, **settings):
             host=db_url.hostname
     )
 
+    # Rendered /api/v1.0/events responses, see UpcomingEventsAPI
+    config.registry.events_cache = ResponseCache()
+    # The events version those are checked against, read from Mongo at most
+    # every carltour.version_ttl seconds
+    config.registry.events_version = VersionCache(float(settings.get('carltour.version_ttl', DEFAULT_VERSION_TTL)))
+    # In-memory copy of the upcoming events, see UpcomingEventsAPI._find_events
+    config.registry.event_index = None
+    if asbool(settings.get('carltour.event_index', False)):
+        config.registry.event_index = EventIntervalIndex()
+    # Dates clients ask for, written out for the scrape daemon every
+    # carltour.demand_flush_interval seconds
+    config.registry.demand = DemandRecorder(float(settings.get('carltour.demand_flush_interval',
+        DEFAULT_DEMAND_FLUSH_INTERVAL)))
+    # Background jobs fixing stored events after alias changes, see UpdateBuilding
+    config.registry.reresolve_jobs = ReresolveJobTracker()
+
+    # Set carltour.ensure_indexes = false in the .ini to skip this (and run
+    # `python indexes.py` by hand instead)
+    if asbool(settings.get('carltour.ensure_indexes', True)):
+        db = config.registry.db[db_url.path[1:]]
+        if db_url.username and db_url.password:
+            db.authenticate(db_url.username, db_url.password)
+        ensure_indexes(db)
+        # Events from before EventsSyncAPI, so it hands them out too
+        stamp_unsequenced_events(db['events'])
+
     # TODO figure out what these do. Taken from Pyramid/mongo tutorial here:
     # http://pyramid-cookbook.readthedocs.org/en/latest/database/mongodb.html
     def add_db(request):
       db = config.registry.db[db_url.path[1:]]
       if db_url.username and db_url.password:
-        print('authenitacintg?')
         db.authenticate(db_url.username, db_url.password)
-      return db
+      # Times what requests (and the jobs they start) ask of Mongo, for /api/v1.0/metrics
+      return TimedDatabase(db, config.registry.metrics)
 
     def add_fs(request):
-      print('adding_fs??')
-      return GridFS(request.db)
+      # GridFS wants the pymongo Database itself
+      return GridFS(request.db.wrapped)
 
     config.add_request_method(add_db, 'db', reify=True)
     config.add_request_method(add_fs, 'fs', reify=True)
@@ -2,28 +2,71 @@ from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
 from pyramid.paster import bootstrap
 
-def create_buildings_collection(db, buildings_file='buildings.txt', collection_name='buildings'):
+def read_buildings_file(buildings_file='buildings.txt'):
     '''
-    Reads all building names from file and inserts them into a collection 
-    <collection_name>, if a collection with that name didn't already exist
+    Reads building dicts from <buildings_file>. Each line is a building name,
+    optionally followed by a tab and its coordinates as "latitude,longitude", e.g.
+        Weitz Center for Creativity\t44.4584,-93.1569
+    Buildings with coordinates get a GeoJSON point as their 'location'
     '''
-    collection = db[collection_name]
+    buildings = []
 
-    if len(list(collection.find())) != 0:
-        print('%s collection already existed. Manually change this if you want to overwrite it!' % collection_name)
-    else:
-        with open(buildings_file) as f:
-            buildings = [l.strip() for l in f]
+    with open(buildings_file) as f:
+        for line_number, line in enumerate(f, 1):
+            name, _, coordinates = line.rstrip('\n').partition('\t')
+            if not name.strip():
+                continue
 
-        for b in buildings:
             b_dict = {
-                'name' : b,
+                'name' : name.strip(),
                 'aliases' : []
             }
 
+            if coordinates.strip():
+                try:
+                    lat, lng = [float(c) for c in coordinates.split(',')]
+                except ValueError:
+                    raise ValueError('%s line %i: coordinates must be "latitude,longitude"' % (buildings_file, line_number))
+                # GeoJSON puts longitude first
+                b_dict['location'] = {'type' : 'Point', 'coordinates' : [lng, lat]}
+
+            buildings.append(b_dict)
+
+    return buildings
+
+def create_buildings_collection(db, buildings_file='buildings.txt', collection_name='buildings'):
+    '''
+    Reads all buildings from file (see read_buildings_file) and inserts them into
+    a collection <collection_name>, if a collection with that name didn't already exist
+    '''
+    collection = db[collection_name]
+
+    if len(list(collection.find())) != 0:
+        print('%s collection already existed. Manually change this if you want to overwrite it!' % collection_name)
+    else:
+        for b_dict in read_buildings_file(buildings_file):
             inserted_id = collection.insert(b_dict)
             print('Inserted', inserted_id)
 
+def update_building_locations(db, buildings_file='buildings.txt', collection_name='buildings'):
+    '''
+    Sets the location of every building in <collection_name> that has coordinates
+    in <buildings_file>, so an existing collection picks up new or fixed ones.
+    Aliases are left alone. Returns the names of buildings the collection doesn't have
+    '''
+    collection = db[collection_name]
+    missing = []
+
+    for b_dict in read_buildings_file(buildings_file):
+        if 'location' not in b_dict:
+            continue
+
+        result = collection.update({'name' : b_dict['name']}, {'$set' : {'location' : b_dict['location']}})
+        if result['n'] == 0:
+            missing.append(b_dict['name'])
+
+    return missing
+
 if __name__ == '__main__':
     # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/commandline.html#writing-a-script
     # for explanation -- we want to access the same Mongo config data that our app uses.
@@ -32,4 +75,7 @@ if __name__ == '__main__':
     # This way, we're hitting the same DB as the requests Pyramid receives will hit
     env = bootstrap('../development.ini')
     db = env['request'].db
-    create_buildings_collection(db)
\ No newline at end of file
+    create_buildings_collection(db)
+
+    for name in update_building_locations(db):
+        print('No building named %s to set the location of' % name)
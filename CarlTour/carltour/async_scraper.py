@@ -0,0 +1,183 @@
+import asyncio
+import datetime
+import logging
+
+from urllib.parse import urlparse
+
+import requests as req
+
+from carltour.event_scraper import EventScraper, BASE_EVENTS_URL
+from carltour.page_archive import EVENT, LISTING
+
+# aiohttp is optional: without it (or when the scraper is given a session),
+# pages are fetched with the scraper's requests session on the event loop's executor
+try:
+    import aiohttp
+    FETCH_ERRORS = (req.RequestException, OSError, asyncio.TimeoutError, aiohttp.ClientError)
+except ImportError:
+    aiohttp = None
+    FETCH_ERRORS = (req.RequestException, OSError, asyncio.TimeoutError)
+
+log = logging.getLogger(__name__)
+
+# Most pages being fetched at once, across every host
+DEFAULT_CONCURRENCY = 16
+# Most requests started per second against any one host (apps.carleton.edu)
+DEFAULT_REQUESTS_PER_SECOND = 10
+# Failed fetches are retried this many times, waiting RETRY_BACKOFF, then twice
+# that, and so on (in seconds) between tries
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+class FetchError(Exception):
+    pass
+
+class HostRateLimiter:
+    '''
+    Spaces out the starts of requests to the same host by 1/<requests_per_second>
+    seconds. Only to be used from one event loop
+    '''
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_slot = {}
+
+    async def wait(self, host):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self.next_slot.get(host, now))
+        self.next_slot[host] = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+class AsyncEventScraper(EventScraper):
+    '''
+    An EventScraper that fetches the listings of every date in a range, and the
+    event pages on them, concurrently on an asyncio event loop. At most <concurrency>
+    pages are fetched at once, requests to one host are rate limited to
+    <requests_per_second>, and failed fetches are retried <retries> times with
+    exponential backoff.
+
+    Parsing and building matching are CPU-bound, so they run on <executor>
+    (the loop's default executor if None) to keep the loop free for fetching.
+    Takes the same other arguments as EventScraper, except that incremental
+    scraping (<page_store>) isn't supported.
+
+    A page that can't be fetched (or parsed) is logged and left out, rather than
+    failing the whole backfill: an event page gives no event, and a day listing
+    no event URLs, so remove_unlisted_events leaves that day alone
+    '''
+
+    def __init__(self, building_dicts, building_callback=None, concurrency=DEFAULT_CONCURRENCY,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, retries=DEFAULT_RETRIES, executor=None, **kwargs):
+        kwargs.setdefault('workers', concurrency)
+        self.use_aiohttp = aiohttp is not None and kwargs.get('session') is None
+        EventScraper.__init__(self, building_dicts, building_callback, **kwargs)
+
+        if self.page_store is not None:
+            raise ValueError('AsyncEventScraper does not do incremental scrapes')
+
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        self.retries = retries
+        self.executor = executor
+
+    def get_events_for_dates(self, start_date, end_date):
+        '''
+        Same as EventScraper.get_events_for_dates, but runs an event loop for the scrape
+        '''
+        return asyncio.run(self.get_events_for_dates_async(start_date, end_date))
+
+    async def get_events_for_dates_async(self, start_date, end_date):
+        '''
+        All events between <start_date> and <end_date> (datetime.date objects),
+        in the same order EventScraper.get_events_for_dates returns them
+        '''
+        all_dates = []
+        cur_date = start_date
+        while cur_date <= end_date:
+            all_dates.append(cur_date)
+            cur_date += datetime.timedelta(days=1)
+
+        self.event_urls_by_date = {}
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.rate_limiter = HostRateLimiter(self.requests_per_second)
+        self.http = aiohttp.ClientSession() if self.use_aiohttp else None
+
+        try:
+            events_per_date = await asyncio.gather(*[self.scrape_events_page_async(BASE_EVENTS_URL, d) for d in all_dates])
+        finally:
+            if self.http is not None:
+                await self.http.close()
+
+        # Some events will simply be None if they were unparsable
+        return [e for events in events_per_date for e in events if e is not None]
+
+    async def scrape_events_page_async(self, events_url, date):
+        try:
+            html = await self.fetch(events_url, {'date' : str(date)})
+            await self._archive(LISTING, events_url, date, html)
+            event_urls = await self._run_in_executor(self.parse_listing_html, html)
+        except Exception:
+            log.exception('Scraping the listing of %s failed', date)
+            event_urls = []
+
+        # So callers can tell which stored events are no longer listed, as with EventScraper
+        self.event_urls_by_date[date] = event_urls
+
+        return await asyncio.gather(*[self.scrape_one_event_async(url, date) for url in event_urls])
+
+    async def scrape_one_event_async(self, url, date):
+        try:
+            html = await self.fetch(url)
+            await self._archive(EVENT, url, date, html)
+            return await self._run_in_executor(self.parse_event_html, html, url, date)
+        except Exception:
+            log.exception('Scraping event page %s failed', url)
+            return None
+
+    async def _archive(self, kind, url, date, html):
+        if self.page_archive is not None:
+            await self._run_in_executor(self.page_archive.add, kind, url, date, html)
+
+    def _run_in_executor(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def fetch(self, url, params=None):
+        '''
+        Returns the text of <url> (GET with <params>), retrying failures.
+        Raises FetchError if every try failed
+        '''
+        host = urlparse(url).netloc
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            async with self.semaphore:
+                await self.rate_limiter.wait(host)
+
+                try:
+                    status, text = await self._get(url, params)
+                except FETCH_ERRORS as e:
+                    log.warning('Fetching %s failed (try %i): %s', url, attempt + 1, e)
+                    continue
+
+            # Server errors are worth another try, anything else isn't going to change
+            if status < 500:
+                return text
+            log.warning('Fetching %s got %i (try %i)', url, status, attempt + 1)
+
+        raise FetchError('Gave up fetching %s after %i tries' % (url, self.retries + 1))
+
+    async def _get(self, url, params):
+        '''
+        Returns (status code, text) of a GET
+        '''
+        if self.http is not None:
+            async with self.http.get(url, params=params) as response:
+                return response.status, await response.text()
+
+        response = await self._run_in_executor(lambda: self.session.get(url, params=params))
+        return response.status_code, response.text
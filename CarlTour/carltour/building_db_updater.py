@@ -1,28 +1,86 @@
 import datetime
+import sys
 import fuzzywuzzy.fuzz
 
 from urllib.parse import urlparse
 from pymongo import MongoClient
 from pyramid.paster import bootstrap
 
+from carltour.building_matcher import LOW_SCORE_THRESHOLD
 from carltour.event_scraper import EventScraper
+from carltour.location_cache import LocationCache
+from carltour.match_evaluator import LABELED_LOCATIONS_FILE, evaluate_matcher, load_labeled_locations
+from carltour.reresolve import ReresolveJob
 
 class BuildingMatchEvaluator:
-    def __init__(self, start_date, end_date, db, buildings_collection_name='buildings'):
+    def __init__(self, start_date, end_date, db, buildings_collection_name='buildings', events_collection_name='events'):
         self.start_date = start_date
         self.end_date = end_date
         self.db = db
         self.buildings_collection = db[buildings_collection_name]
+        self.events_collection = db[events_collection_name]
 
         # The building objects at the start of this run. These will not yet
         # have the new alias information given by user
         self.current_buildings = list(self.buildings_collection.find())
-        self.scraper = EventScraper(self.current_buildings, building_callback=self.cl_user_update_aliases)
+        self.location_cache = LocationCache(db)
+        self.added_aliases = []
+        self.scraper = EventScraper(self.current_buildings, building_callback=self.cl_user_update_aliases,
+            location_cache=self.location_cache)
+
+    def run_evaluator(self, stored_only=False, max_score=LOW_SCORE_THRESHOLD):
+        '''
+        Asks about every location scraped between our dates or, if <stored_only>, only
+        about the locations of already stored events that matched with a score
+        below <max_score> (without scraping anything)
+        '''
+        if stored_only:
+            self.review_stored_matches(max_score)
+        else:
+            events = self.scraper.get_events_for_dates(self.start_date, self.end_date)
+
+        # Fix up the stored events the new aliases match differently
+        if len(self.added_aliases) > 0:
+            # Past events included: the evaluator is run to fix what's stored
+            job = ReresolveJob(self.db, self.added_aliases, since=None)
+            job.run()
+            print('Re-resolved %(affected)i locations, updated %(events_updated)i events' % job.status)
 
-    def run_evaluator(self):
-        events = self.scraper.get_events_for_dates(self.start_date, self.end_date)
         print('Evaluator done!')
 
+    def run_batch(self, labeled_file=LABELED_LOCATIONS_FILE, repeat=1):
+        '''
+        Non-interactive: matches the labeled locations in <labeled_file> against our
+        buildings and returns the accuracy/speed report (see match_evaluator.py)
+        '''
+        return evaluate_matcher(self.current_buildings, load_labeled_locations(labeled_file), repeat)
+
+    def review_stored_matches(self, max_score):
+        '''
+        Asks about each distinct location of the stored events between our dates
+        that matched with a score below <max_score>, doubtful ones first
+        '''
+        spec = {
+            'start_datetime' : {
+                '$gte' : datetime.datetime.combine(self.start_date, datetime.time()),
+                '$lt' : datetime.datetime.combine(self.end_date + datetime.timedelta(days=1), datetime.time())
+            },
+            'match_score' : {'$lt' : max_score},
+            'building_set_by_hand' : {'$ne' : True}
+        }
+        docs = self.events_collection.find(
+            spec=spec,
+            fields={'full_location' : True, 'matched_alias' : True, 'match_score' : True, '_id' : False}
+        ).sort('match_score')
+
+        seen = set()
+        for doc in docs:
+            if doc['full_location'] not in seen:
+                seen.add(doc['full_location'])
+                self.cl_user_update_aliases(doc['full_location'], doc['matched_alias'], doc['match_score'])
+
+        print('Reviewed %i locations scoring below %i' % (len(seen), max_score))
+
     def cl_user_update_aliases(self, full_location_str, closest_match_str, closest_match_score):
         formal_building_names = [b['name'] for b in self.current_buildings]
 
@@ -56,8 +114,13 @@ class BuildingMatchEvaluator:
                     {'name' : correct_building},
                     {'$set' : {'aliases' : updated_aliases}}
                 )
+                self.added_aliases.append(new_alias)
                 print("Added alias '%s' for '%s' with score %i" % (new_alias, correct_building, alias_score))
 
+            # The remembered match for this location was wrong, and any others the
+            # new alias could change have to be redone
+            self.location_cache.invalidate_alias(new_alias, full_location_str)
+
         print('-'*30)
 
 
@@ -75,4 +138,5 @@ if __name__ == '__main__':
     end_date = datetime.date(2014, 5, 15)
 
     match_evaluator = BuildingMatchEvaluator(start_date, end_date, db)
-    match_evaluator.run_evaluator()
+    # Only look at the doubtful matches already in the DB, rather than every scraped location
+    match_evaluator.run_evaluator(stored_only='--stored' in sys.argv)
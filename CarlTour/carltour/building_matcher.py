@@ -0,0 +1,234 @@
+from collections import Counter, defaultdict
+
+import fuzzywuzzy.fuzz
+
+# numpy is optional: without it match_many just calls match for each location
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Locations whose bounds are worked out together in match_many. The work
+# array is (chunk size x names x distinct characters) big
+MATCH_MANY_CHUNK_SIZE = 16
+
+# Matches scoring below this are doubtful, and worth a person looking at
+LOW_SCORE_THRESHOLD = 80
+
+
+class BuildingMatcher:
+    '''
+    Finds the building whose official name or alias is most similar to a
+    location string, giving the same answer as scoring every name with
+    fuzzywuzzy.fuzz.partial_ratio (see brute_force_match), but without
+    running partial_ratio against every name.
+
+    partial_ratio can never be higher than what the characters the two
+    strings share allow, so we keep an index from each character to the
+    names containing it. For a location we count the shared characters of
+    every name in one pass over the index, turn that into an upper bound
+    on the score, and only run the real scorer on names (best bound first)
+    whose bound can still beat the best score found so far.
+    '''
+
+    def __init__(self, building_dicts):
+        '''
+        <building_dicts> is the same list of {'name' : ..., 'aliases' : [...]}
+        dictionaries that EventScraper takes
+        '''
+        # (official_name, name_or_alias), in the order the brute force scan visits them
+        self.names = []
+        self.name_lengths = []
+        # character -> list of (index into self.names, count of character in that name)
+        self.char_index = defaultdict(list)
+
+        for build in building_dicts:
+            official_name = build['name']
+
+            for bname in [official_name] + build['aliases']:
+                name_idx = len(self.names)
+                self.names.append((official_name, bname))
+                self.name_lengths.append(len(bname))
+
+                for char, count in Counter(bname).items():
+                    self.char_index[char].append((name_idx, count))
+
+    def match(self, location_str):
+        '''
+        Returns (official_name, matched_str, score) for the name or alias most
+        similar to <location_str>. Ties go to the name that comes first in the
+        building dicts, and ('', '', 0) is returned if nothing scores above 0
+        '''
+        return self._best_of(location_str, self._candidates(location_str))
+
+    def margin(self, location_str, match):
+        '''
+        How much better <match> (what match returned for <location_str>) scores than
+        the best name of any other building. Small margins mean the match could
+        easily have gone to a different building
+        '''
+        official_name, matched_str, score = match
+        if official_name == '':
+            return 0
+
+        runner_up = self._best_of(location_str, self._candidates(location_str), exclude_building=official_name)
+        return score - runner_up[2]
+
+    def _best_of(self, location_str, candidates, exclude_building=None):
+        '''
+        Scores <location_str> against <candidates>, (score_upper_bound, name_index)
+        pairs sorted best bound first, until no candidate left can do better.
+        Names of <exclude_building> are skipped.
+        Returns the (official_name, matched_str, score) of the best
+        '''
+        best_idx = None
+        best_score = 0
+
+        for bound, name_idx in candidates:
+            # Sorted by bound, so nothing after this can beat (or tie) the best
+            if bound < best_score:
+                break
+            if self.names[name_idx][0] == exclude_building:
+                continue
+
+            score = fuzzywuzzy.fuzz.partial_ratio(location_str, self.names[name_idx][1])
+
+            if score > best_score or (score == best_score and best_idx is not None and name_idx < best_idx):
+                best_score = score
+                best_idx = name_idx
+
+        if best_idx is None:
+            return '', '', 0
+
+        official_name, matched_str = self.names[best_idx]
+        return official_name, matched_str, best_score
+
+    def match_many(self, location_strs):
+        '''
+        Same as [self.match(l) for l in <location_strs>], for when there are a lot of
+        locations (e.g. re-resolving every stored event after aliases change).
+        The score bounds of every location against every name are worked out as
+        numpy array operations, rather than one character at a time. Only that
+        prefilter is vectorized: names whose bound can still win are scored with
+        partial_ratio one at a time, same as in match
+        '''
+        location_strs = list(location_strs)
+        if numpy is None or len(self.names) == 0:
+            return [self.match(l) for l in location_strs]
+
+        chars, name_counts = self._count_matrix()
+        char_columns = dict((c, i) for i, c in enumerate(chars))
+        name_lengths = numpy.array(self.name_lengths)
+        matches = []
+
+        for chunk_start in range(0, len(location_strs), MATCH_MANY_CHUNK_SIZE):
+            chunk = location_strs[chunk_start:chunk_start + MATCH_MANY_CHUNK_SIZE]
+
+            # Characters no name has can't be shared, so they can be left out
+            location_counts = numpy.zeros((len(chunk), len(chars)), dtype=numpy.int32)
+            for row, location_str in enumerate(chunk):
+                for char, count in Counter(location_str).items():
+                    if char in char_columns:
+                        location_counts[row, char_columns[char]] = count
+
+            shared = numpy.minimum(location_counts[:, None, :], name_counts[None, :, :]).sum(axis=2)
+            location_lengths = numpy.array([len(l) for l in chunk])
+            shorter = numpy.minimum(location_lengths[:, None], name_lengths[None, :])
+            bounds = partial_ratio_upper_bounds(shared, shorter)
+
+            for row, location_str in enumerate(chunk):
+                # Stable sort, so equal bounds stay in name order like _candidates.
+                # (mergesort is numpy's only stable kind before 1.15)
+                order = numpy.argsort(-bounds[row], kind='mergesort')
+                order = order[shared[row, order] > 0]
+                candidates = zip(bounds[row, order].tolist(), order.tolist())
+                matches.append(self._best_of(location_str, candidates))
+
+        return matches
+
+    def _count_matrix(self):
+        '''
+        Returns (characters, matrix) where matrix[i, j] is how many times
+        characters[j] is in self.names[i]
+        '''
+        chars = sorted(self.char_index)
+        counts = numpy.zeros((len(self.names), len(chars)), dtype=numpy.int32)
+
+        for column, char in enumerate(chars):
+            for name_idx, count in self.char_index[char]:
+                counts[name_idx, column] = count
+
+        return chars, counts
+
+    def _candidates(self, location_str):
+        '''
+        Returns a list of (score_upper_bound, name_index) for every name sharing
+        at least one character with <location_str>, best bound first
+        '''
+        location_counts = Counter(location_str)
+        shared_chars = defaultdict(int)
+
+        for char, location_count in location_counts.items():
+            for name_idx, name_count in self.char_index.get(char, ()):
+                shared_chars[name_idx] += min(location_count, name_count)
+
+        location_len = len(location_str)
+        candidates = [
+            (partial_ratio_upper_bound(shared, min(location_len, self.name_lengths[name_idx])), name_idx)
+            for name_idx, shared in shared_chars.items()
+        ]
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+
+        return candidates
+
+
+def partial_ratio_upper_bound(shared_chars, shorter_len):
+    '''
+    The highest score partial_ratio could give two strings which have
+    <shared_chars> characters in common, the shorter of which is <shorter_len> long.
+
+    partial_ratio compares the shorter string against windows of the longer one
+    (at most <shorter_len> long); a window with M matching characters scores
+    2M / (shorter_len + window_len), and M can't be more than the characters
+    the strings share, nor more than the window's length
+    '''
+    ratio = 2.0 * shared_chars / (shorter_len + shared_chars)
+
+    # Same rounding partial_ratio does, so the bound is comparable to its scores
+    if ratio > .995:
+        return 100
+    return int(round(100 * ratio))
+
+
+def partial_ratio_upper_bounds(shared_chars, shorter_lens):
+    '''
+    partial_ratio_upper_bound over numpy arrays of <shared_chars> and <shorter_lens>
+    '''
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        ratios = 2.0 * shared_chars / (shorter_lens + shared_chars)
+
+    # numpy rounds halves to even, same as round() does
+    bounds = numpy.where(ratios > .995, 100, numpy.round(100 * ratios))
+    return numpy.nan_to_num(bounds).astype(numpy.int32)
+
+def brute_force_match(building_dicts, location_str):
+    '''
+    Scores <location_str> against every official name and alias in
+    <building_dicts>. This is what BuildingMatcher.match must agree with
+    '''
+    closest_match_build = ''
+    closest_match_actual_str = ''
+    closest_match_score = 0
+
+    for build in building_dicts:
+        official_name = build['name']
+
+        for bname in [official_name] + build['aliases']:
+            cur_build_score = fuzzywuzzy.fuzz.partial_ratio(location_str, bname)
+
+            if cur_build_score > closest_match_score:
+                closest_match_score = cur_build_score
+                closest_match_build = official_name
+                closest_match_actual_str = bname
+
+    return closest_match_build, closest_match_actual_str, closest_match_score
@@ -0,0 +1,93 @@
+import contextlib
+import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+# One document per sequence of changes:
+# {'_id' : 'events', 'seq' : 1234, 'pending' : [{'seq' : 1234, 'at' : datetime}, ...]}
+# <pending> lists the sequence numbers handed out to writes that haven't finished yet
+SEQUENCES_COLLECTION = 'sequences'
+EVENTS_SEQUENCE = 'events'
+
+# Every write to an event stamps it with the sequence number of the write,
+# so clients can ask for what changed after the last number they saw
+CHANGE_SEQ_FIELD = 'change_seq'
+# Removed events are kept (with this set to True) so clients hear about the removal
+DELETED_FIELD = 'deleted'
+
+# What sync clients are given to tell events apart by, for events stored before
+# they had an event_key: this plus their _id
+UNKEYED_PREFIX = 'unkeyed-'
+
+# Writes that haven't finished after this long are taken to have died
+PENDING_TIMEOUT = datetime.timedelta(minutes=10)
+
+def reserve_sequence(db, name=EVENTS_SEQUENCE):
+    '''
+    The next sequence number of <name>, marked pending until finish_sequence is called
+    '''
+    collection = db[SEQUENCES_COLLECTION]
+    if collection.find_one({'_id' : name}) is None:
+        try:
+            collection.insert({'_id' : name, 'seq' : 0, 'pending' : []})
+        except DuplicateKeyError:
+            pass
+
+    # Taking the number and marking it pending have to happen in one update, or a
+    # reader could see the number as settled in between. So it's compare-and-swap
+    while True:
+        seq = collection.find_one({'_id' : name})['seq'] + 1
+        result = collection.update({'_id' : name, 'seq' : seq - 1}, {
+            '$set' : {'seq' : seq},
+            '$push' : {'pending' : {'seq' : seq, 'at' : datetime.datetime.utcnow()}}
+        })
+        if result['n'] == 1:
+            return seq
+
+def finish_sequence(db, seq, name=EVENTS_SEQUENCE):
+    db[SEQUENCES_COLLECTION].update({'_id' : name}, {'$pull' : {'pending' : {'seq' : seq}}})
+
+@contextlib.contextmanager
+def change_sequence(db, name=EVENTS_SEQUENCE):
+    '''
+    Context manager giving the sequence number a batch of writes should stamp
+    its changes with. Readers won't go past it until the block is done
+    '''
+    seq = reserve_sequence(db, name)
+    try:
+        yield seq
+    finally:
+        finish_sequence(db, seq, name)
+
+def settled_sequence(db, name=EVENTS_SEQUENCE):
+    '''
+    The highest sequence number whose writes, and every earlier one's, have finished.
+    Changes up to it can be handed out without missing any still being written
+    '''
+    doc = db[SEQUENCES_COLLECTION].find_one({'_id' : name})
+    if doc is None:
+        return 0
+
+    cutoff = datetime.datetime.utcnow() - PENDING_TIMEOUT
+    pending = [p['seq'] for p in doc.get('pending', []) if p['at'] >= cutoff]
+
+    if len(pending) > 0:
+        return min(pending) - 1
+    return doc['seq']
+
+def stamp_unsequenced_events(collection):
+    '''
+    Give the events in <collection> written before change sequences a sequence
+    number, so syncing clients get them too. Returns how many there were
+    '''
+    with change_sequence(collection.database) as seq:
+        result = collection.update({CHANGE_SEQ_FIELD : {'$exists' : False}}, {'$set' : {CHANGE_SEQ_FIELD : seq}}, multi=True)
+
+    return result['n']
+
+def sync_key(event):
+    '''
+    The key sync clients know the stored <event> by: its event_key, or one made
+    from its _id if it was stored before events had keys
+    '''
+    return event.get('event_key') or UNKEYED_PREFIX + str(event['_id'])
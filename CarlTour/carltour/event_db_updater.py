@@ -1,29 +1,272 @@
+import argparse
 import datetime
+import hashlib
 from urllib.parse import urlparse
 
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
 from pyramid.paster import bootstrap
 
+from carltour.async_scraper import AsyncEventScraper
+from carltour.change_log import CHANGE_SEQ_FIELD, DELETED_FIELD, change_sequence
+from carltour.event_index import MODIFIED_FIELD
 from carltour.event_scraper import EventScraper
+from carltour.location_cache import LocationCache
+from carltour.page_store import PageStore
+from carltour.response_cache import bump_version
 
-def update_db_for_dates(start_date, end_date, db, collection_name='events', buildings_collection='buildings'):
+# Pages are fetched concurrently when updating the DB; nobody is waiting on
+# a building callback here
+SCRAPE_WORKERS = 8
+
+# Number of upserts sent to Mongo in one bulk operation
+DEFAULT_BATCH_SIZE = 500
+
+def make_event_key(event):
+    '''
+    A stable identity for a scraped <event>, used to find it again on the next scrape.
+    The event page URL is the same every time an event is listed, but recurring
+    events share it, so the day of the event is part of the key too.
+    Events without a URL fall back to their title, start time and location
+    '''
+    if event.get('event_url'):
+        parts = [event['event_url'], event['start_datetime'].date().isoformat()]
+    else:
+        parts = [event['title'], event['start_datetime'].isoformat(), event['full_location']]
+
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+# What a building fixed by hand (see UpdateBuilding) decides, so rescrapes leave them alone
+MATCH_FIELDS = ['building', 'match_score', 'matched_alias', 'match_margin']
+
+class BulkEventWriter:
+    '''
+    Collects events and upserts them (keyed on make_event_key) with unordered bulk
+    operations of <batch_size> events each, instead of one round-trip per event.
+    Stored events whose building was set by hand keep it (and its MATCH_FIELDS).
+
+    Counts of inserted/updated/unchanged events are kept in <self.counts>
+    '''
+
+    def __init__(self, collection, batch_size=DEFAULT_BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.pending = []
+        self.counts = {'inserted' : 0, 'updated' : 0, 'unchanged' : 0}
+
+    def add(self, event):
+        self.pending.append(event)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Send everything added since the last flush to Mongo
+        '''
+        if len(self.pending) == 0:
+            return
+
+        # Two of the same event in one bulk op would both try to insert it, and one
+        # would fail on the unique event_key index. The last scraped copy wins
+        keyed = dict((make_event_key(e), e) for e in self.pending)
+        self.pending = list(keyed.values())
+
+        now = datetime.datetime.utcnow()
+
+        with change_sequence(self.collection.database) as seq:
+            stamps = {MODIFIED_FIELD : now, CHANGE_SEQ_FIELD : seq}
+            bulk = self.collection.initialize_unordered_bulk_op()
+
+            for event_key, e in keyed.items():
+                # Stored events are only touched if something about them changed (see
+                # changed_spec), so MODIFIED_FIELD and CHANGE_SEQ_FIELD say when they last did
+                bulk.find({
+                    'event_key' : event_key,
+                    'building_set_by_hand' : {'$ne' : True},
+                    '$or' : changed_spec(e)
+                }).update({
+                    '$set' : dict(e, **stamps),
+                    '$unset' : {DELETED_FIELD : ''}
+                })
+
+                by_hand = dict((field, value) for field, value in e.items() if field not in MATCH_FIELDS)
+                bulk.find({
+                    'event_key' : event_key,
+                    'building_set_by_hand' : True,
+                    '$or' : changed_spec(by_hand)
+                }).update({
+                    '$set' : dict(by_hand, **stamps),
+                    '$unset' : {DELETED_FIELD : ''}
+                })
+
+                bulk.find({'event_key' : event_key}).upsert().update({
+                    '$setOnInsert' : dict(e, event_key=event_key, **stamps)
+                })
+            result = bulk.execute()
+
+        # The last operation matches every event that was already stored, so
+        # what's left of nMatched are the ones the other two (only one of which
+        # can match) changed
+        inserted = result['nUpserted']
+        updated = result['nMatched'] - (len(self.pending) - inserted)
+
+        self.counts['inserted'] += inserted
+        self.counts['updated'] += updated
+        self.counts['unchanged'] += len(self.pending) - inserted - updated
+        self.pending = []
+
+def changed_spec(event):
+    '''
+    $or clauses matching a stored version of <event> that differs from it in some
+    field. Removed events that are listed again, and ones from before change
+    sequences, count as changed too
+    '''
+    changed = [{field : {'$ne' : value}} for field, value in event.items()]
+    return changed + [{DELETED_FIELD : True}, {CHANGE_SEQ_FIELD : {'$exists' : False}}]
+
+def make_scraper(db, buildings_collection='buildings', workers=SCRAPE_WORKERS, incremental=False, page_archive=None,
+                 backfill=False):
+    '''
+    The scraper update_db_for_dates scrapes with, matching against the buildings
+    in <db> as they are now. The other arguments are as for update_db_for_dates
+    '''
+    buildings = list(db[buildings_collection].find())
+    page_store = PageStore(db) if incremental else None
+
+    if backfill:
+        return AsyncEventScraper(buildings, concurrency=workers, location_cache=LocationCache(db),
+            page_store=page_store, page_archive=page_archive)
+    return EventScraper(buildings, workers=workers, location_cache=LocationCache(db), page_store=page_store,
+        page_archive=page_archive)
+
+def update_db_for_dates(start_date, end_date, db, collection_name='events', buildings_collection='buildings',
+                        workers=SCRAPE_WORKERS, batch_size=DEFAULT_BATCH_SIZE, incremental=False, page_archive=None,
+                        backfill=False, scraper=None):
     '''
     Insert all events scraped from the website that take place between
     <start_date> and <end_date>
 
     Both parameters should be datetime.date objects
+    <workers> is the number of threads the scraper fetches pages with
+    If <incremental>, pages that haven't changed since they were last scraped
+    are skipped (see PageStore), so only new or changed events are upserted
+    Pages fetched are saved to <page_archive> (a PageArchive), if given
+    If <backfill>, every date's pages are fetched at once on an event loop (see
+    AsyncEventScraper, which fetches <workers> pages at a time). Best for long
+    ranges of dates; it can't be <incremental>
+    <scraper>, from make_scraper, is scraped with if given (and the arguments it
+    was made with are ignored), so several calls can share one
+    Stored events on those dates that are no longer listed are marked removed
+    (see remove_unlisted_events).
+    Returns the inserted/updated/unchanged counts of a BulkEventWriter, and
+    how many events were removed
     '''
-    buildings = list(db[buildings_collection].find())
-    scraper = EventScraper(buildings)
+    if scraper is None:
+        scraper = make_scraper(db, buildings_collection, workers, incremental, page_archive, backfill)
+    page_store = scraper.page_store
+
+    writer = BulkEventWriter(db[collection_name], batch_size)
 
-    event_dicts = scraper.get_events_for_dates(start_date, end_date)
-    collection = db[collection_name]
+    try:
+        for e in scraper.get_events_for_dates(start_date, end_date):
+            writer.add(e)
+        writer.flush()
+    except Exception:
+        # <scraper> may be used again (see ScrapeDaemon.run_once), and its next
+        # save_page_states mustn't mark the pages of these unwritten events scraped
+        scraper.discard_page_states()
+        raise
 
-    inserted_ids = [collection.update(e, e, upsert = True) for e in event_dicts]
+    # Only now that the events are written can their pages be skipped next time
+    if page_store is not None:
+        scraper.save_page_states()
+
+    removed = remove_unlisted_events(db[collection_name], scraper.event_urls_by_date, page_store)
+    removed += remove_unkeyed_events(db[collection_name], scraper.event_urls_by_date)
+    counts = dict(writer.counts, removed=removed)
+
+    # Let the app know its cached event responses are stale
+    if counts['inserted'] > 0 or counts['updated'] > 0 or counts['removed'] > 0:
+        bump_version(db)
+
+    return counts
+
+def remove_unlisted_events(collection, event_urls_by_date, page_store=None):
+    '''
+    Mark the stored events starting on each date of <event_urls_by_date> whose
+    event page isn't one of the URLs now listed for that date as removed.
+    They're kept as tombstones, so clients syncing changes hear about it.
+    Their pages are forgotten by <page_store> (a PageStore), if given: should an
+    event be listed again with its page unchanged, an incremental scrape still
+    has to return it, or it would never be brought back.
+    Returns the number of events removed
+    '''
+    now = datetime.datetime.utcnow()
+    removed = 0
+
+    with change_sequence(collection.database) as seq:
+        for d, urls in event_urls_by_date.items():
+            # An empty listing is more likely a broken page than a day with nothing on
+            if len(urls) == 0:
+                continue
+
+            day_start = datetime.datetime.combine(d, datetime.time())
+            spec = {
+                'start_datetime' : {'$gte' : day_start, '$lt' : day_start + datetime.timedelta(days=1)},
+                'event_url' : {'$exists' : True, '$nin' : urls},
+                DELETED_FIELD : {'$ne' : True}
+            }
+
+            if page_store is not None:
+                page_store.forget(set(e['event_url'] for e in collection.find(spec, {'event_url' : True})))
+
+            result = collection.update(spec, {
+                '$set' : {DELETED_FIELD : True, MODIFIED_FIELD : now, CHANGE_SEQ_FIELD : seq}
+            }, multi=True)
+            removed += result['n']
+
+    return removed
+
+def remove_unkeyed_events(collection, event_urls_by_date):
+    '''
+    Mark the stored events starting on each date of <event_urls_by_date> that
+    were written before events had an event_key (and event_url) as removed:
+    there's no working out which scraped event they are, so the scrape just
+    written has replaced them, and BulkEventWriter would otherwise leave both
+    copies around. Like remove_unlisted_events they're kept as tombstones; sync
+    clients know them by sync_key.
+    Returns the number of events removed
+    '''
+    now = datetime.datetime.utcnow()
+    removed = 0
+
+    with change_sequence(collection.database) as seq:
+        for d, urls in event_urls_by_date.items():
+            # Same as remove_unlisted_events: don't trust an empty listing
+            if len(urls) == 0:
+                continue
+
+            day_start = datetime.datetime.combine(d, datetime.time())
+            result = collection.update({
+                'start_datetime' : {'$gte' : day_start, '$lt' : day_start + datetime.timedelta(days=1)},
+                'event_key' : {'$exists' : False},
+                DELETED_FIELD : {'$ne' : True}
+            }, {
+                '$set' : {DELETED_FIELD : True, MODIFIED_FIELD : now, CHANGE_SEQ_FIELD : seq}
+            }, multi=True)
+            removed += result['n']
+
+    return removed
 
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Scrape the events of a range of dates into the DB')
+    arg_parser.add_argument('start_date', nargs='?', default='2014-05-19', help='YYYY-MM-DD')
+    arg_parser.add_argument('end_date', nargs='?', default='2014-05-21', help='YYYY-MM-DD')
+    arg_parser.add_argument('--backfill', action='store_true', help='fetch every date at once (for long ranges)')
+    args = arg_parser.parse_args()
+
     # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/commandline.html#writing-a-script
     # for explanation -- we want to access the same Mongo config data that our app uses.
     # "bootstrapping" gives us access to a "typical" pyramid environment without
@@ -32,7 +275,8 @@ if __name__ == '__main__':
     env = bootstrap('../development.ini')
     db = env['request'].db
 
-    start_date = datetime.date(2014, 5, 19)
-    end_date = datetime.date(2014, 5, 21)
+    start_date = datetime.datetime.strptime(args.start_date, '%Y-%m-%d').date()
+    end_date = datetime.datetime.strptime(args.end_date, '%Y-%m-%d').date()
 
-    update_db_for_dates(start_date, end_date, db)
+    counts = update_db_for_dates(start_date, end_date, db, backfill=args.backfill)
+    print('Inserted %(inserted)i, updated %(updated)i, unchanged %(unchanged)i, removed %(removed)i events' % counts)
@@ -0,0 +1,144 @@
+import bisect
+import datetime
+import logging
+import threading
+
+from pymongo import ASCENDING
+
+from carltour.change_log import CHANGE_SEQ_FIELD, DELETED_FIELD, settled_sequence
+
+log = logging.getLogger(__name__)
+
+# Every write to an event sets this to when its content last changed
+MODIFIED_FIELD = 'modified_at'
+
+# The index holds the events overlapping [now - DEFAULT_DAYS_BEFORE, now + DEFAULT_DAYS_AHEAD]
+DEFAULT_DAYS_BEFORE = 1
+DEFAULT_DAYS_AHEAD = 14
+
+class EventIntervalIndex:
+    '''
+    In-memory copy of the events overlapping a rolling window around now, sorted
+    by (start_datetime, _id), that answers the overlap queries UpcomingEventsAPI
+    makes without going to Mongo.
+
+    Events are found with a binary search on start_datetime: an event overlapping
+    [first, final] starts at or before final, and no earlier than first minus the
+    longest event held. Only the events between those two are looked at.
+
+    When the events version changes (see bump_version) only the events changed
+    since the index last looked are fetched and merged in: those whose
+    CHANGE_SEQ_FIELD is past the settled sequence (see settled_sequence) it was
+    last brought up to, and no further than the one settled now. Modified times
+    wouldn't do, since a write stamped earlier can land after one stamped later.
+    Once the window gets close to running out, everything is loaded again.
+    Queries read an immutable snapshot, so they don't take the lock.
+    '''
+
+    def __init__(self, days_before=DEFAULT_DAYS_BEFORE, days_ahead=DEFAULT_DAYS_AHEAD, collection_name='events'):
+        self.days_before = datetime.timedelta(days=days_before)
+        self.days_ahead = datetime.timedelta(days=days_ahead)
+        self.collection_name = collection_name
+        self.lock = threading.Lock()
+
+        # (range_start, range_end, version, settled sequence, sort keys, events, longest event)
+        self.snapshot = None
+
+    def covers(self, first_datetime, final_datetime):
+        snapshot = self.snapshot
+        return snapshot is not None and snapshot[0] <= first_datetime and final_datetime <= snapshot[1]
+
+    def refresh(self, db, version, now=None):
+        '''
+        Bring the index up to <version> of the events in <db>
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+
+        with self.lock:
+            snapshot = self.snapshot
+
+            # Keep at least half the look-ahead in the window, or start over
+            if snapshot is None or now + self.days_ahead / 2 > snapshot[1] or now - self.days_before < snapshot[0]:
+                self.snapshot = self._load(db, version, now - self.days_before, now + self.days_ahead)
+            elif version != snapshot[2]:
+                self.snapshot = self._merge(db, version, snapshot)
+
+    def find(self, first_datetime, final_datetime):
+        '''
+        The events overlapping [<first_datetime>, <final_datetime>], sorted by
+        (start_datetime, _id). Only right if covers() says so
+        '''
+        range_start, range_end, version, seq, keys, events, longest = self.snapshot
+
+        lo = bisect.bisect_left(keys, (first_datetime - longest,))
+        hi = bisect.bisect_right(keys, (final_datetime, _MAX_KEY))
+
+        return [e for e in events[lo:hi] if e['end_datetime'] >= first_datetime]
+
+    def _load(self, db, version, range_start, range_end):
+        # Read first: whatever is written while loading is fetched again by the next merge
+        seq = settled_sequence(db)
+        spec = {'start_datetime' : {'$lte' : range_end}, 'end_datetime' : {'$gte' : range_start}, DELETED_FIELD : {'$ne' : True}}
+        events = list(db[self.collection_name].find(spec=spec).sort([('start_datetime', ASCENDING), ('_id', ASCENDING)]))
+
+        log.debug('Loaded %i events between %s and %s into the index', len(events), range_start, range_end)
+        return self._make_snapshot(range_start, range_end, version, seq, events)
+
+    def _merge(self, db, version, snapshot):
+        range_start, range_end, old_version, old_seq, keys, events, longest = snapshot
+
+        # Writes past the settled sequence may still be going, so they're left
+        # for a later merge. Not limited to the window, since events may have moved out of it
+        seq = settled_sequence(db)
+        changed = list(db[self.collection_name].find(spec={CHANGE_SEQ_FIELD : {'$gt' : old_seq, '$lte' : seq}}))
+
+        # Replaced events may have moved, so they're dropped and sorted back in.
+        # Removed ones just go
+        changed_ids = set(e['_id'] for e in changed)
+        merged = [e for e in events if e['_id'] not in changed_ids]
+        merged.extend(e for e in changed
+            if e['start_datetime'] <= range_end and e['end_datetime'] >= range_start and not e.get(DELETED_FIELD))
+        merged.sort(key=_sort_key)
+
+        log.debug('Merged %i changed events into the index', len(changed))
+        return self._make_snapshot(range_start, range_end, version, seq, merged)
+
+    def _make_snapshot(self, range_start, range_end, version, seq, events):
+        keys = [_sort_key(e) for e in events]
+        longest = max([e['end_datetime'] - e['start_datetime'] for e in events] + [datetime.timedelta(0)])
+
+        return range_start, range_end, version, seq, keys, events, longest
+
+def _sort_key(event):
+    return event['start_datetime'], event['_id']
+
+class _MaxKey:
+    '''
+    Sorts after any _id, so (t, _MAX_KEY) comes after every event starting at t
+    '''
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+_MAX_KEY = _MaxKey()
+
+def project_event(event, fields, paged):
+    '''
+    <event> cut down to what UpcomingEventsAPI's Mongo projection would have returned
+    '''
+    if fields is None:
+        projected = dict(event)
+    else:
+        projected = dict((f, event[f]) for f in fields if f in event)
+        if paged:
+            projected['start_datetime'] = event['start_datetime']
+
+    if paged:
+        projected['_id'] = event['_id']
+    else:
+        projected.pop('_id', None)
+
+    return projected
@@ -2,10 +2,14 @@ import re
 import datetime
 import bs4 as bs 
 import requests as req
-import fuzzywuzzy.fuzz
 import pprint
 
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse
+from requests.adapters import HTTPAdapter
+
+from carltour.building_matcher import BuildingMatcher
+from carltour.page_archive import EVENT, LISTING
 
 BASE_EVENTS_URL = 'http://apps.carleton.edu/calendar/'
 BASE_CARLETON_URL = 'http://apps.carleton.edu/'
@@ -20,9 +24,28 @@ ONE_TIME_RE = r"([0-9]{1,2}):([0-9]{2})\s*(a|p|n)"
 DEFAULT_START_TIME = datetime.time(hour=8)
 DEFAULT_END_TIME = datetime.time(hour=22)
 
+# Number of threads used to fetch pages. 1 means everything is fetched serially
+DEFAULT_WORKERS = 1
+
+# BeautifulSoup tree builders that can be used to parse pages, fastest first.
+# html5lib is what we originally used and is by far the slowest. lxml fixes up
+# sloppy HTML (unclosed <td>s and such) the same way, html.parser doesn't, so
+# it isn't one of the options
+try:
+    import lxml
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html5lib'
+PARSERS = ['lxml', 'html5lib']
+
+# The only parts of an event page we look at: the title cell, the info
+# table rows and the description/more information blockquotes
+EVENT_PAGE_STRAINER = bs.SoupStrainer(['tr', 'td', 'blockquote'])
+
 class EventScraper:
 
-    def __init__(self, building_dicts, building_callback=None):
+    def __init__(self, building_dicts, building_callback=None, workers=DEFAULT_WORKERS, session=None, location_cache=None,
+                 page_store=None, parser=DEFAULT_PARSER, page_archive=None):
         '''
         <building_dicts> should be a list where each entry is a dictionary
         with keys 'name' and 'aliases', like:
@@ -33,9 +56,45 @@ class EventScraper:
         <building_callback> is a function that is called (once) at the end of an attempt to 
         match a building string to one of the buildings in <self.buildings>
         Takes 3 arguments: (full_input_str, best_match_str, best_match_score)
+        <workers> is the number of threads used to fetch and parse event pages.
+        With more than one worker, <building_callback> is called from those threads.
+        <session> is a requests.Session shared by every fetch; one is made 
+        (with a connection pool sized to <workers>) if not given
+        <location_cache> is an optional LocationCache; locations found in it
+        are not fuzzy matched again
+        <page_store> is an optional PageStore. With one, scrapes are incremental:
+        pages that haven't changed since they were last scraped are skipped, and 
+        only new or changed events are returned. What was fetched of event pages
+        is only stored by save_page_states, once the events have been written
+        <parser> is the BeautifulSoup tree builder pages are parsed with (one of PARSERS)
+        <page_archive> is an optional PageArchive every fetched page is saved to,
+        so it can be parsed again later with replay_events
         '''
         self.buildings = building_dicts
+        self.matcher = BuildingMatcher(building_dicts)
         self.building_callback = building_callback
+        self.workers = max(1, workers)
+        self.session = session if session is not None else make_session(self.workers)
+        self.location_cache = location_cache
+        self.page_store = page_store
+        self.parser = parser
+        self.page_archive = page_archive
+        # date -> event URLs listed on it, for the dates of the last get_events_for_dates
+        self.event_urls_by_date = {}
+        # Event pages fetched but not yet saved to <page_store> (see save_page_states)
+        self.page_states = []
+
+    def _map(self, func, *iterables):
+        '''
+        Like the builtin map, but runs <func> on <self.workers> threads when 
+        there is more than one. Results are always returned as a list in 
+        the same order as the inputs
+        '''
+        if self.workers == 1:
+            return list(map(func, *iterables))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(func, *iterables))
 
     def parse_building(self, location_str):
         '''
@@ -44,30 +103,32 @@ class EventScraper:
         Returns building
 
         '''
-        closest_match_build = ''
-        closest_match_actual_str = ''
-        closest_match_score = 0
+        return self.parse_location(location_str)[0]
 
-        for build in self.buildings:
-            official_name = build['name']
-            aliases = build['aliases']
+    def parse_location(self, location_str):
+        '''
+        Same as parse_building, but returns (building, matched_str, score, margin):
+        the alias (which may be an official name) that gave the highest score, and
+        how far ahead of the best other building it was (see BuildingMatcher.margin)
+        '''
+        match = None
+        if self.location_cache is not None:
+            match = self.location_cache.get(location_str)
 
-            for bname in [official_name] + aliases:
-                cur_build_score = fuzzywuzzy.fuzz.partial_ratio(location_str, bname)
-                
-                if cur_build_score > closest_match_score:
-                    # The best match will be defined by official name, not an alias
-                    closest_match_score = cur_build_score
-                    closest_match_build = official_name
+        if match is None:
+            match = self.matcher.match(location_str)
+            match = match + (self.matcher.margin(location_str, match),)
+            if self.location_cache is not None:
+                self.location_cache.set(location_str, match)
 
-                    # Want to return an official building name, but also keep track 
-                    # of the alias (which may be an official name) that gave highest score
-                    closest_match_actual_str = bname
+        # Want to return an official building name, but also keep track 
+        # of the alias (which may be an official name) that gave highest score
+        closest_match_build, closest_match_actual_str, closest_match_score, margin = match
 
         if self.building_callback is not None:
             self.building_callback(location_str, closest_match_actual_str, closest_match_score)
         
-        return closest_match_build
+        return match
 
     def _parse_title(self, soup):
         '''
@@ -89,20 +150,7 @@ class EventScraper:
         info_text = soup.find('blockquote', {'class' : 'infoText'})
 
         if info_text is not None:
-            # All events seem to have a description, followed by
-            # a few newlines and the string More information..."
-            # Only take the text up to the \n
-            stripped = info_text.get_text().strip()
-            end_of_text = stripped.find('\n')
-            if end_of_text == -1:
-                description = stripped
-            else:
-                description = stripped[:end_of_text]
-
-            # Some descriptions are simply the text of "More information"
-            # Let's not parse this out. Return empty description instead
-            if description.startswith('More information'):
-                description = ''
+            description = description_from_info_text(info_text)
             
         return description
 
@@ -146,6 +194,55 @@ class EventScraper:
 
         return location, start_datetime, end_datetime
 
+    def _parse_all(self, soup, date):
+        '''
+        Does the work of all the _parse_* helpers above in one walk over <soup>.
+        Returns title, description, more_info_url, location, start_datetime, end_datetime
+        '''
+        title_td = None
+        info_text = None
+        more_link_info_blockquote = None
+        location = ''
+        time = None
+
+        for tag in soup.find_all(['td', 'blockquote', 'tr']):
+            if tag.name == 'td':
+                if title_td is None and 'infoTitle' in tag.get('class', []):
+                    title_td = tag
+
+            elif tag.name == 'blockquote':
+                if more_link_info_blockquote is None:
+                    more_link_info_blockquote = tag
+                if info_text is None and 'infoText' in tag.get('class', []):
+                    info_text = tag
+
+            else:
+                tds = tag.find_all('td')
+                if len(tds) == 2:
+                    label = tds[0].text.strip()
+                    if label == 'Time:':
+                        time = tds[1].text.strip()
+                    elif label == 'Location:':
+                        location = tds[1].text.strip()
+
+        title = ''
+        if title_td is not None and len(title_td.contents) > 0:
+            title = title_td.contents[0].strip()
+
+        description = ''
+        if info_text is not None:
+            description = description_from_info_text(info_text)
+
+        more_info_url = ''
+        if more_link_info_blockquote is not None and len(more_link_info_blockquote) > 0:
+            link = more_link_info_blockquote.find('a')
+            if link is not None:
+                more_info_url = make_carl_absolute_url(link['href'])
+
+        start_datetime, end_datetime = make_datetime_obj(date, time)
+
+        return title, description, more_info_url, location, start_datetime, end_datetime
+
     def scrape_one_event(self, url, date):
         '''
         For an event with data at <url>, parse out and return 
@@ -153,19 +250,81 @@ class EventScraper:
 
         The format of the timing will be datetime objects
         '''
-        soup = make_soup(url)
+        if self.page_store is None:
+            return self.parse_event_html(self._get_html(EVENT, url, date), url, date)
+
+        response, page_state = self.page_store.fetch_if_changed(self.session, url, date)
+
+        # Unchanged since the last scrape, so whatever we got then still stands
+        if response is None:
+            return None
+
+        if self.page_archive is not None:
+            self.page_archive.add(EVENT, url, date, response.text)
+        event = self.parse_event_html(response.text, url, date)
+        # Not saved yet: if the event never makes it to the DB, the page
+        # has to look changed next time
+        self.page_states.append(page_state)
+
+        return event
+
+    def save_page_states(self):
+        '''
+        Save the event pages fetched since the last call to <self.page_store>, so
+        the next incremental scrape skips them. Call once the events scraped
+        from them are stored
+        '''
+        page_states, self.page_states = self.page_states, []
 
-        title = self._parse_title(soup)
-        description = self._parse_description(soup)
-        more_info_url = self._parse_more_info_url(soup)
-        location, start_datetime, end_datetime = self._parse_loc_start_end(soup, date)
+        for page_state in page_states:
+            self.page_store.save(page_state)
+
+    def discard_page_states(self):
+        '''
+        Forget the event pages fetched since the last save_page_states, when the
+        events scraped from them couldn't be stored, so they're parsed again
+        next time instead of being saved along with a later scrape's
+        '''
+        self.page_states = []
+
+    def _get_html(self, kind, url, date):
+        '''
+        GET the page at <url> (a day listing or event page, per <kind>) for <date>,
+        archiving it if we have a page archive. Returns its text
+        '''
+        params = {'date' : date} if kind == LISTING else None
+        html = self.session.get(url, params=params).text
+
+        if self.page_archive is not None:
+            self.page_archive.add(kind, url, date, html)
+
+        return html
+
+    def parse_event_html(self, html, url, date):
+        '''
+        Same as parse_event, for the already fetched <html> of an event page
+        '''
+        return self.parse_event(make_soup_from_html(html, self.parser, EVENT_PAGE_STRAINER), url, date)
+
+    def parse_listing_html(self, html):
+        '''
+        Event URLs on the already fetched <html> of a day listing
+        '''
+        return parse_event_urls(make_soup_from_html(html, self.parser))
+
+    def parse_event(self, soup, url, date):
+        '''
+        Build the event dictionary out of the <soup> of its page at <url>, for <date>.
+        Returns None if the event has no location
+        '''
+        title, description, more_info_url, location, start_datetime, end_datetime = self._parse_all(soup, date)
 
         # Some events don't have locations -- how should we handle this?
         # For now, just don't include these events
         if location == '':
             return None
         else:
-            building = self.parse_building(location)
+            building, matched_alias, match_score, match_margin = self.parse_location(location)
     
         return {
             'title' : title,
@@ -174,7 +333,12 @@ class EventScraper:
             'start_datetime' : start_datetime,
             'end_datetime' : end_datetime,
             'building' : building,
-            'full_location' : location
+            'full_location' : location,
+            'event_url' : url,
+            # How sure we are about <building>, so doubtful matches can be found for review
+            'match_score' : match_score,
+            'matched_alias' : matched_alias,
+            'match_margin' : match_margin
         }
 
     def get_all_event_urls(self, event_page_url, date):
@@ -182,20 +346,20 @@ class EventScraper:
         For a main <event_page_url> and <date>, returns a list of absolute URLs to 
         individual events
         '''
-        soup = make_soup(event_page_url, date)
-        all_event_urls = []
+        if self.page_store is None:
+            return self.parse_listing_html(self._get_html(LISTING, event_page_url, date))
 
-        # The titles with no time have class "events_notime"
-        # Go figure.
-        event_titles = soup.find_all('td', {'class' : ['events_title', 'events_notime']})
-        for et in event_titles:
-            link = et.find('a')
-            relative_url_match = re.search(EVENT_JS_RE, link['href'])
+        response, page_state = self.page_store.fetch_if_changed(self.session, event_page_url, date, {'date' : date})
 
-            if relative_url_match is not None:
-                relative_url = relative_url_match.group(1)
-                abs_url = urljoin(BASE_EVENTS_URL, relative_url)
-                all_event_urls.append(abs_url)
+        # Same listing as last time, so the same events (each of which may still have changed)
+        if response is None:
+            return page_state['event_urls']
+
+        if self.page_archive is not None:
+            self.page_archive.add(LISTING, event_page_url, date, response.text)
+
+        all_event_urls = self.parse_listing_html(response.text)
+        self.page_store.save(page_state, event_urls=all_event_urls)
 
         return all_event_urls
 
@@ -205,7 +369,7 @@ class EventScraper:
         on date <date>
         '''
         event_urls = self.get_all_event_urls(events_url, date)
-        parsed_events = [self.scrape_one_event(url, date) for url in event_urls]
+        parsed_events = self._map(self.scrape_one_event, event_urls, [date] * len(event_urls))
 
         return parsed_events
 
@@ -223,16 +387,92 @@ class EventScraper:
             all_dates.append(cur_date)
             cur_date += one_day_delta
 
-        all_events = []
-        for d in all_dates:
-            # Some events will simply be None if they were unparsable
-            all_events.extend([e for e in self.scrape_events_page(BASE_EVENTS_URL, d) if e is not None])
+        # Fetch every day's listing first, then every event on all of those days,
+        # so the worker threads stay busy across day boundaries
+        urls_per_date = self._map(self.get_all_event_urls, [BASE_EVENTS_URL] * len(all_dates), all_dates)
+        # So callers can tell which stored events are no longer listed
+        self.event_urls_by_date = dict(zip(all_dates, urls_per_date))
+
+        event_urls = []
+        event_dates = []
+        for d, urls in zip(all_dates, urls_per_date):
+            event_urls.extend(urls)
+            event_dates.extend([d] * len(urls))
+
+        # Some events will simply be None if they were unparsable
+        all_events = [e for e in self._map(self.scrape_one_event, event_urls, event_dates) if e is not None]
 
         return all_events
 
-def make_soup(url, date_param=None):
+    def replay_events(self, page_archive, start_date, end_date):
+        '''
+        Generator of the events between <start_date> and <end_date>, rebuilt from the
+        pages last archived for them in <page_archive> (a PageArchive) instead of
+        fetching anything. Pages are read and parsed one at a time
+        '''
+        for html, url, date in page_archive.event_pages(start_date, end_date, self.parse_listing_html):
+            event = self.parse_event_html(html, url, date)
+            if event is not None:
+                yield event
+
+def make_session(pool_size=DEFAULT_WORKERS):
+    '''
+    Returns a requests.Session that keeps connections alive between fetches, 
+    with room for <pool_size> connections per host
+    '''
+    session = req.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def parse_event_urls(soup):
+    '''
+    Returns a list of absolute URLs to the events on a day listing's <soup>
+    '''
+    all_event_urls = []
+
+    # The titles with no time have class "events_notime"
+    # Go figure.
+    event_titles = soup.find_all('td', {'class' : ['events_title', 'events_notime']})
+    for et in event_titles:
+        link = et.find('a')
+        relative_url_match = re.search(EVENT_JS_RE, link['href'])
+
+        if relative_url_match is not None:
+            relative_url = relative_url_match.group(1)
+            abs_url = urljoin(BASE_EVENTS_URL, relative_url)
+            all_event_urls.append(abs_url)
+
+    return all_event_urls
+
+def description_from_info_text(info_text):
+    '''
+    The description in an event's infoText blockquote <info_text>
+    '''
+    # All events seem to have a description, followed by
+    # a few newlines and the string More information..."
+    # Only take the text up to the \n
+    stripped = info_text.get_text().strip()
+    end_of_text = stripped.find('\n')
+    if end_of_text == -1:
+        description = stripped
+    else:
+        description = stripped[:end_of_text]
+
+    # Some descriptions are simply the text of "More information"
+    # Let's not parse this out. Return empty description instead
+    if description.startswith('More information'):
+        description = ''
+
+    return description
+
+def make_soup(url, date_param=None, session=None, parser=DEFAULT_PARSER, parse_only=None):
     '''
     Returns soup created from sending a GET to <url> with <params>
+    Uses <session> (a requests.Session) for the GET if given
+    <parser> and <parse_only> are as for make_soup_from_html
     '''
     if date_param is not None:
         # Note that a datetime.date object's default str() method
@@ -240,10 +480,21 @@ def make_soup(url, date_param=None):
         # 2014-05-07, for example
         date_param = {'date' : date_param}
 
-    response = req.get(url, params=date_param)
-    soup = bs.BeautifulSoup(response.text, 'html5lib')
+    getter = req if session is None else session
+    response = getter.get(url, params=date_param)
 
-    return soup
+    return make_soup_from_html(response.text, parser, parse_only)
+
+def make_soup_from_html(html, parser=DEFAULT_PARSER, parse_only=None):
+    '''
+    Returns soup parsed from an already fetched page with the <parser> tree builder.
+    If <parse_only> (a SoupStrainer) is given, only the tags it matches are built.
+    html5lib can't do that, so it always builds the whole tree
+    '''
+    if parser == 'html5lib':
+        parse_only = None
+
+    return bs.BeautifulSoup(html, parser, parse_only=parse_only)
 
 def make_datetime_obj(date, time):
     '''
@@ -302,13 +553,13 @@ def make_carl_absolute_url(url):
 
 
 if __name__ == '__main__':
+    from carltour.add_buildings_to_db import read_buildings_file
+
     start_date = datetime.date(2014, 5, 21)
     end_date = datetime.date(2014, 5, 21)
 
     # These are usually provided by DB, but read from file for testing the scraper
-    with open('buildings.txt') as f:
-        buildings = [l.strip() for l in f]
-    building_dicts = [{'name' : b, 'aliases' : []} for b in buildings]
+    building_dicts = read_buildings_file('buildings.txt')
 
     scraper = EventScraper(building_dicts)
 
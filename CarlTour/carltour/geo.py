@@ -0,0 +1,42 @@
+import math
+from collections import OrderedDict
+
+EARTH_RADIUS_METERS = 6371000
+
+# Most buildings a "near" query looks for events in
+NEAR_BUILDINGS_LIMIT = 20
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    '''
+    Great-circle (haversine) distance between two points, in meters
+    '''
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+def nearest_buildings(db, lat, lng, radius, limit=NEAR_BUILDINGS_LIMIT, collection_name='buildings'):
+    '''
+    Returns an OrderedDict of building name -> distance in meters for the (at most
+    <limit>) buildings within <radius> meters of (<lat>, <lng>), nearest first.
+    Buildings without a location are never near anything. Served by the
+    2dsphere index that carltour.indexes sets up
+    '''
+    cursor = db[collection_name].find(spec={
+        'location' : {
+            '$nearSphere' : {
+                '$geometry' : {'type' : 'Point', 'coordinates' : [lng, lat]},
+                '$maxDistance' : radius
+            }
+        }
+    }, fields={'name' : True, 'location' : True, '_id' : False}).limit(limit)
+
+    distances = OrderedDict()
+    for b in cursor:
+        b_lng, b_lat = b['location']['coordinates']
+        distances[b['name']] = distance_meters(lat, lng, b_lat, b_lng)
+
+    return distances
@@ -0,0 +1,68 @@
+from pymongo import ASCENDING, GEOSPHERE
+from pyramid.paster import bootstrap
+
+from carltour.change_log import CHANGE_SEQ_FIELD
+from carltour.location_cache import LOCATIONS_COLLECTION
+from carltour.page_store import PAGES_COLLECTION
+from carltour.scrape_daemon import SCRAPE_DATES_COLLECTION
+
+# collection name -> list of (index key, options) that should exist on it
+INDEXES = {
+    'events' : [
+        # UpcomingEventsAPI asks for events with start_datetime <= end of window
+        # and end_datetime >= start of window
+        ([('start_datetime', ASCENDING), ('end_datetime', ASCENDING)], {}),
+        # Paged requests are sorted on (start_datetime, _id)
+        ([('start_datetime', ASCENDING), ('_id', ASCENDING)], {}),
+        # EventViewer's building filter, sorted the same way as paged requests
+        ([('building', ASCENDING), ('start_datetime', ASCENDING), ('_id', ASCENDING)], {}),
+        # Doubtful matches (EventViewer's low_score filter, BuildingMatchEvaluator)
+        ([('match_score', ASCENDING), ('start_datetime', ASCENDING), ('_id', ASCENDING)], {}),
+        # What EventsSyncAPI pages through changes with, and EventIntervalIndex fetches them with
+        ([(CHANGE_SEQ_FIELD, ASCENDING), ('_id', ASCENDING)], {}),
+        # What BulkEventWriter upserts on
+        ([('event_key', ASCENDING)], {'unique' : True, 'sparse' : True}),
+    ],
+    'buildings' : [
+        ([('name', ASCENDING)], {'unique' : True}),
+        ([('aliases', ASCENDING)], {}),
+        # "near" queries on UpcomingEventsAPI (see carltour.geo)
+        ([('location', GEOSPHERE)], {}),
+    ],
+    LOCATIONS_COLLECTION : [
+        ([('full_location', ASCENDING)], {'unique' : True}),
+    ],
+    PAGES_COLLECTION : [
+        ([('url', ASCENDING), ('date', ASCENDING)], {'unique' : True}),
+    ],
+    SCRAPE_DATES_COLLECTION : [
+        ([('date', ASCENDING)], {'unique' : True}),
+    ],
+}
+
+def ensure_indexes(db, indexes=INDEXES):
+    '''
+    Make sure every index in <indexes> exists on <db>. Cheap if they already do,
+    so this is run every time the app starts.
+    Returns the names of the indexes
+    '''
+    index_names = []
+
+    for collection_name, collection_indexes in indexes.items():
+        for key, options in collection_indexes:
+            index_names.append(db[collection_name].create_index(key, **options))
+
+    return index_names
+
+
+if __name__ == '__main__':
+    # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/commandline.html#writing-a-script
+    # for explanation -- we want to access the same Mongo config data that our app uses.
+    # "bootstrapping" gives us access to a "typical" pyramid environment without
+    # an actual request having been made.
+    # This way, we're hitting the same DB as the requests Pyramid receives will hit
+    env = bootstrap('../development.ini')
+    db = env['request'].db
+
+    for name in ensure_indexes(db):
+        print('Ensured index', name)
@@ -0,0 +1,142 @@
+import threading
+from collections import Counter, OrderedDict
+
+import fuzzywuzzy.fuzz
+
+from carltour.building_matcher import partial_ratio_upper_bound
+
+# Lives next to the 'buildings' collection. One document per location string:
+# {'full_location' : ..., 'building' : ..., 'matched_str' : ..., 'score' : ..., 'margin' : ...}
+LOCATIONS_COLLECTION = 'building_locations'
+
+# Max number of location strings kept in memory by one LocationCache
+DEFAULT_LRU_SIZE = 1024
+
+class LocationCache:
+    '''
+    Remembers which building a location string (like "Weitz Center 236") resolved to,
+    so scrapes don't have to fuzzy match locations they've already seen.
+
+    Matches are stored in Mongo (so they survive between runs), with a bounded
+    LRU in front of it for the locations seen during this run.
+    Safe to share between the scraper's worker threads.
+    '''
+
+    def __init__(self, db, collection_name=LOCATIONS_COLLECTION, max_size=DEFAULT_LRU_SIZE):
+        self.db = db
+        self.collection = db[collection_name]
+        self.max_size = max_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, location_str):
+        '''
+        Returns the (official_name, matched_str, score, margin) remembered for
+        <location_str>, or None if it hasn't been matched yet
+        '''
+        with self.lock:
+            if location_str in self.lru:
+                self.lru.move_to_end(location_str)
+                return self.lru[location_str]
+
+        doc = self.collection.find_one({'full_location' : location_str})
+        # Matches remembered before margins were kept have to be redone
+        if doc is None or 'margin' not in doc:
+            return None
+
+        match = (doc['building'], doc['matched_str'], doc['score'], doc['margin'])
+        self._remember(location_str, match)
+
+        return match
+
+    def set(self, location_str, match):
+        '''
+        Remember that <location_str> resolved to <match>, an
+        (official_name, matched_str, score, margin) tuple
+        '''
+        self.collection.update({'full_location' : location_str}, {'$set' : location_doc(match)}, upsert=True)
+        self._remember(location_str, match)
+
+    def invalidate_alias(self, alias, full_location=None):
+        '''
+        Forget every location that <alias> (just added to a building) might now
+        match instead. See invalidate_locations_for_alias
+        '''
+        invalidate_locations_for_alias(self.db, alias, full_location, self.collection.name)
+
+        # Cheaper to drop this run's LRU than to rescore it, and the entries
+        # that are still good are a find_one away in Mongo
+        with self.lock:
+            self.lru.clear()
+
+    def _remember(self, location_str, match):
+        with self.lock:
+            self.lru[location_str] = match
+            self.lru.move_to_end(location_str)
+
+            if len(self.lru) > self.max_size:
+                self.lru.popitem(last=False)
+
+
+def location_doc(match):
+    '''
+    The fields stored for a location that resolved to <match>, an
+    (official_name, matched_str, score, margin) tuple
+    '''
+    official_name, matched_str, score, margin = match
+    return {'building' : official_name, 'matched_str' : matched_str, 'score' : score, 'margin' : margin}
+
+def alias_could_change(location_str, alias, score):
+    '''
+    True if a newly added <alias> scores at least as well against <location_str>
+    as <score>, the score of its current match -- so it may now match differently
+    '''
+    # Most locations share too few characters with the alias to possibly
+    # score as well as they already do, so skip scoring those
+    shared = sum((Counter(location_str) & Counter(alias)).values())
+    if shared == 0 or partial_ratio_upper_bound(shared, min(len(alias), len(location_str))) < score:
+        return False
+
+    return fuzzywuzzy.fuzz.partial_ratio(location_str, alias) >= score
+
+def invalidate_locations(db, locations, collection_name=LOCATIONS_COLLECTION):
+    '''
+    Forget the remembered matches of <locations>, e.g. ones corrected by hand
+    '''
+    if len(locations) > 0:
+        db[collection_name].remove({'full_location' : {'$in' : list(locations)}})
+
+def invalidate_locations_for_alias(db, alias, full_location=None, collection_name=LOCATIONS_COLLECTION):
+    '''
+    Called whenever <alias> is added to a building. Removes the remembered match for
+    every location that <alias> scores at least as well against as its current match,
+    since those could now resolve to a different building. <full_location>, if given,
+    is a location someone corrected by hand and is always removed.
+
+    Returns the list of removed location strings
+    '''
+    full_locations = [] if full_location is None else [full_location]
+    return invalidate_locations_for_aliases(db, [alias], full_locations, collection_name)
+
+def invalidate_locations_for_aliases(db, aliases, full_locations=(), collection_name=LOCATIONS_COLLECTION):
+    '''
+    Same as invalidate_locations_for_alias, for several <aliases> and hand
+    corrected <full_locations> at once.
+
+    Every remembered location is checked: partial_ratio matches an alias anywhere
+    in a location, even in the middle of a word, so nothing short of the score
+    (or its character count bound, which rules most out cheaply) tells which
+    ones an alias could change
+    '''
+    collection = db[collection_name]
+    stale_locations = list(full_locations)
+    aliases = [a for a in aliases if a]
+
+    if len(aliases) > 0:
+        for doc in collection.find(fields={'full_location' : True, 'score' : True, '_id' : False}):
+            if any(alias_could_change(doc['full_location'], alias, doc['score']) for alias in aliases):
+                stale_locations.append(doc['full_location'])
+
+    invalidate_locations(db, stale_locations, collection_name)
+
+    return stale_locations
@@ -0,0 +1,153 @@
+# Headless evaluation of the building matcher.
+#
+# Runs BuildingMatcher over a labeled file of location strings and the building
+# each one is really in (fixtures/labeled_locations.tsv by default), and reports
+# accuracy, which buildings get confused for which, and how fast matching is.
+# With --json the report can be saved and compared across matcher changes.
+#
+# Run from this directory:
+#     python match_evaluator.py --json > before.json
+#     python match_evaluator.py --db --repeat 50
+import argparse
+import json
+import os
+import time
+
+from collections import OrderedDict
+
+from pyramid.paster import bootstrap
+
+from carltour.building_matcher import BuildingMatcher, LOW_SCORE_THRESHOLD
+from carltour.scraper_benchmark import FIXTURES_DIR, load_building_dicts, summarize, time_calls
+
+LABELED_LOCATIONS_FILE = os.path.join(FIXTURES_DIR, 'labeled_locations.tsv')
+
+def load_labeled_locations(labeled_file=LABELED_LOCATIONS_FILE):
+    '''
+    Returns a list of (full_location, expected_building) pairs from <labeled_file>:
+    one tab separated pair per line, with blank lines and # comments skipped
+    '''
+    labeled = []
+
+    with open(labeled_file) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if line.strip() == '' or line.startswith('#'):
+                continue
+
+            parts = line.split('\t')
+            if len(parts) != 2:
+                raise ValueError('%s:%i: expected full_location<TAB>expected_building' % (labeled_file, line_number))
+            labeled.append((parts[0], parts[1]))
+
+    return labeled
+
+def evaluate_matcher(building_dicts, labeled, repeat=1):
+    '''
+    Matches every location in <labeled> ((full_location, expected_building) pairs)
+    against <building_dicts>. Matching is timed <repeat> times over.
+    Returns a dictionary of results
+    '''
+    start = time.perf_counter()
+    matcher = BuildingMatcher(building_dicts)
+    build_seconds = time.perf_counter() - start
+
+    misses = []
+    # (expected, matched) -> locations matched to the wrong building
+    confusions = OrderedDict()
+    low_score = 0
+
+    for location_str, expected in labeled:
+        match = matcher.match(location_str)
+        official_name, matched_str, score = match
+
+        if score < LOW_SCORE_THRESHOLD:
+            low_score += 1
+
+        if official_name != expected:
+            misses.append({
+                'full_location' : location_str,
+                'expected' : expected,
+                'matched' : official_name,
+                'matched_str' : matched_str,
+                'score' : score,
+                'margin' : matcher.margin(location_str, match)
+            })
+            confusions.setdefault((expected, official_name), []).append(location_str)
+
+    latencies = time_calls(matcher.match, [(l,) for l, expected in labeled], repeat)
+    match_seconds = sum(latencies)
+
+    # The batch path re-resolution jobs use
+    locations = [l for l, expected in labeled] * repeat
+    start = time.perf_counter()
+    matcher.match_many(locations)
+    match_many_seconds = time.perf_counter() - start
+
+    total = len(labeled)
+    correct = total - len(misses)
+
+    return {
+        'buildings' : len(building_dicts),
+        'names' : len(matcher.names),
+        'locations' : total,
+        'repeat' : repeat,
+        'correct' : correct,
+        'accuracy' : correct / float(total) if total > 0 else 0,
+        'low_score_threshold' : LOW_SCORE_THRESHOLD,
+        'low_score' : low_score,
+        'confusions' : sorted([
+            {'expected' : expected, 'matched' : matched, 'count' : len(locs), 'locations' : locs}
+            for (expected, matched), locs in confusions.items()
+        ], key=lambda c: -c['count']),
+        'misses' : misses,
+        'build_ms' : build_seconds * 1000,
+        'match' : summarize(latencies) if latencies else {'count' : 0},
+        'matches_per_second' : len(latencies) / match_seconds if match_seconds > 0 else 0,
+        'match_many_per_second' : len(locations) / match_many_seconds if match_many_seconds > 0 else 0,
+    }
+
+def print_report(results):
+    print('%(buildings)i buildings (%(names)i names and aliases), %(locations)i labeled locations' % results)
+    print('accuracy: %(correct)i/%(locations)i = %(accuracy).3f' % results)
+    print('%(low_score)i matches scored below %(low_score_threshold)i' % results)
+    print()
+
+    if results['match']['count'] > 0:
+        print('match: p50 %(p50_ms).3fms  p95 %(p95_ms).3fms  p99 %(p99_ms).3fms  max %(max_ms).3fms' % results['match'])
+    print('%(matches_per_second).1f matches/s, %(match_many_per_second).1f with match_many' % results)
+    print()
+
+    if results['confusions']:
+        print('%-40s %-40s %5s' % ('expected', 'matched', 'count'))
+        for c in results['confusions']:
+            print('%-40s %-40s %5i' % (c['expected'], c['matched'] or '(nothing)', c['count']))
+        print()
+
+    for miss in results['misses']:
+        print("'%(full_location)s': expected '%(expected)s', matched '%(matched_str)s' "
+              "(score %(score)i, margin %(margin)i)" % miss)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Measure building matcher accuracy and speed on labeled locations')
+    arg_parser.add_argument('--labeled', default=LABELED_LOCATIONS_FILE, help='tab separated full_location, expected_building file')
+    arg_parser.add_argument('--db', action='store_true', help="match against the buildings (and aliases) in the app's DB "
+                            'instead of buildings.txt')
+    arg_parser.add_argument('--repeat', type=int, default=20, help='times matching is timed over the labeled locations')
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = arg_parser.parse_args()
+
+    if args.db:
+        # See building_db_updater.py: bootstrapping gives us the same DB the app uses
+        env = bootstrap('../development.ini')
+        building_dicts = list(env['request'].db['buildings'].find(fields={'_id' : False}))
+    else:
+        building_dicts = load_building_dicts()
+
+    results = evaluate_matcher(building_dicts, load_labeled_locations(args.labeled), args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_report(results)
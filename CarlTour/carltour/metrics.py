@@ -0,0 +1,316 @@
+import bisect
+import datetime
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (in milliseconds) of the request latency histogram buckets.
+# Slower requests go in one last overflow bucket
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Stats of the request being handled on this thread, see metrics_tween_factory
+_current = threading.local()
+
+class LatencyHistogram:
+    '''
+    Counts of latencies falling in each of LATENCY_BUCKETS_MS. Not thread safe
+    on its own; Metrics holds a lock around it
+    '''
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self.counts = [0] * (len(buckets_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.buckets_ms, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket the <q> quantile falls in (max_ms for the overflow bucket)
+        '''
+        if self.count == 0:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets_ms, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return self.max_ms
+
+    def snapshot(self):
+        return {
+            'count' : self.count,
+            'mean_ms' : self.total_ms / self.count if self.count > 0 else 0,
+            'max_ms' : self.max_ms,
+            'p50_ms' : self.quantile(.5),
+            'p95_ms' : self.quantile(.95),
+            'p99_ms' : self.quantile(.99),
+            # [upper bound in ms, count]; None is the overflow bucket
+            'buckets' : [[bound, count] for bound, count in zip(self.buckets_ms + [None], self.counts)],
+        }
+
+class MongoStats:
+    '''
+    Commands sent, documents returned and milliseconds spent in Mongo, per collection
+    '''
+
+    def __init__(self):
+        self.collections = {}
+
+    def add(self, collection, documents, ms):
+        stats = self.collections.setdefault(collection, {'commands' : 0, 'documents' : 0, 'ms' : 0.0})
+        stats['commands'] += 1
+        stats['documents'] += documents
+        stats['ms'] += ms
+
+    def merge(self, other):
+        for collection, stats in other.collections.items():
+            mine = self.collections.setdefault(collection, {'commands' : 0, 'documents' : 0, 'ms' : 0.0})
+            for key in mine:
+                mine[key] += stats[key]
+
+    def totals(self):
+        totals = {'commands' : 0, 'documents' : 0, 'ms' : 0.0}
+        for stats in self.collections.values():
+            for key in totals:
+                totals[key] += stats[key]
+        return totals
+
+    def snapshot(self):
+        return dict((collection, dict(stats)) for collection, stats in self.collections.items())
+
+class Metrics:
+    '''
+    Request latency histograms and Mongo stats per route, and Mongo stats per
+    collection (including work done outside requests, like re-resolution jobs).
+    Kept on the registry as registry.metrics; safe to share between threads
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.utcnow()
+        self.routes = {}
+        self.collections = MongoStats()
+
+    def record_request(self, route_name, status, seconds, mongo_stats):
+        with self.lock:
+            route = self.routes.get(route_name)
+            if route is None:
+                route = self.routes[route_name] = {'latency' : LatencyHistogram(), 'errors' : 0, 'mongo' : MongoStats()}
+
+            route['latency'].observe(seconds * 1000)
+            if status >= 500:
+                route['errors'] += 1
+            route['mongo'].merge(mongo_stats)
+
+    def record_command(self, collection, documents, ms):
+        with self.lock:
+            self.collections.add(collection, documents, ms)
+
+    def snapshot(self):
+        with self.lock:
+            routes = {}
+            for name, route in self.routes.items():
+                routes[name] = dict(route['latency'].snapshot(), errors=route['errors'],
+                    mongo=route['mongo'].totals(), mongo_collections=route['mongo'].snapshot())
+
+            return {
+                'started' : self.started,
+                'routes' : routes,
+                'collections' : self.collections.snapshot(),
+            }
+
+def _record(metrics, collection, documents, seconds):
+    '''
+    Pass a Mongo call on <collection> to <metrics>, and to the stats of the
+    request being handled on this thread (if any)
+    '''
+    ms = seconds * 1000
+    metrics.record_command(collection, documents, ms)
+
+    request_stats = getattr(_current, 'mongo_stats', None)
+    if request_stats is not None:
+        request_stats.add(collection, documents, ms)
+
+# collection method -> how many documents its result returned (or wrote). Ones
+# not listed count as none
+RESULT_DOCUMENTS = {
+    'find_one' : lambda result: 0 if result is None else 1,
+    'find_and_modify' : lambda result: 0 if result is None else 1,
+    'insert' : lambda result: len(result) if isinstance(result, list) else 1,
+    'update' : lambda result: result.get('n', 0) if isinstance(result, dict) else 0,
+    'remove' : lambda result: result.get('n', 0) if isinstance(result, dict) else 0,
+    'distinct' : len,
+    # pymongo 2.x returns the whole reply
+    'aggregate' : lambda result: len(result.get('result', [])) if isinstance(result, dict) else 0,
+}
+
+# Methods of a cursor that return the cursor (so it is wrapped again)
+CURSOR_CHAINING = set(['sort', 'limit', 'skip', 'hint', 'batch_size', 'max_time_ms', 'where'])
+
+class TimedDatabase:
+    '''
+    Stands in for the pymongo Database <wrapped>, timing every call made on its
+    collections (and the cursors and bulk operations they return) into <metrics>.
+    This is what request.db is, see carltour.main. Command monitoring would do
+    it for us, but pymongo 2.x doesn't have it
+    '''
+
+    def __init__(self, wrapped, metrics):
+        self.wrapped = wrapped
+        self.metrics = metrics
+
+    def __getitem__(self, name):
+        return TimedCollection(self.wrapped[name], self.metrics)
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+class TimedCollection:
+    def __init__(self, wrapped, metrics):
+        self.wrapped = wrapped
+        self.metrics = metrics
+
+    @property
+    def database(self):
+        return TimedDatabase(self.wrapped.database, self.metrics)
+
+    def find(self, *args, **kwargs):
+        # Nothing is sent until the cursor is iterated
+        return TimedCursor(self.wrapped.find(*args, **kwargs), self.wrapped.name, self.metrics)
+
+    def initialize_ordered_bulk_op(self):
+        return TimedBulk(self.wrapped.initialize_ordered_bulk_op(), self.wrapped.name, self.metrics)
+
+    def initialize_unordered_bulk_op(self):
+        return TimedBulk(self.wrapped.initialize_unordered_bulk_op(), self.wrapped.name, self.metrics)
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped, name)
+        if not callable(attr):
+            return attr
+
+        count_documents = RESULT_DOCUMENTS.get(name, lambda result: 0)
+
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            _record(self.metrics, self.wrapped.name, count_documents(result), time.perf_counter() - start)
+            return result
+
+        return timed_call
+
+class TimedCursor:
+    '''
+    Times iterating the cursor <wrapped> over <collection_name>: one call, with
+    every document it returned, once iteration stops
+    '''
+
+    def __init__(self, wrapped, collection_name, metrics):
+        self.wrapped = wrapped
+        self.collection_name = collection_name
+        self.metrics = metrics
+
+    def __iter__(self):
+        documents = 0
+        seconds = 0.0
+        iterator = iter(self.wrapped)
+
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    document = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - start
+
+                documents += 1
+                yield document
+        finally:
+            _record(self.metrics, self.collection_name, documents, seconds)
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped, name)
+        if not callable(attr):
+            return attr
+
+        def timed_call(*args, **kwargs):
+            if name in CURSOR_CHAINING:
+                return TimedCursor(attr(*args, **kwargs), self.collection_name, self.metrics)
+
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            documents = len(result) if name == 'distinct' else 0
+            _record(self.metrics, self.collection_name, documents, time.perf_counter() - start)
+            return result
+
+        return timed_call
+
+class TimedBulk:
+    '''
+    A bulk operation whose execute() is timed, counting the documents it wrote
+    '''
+
+    def __init__(self, wrapped, collection_name, metrics):
+        self.wrapped = wrapped
+        self.collection_name = collection_name
+        self.metrics = metrics
+
+    def find(self, *args, **kwargs):
+        return self.wrapped.find(*args, **kwargs)
+
+    def insert(self, *args, **kwargs):
+        return self.wrapped.insert(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = self.wrapped.execute(*args, **kwargs)
+        documents = sum(result.get(key, 0) for key in ['nInserted', 'nUpserted', 'nMatched', 'nRemoved'])
+        _record(self.metrics, self.collection_name, documents, time.perf_counter() - start)
+        return result
+
+def metrics_tween_factory(handler, registry):
+    '''
+    Times every request, and records it (with the Mongo calls it made through
+    request.db, see TimedDatabase) in
+    registry.metrics under its route name. Requests slower than the
+    carltour.slow_request_ms setting (if set) are logged
+    '''
+    slow_request_ms = float((registry.settings or {}).get('carltour.slow_request_ms') or 0)
+
+    def metrics_tween(request):
+        _current.mongo_stats = MongoStats()
+        status = 500
+        start = time.perf_counter()
+
+        try:
+            response = handler(request)
+            status = response.status_int
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            mongo_stats = _current.mongo_stats
+            _current.mongo_stats = None
+
+            matched_route = getattr(request, 'matched_route', None)
+            route_name = matched_route.name if matched_route is not None else '(no route)'
+            registry.metrics.record_request(route_name, status, elapsed, mongo_stats)
+
+            if slow_request_ms and elapsed * 1000 >= slow_request_ms:
+                log.warning('Slow request: %s %s took %.1fms (Mongo: %s)', request.method, request.path_qs,
+                    elapsed * 1000, mongo_stats.snapshot())
+
+    return metrics_tween
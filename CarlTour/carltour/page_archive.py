@@ -0,0 +1,167 @@
+# On-disk archive of every calendar page the scraper fetched, so past scrapes
+# can be parsed again (after a parser or matcher fix) without the network.
+#
+# Layout under the archive directory:
+#     objects/ab/cdef0123....gz   gzipped page, named by the sha1 of its text, so
+#                                 a page fetched many times is stored once
+#     index/2014-05.jsonl         one line per fetch of a page for a date in that
+#                                 month: {"kind", "url", "date", "hash", "fetched_at"}
+#
+# Replay re-parses a range of dates from the archive into the DB, e.g.:
+#     python page_archive.py ../archive 2014-01-01 2014-12-31
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from pyramid.paster import bootstrap
+
+log = logging.getLogger(__name__)
+
+LISTING = 'listing'
+EVENT = 'event'
+
+class PageArchive:
+    '''
+    Content-addressed, gzip compressed archive of fetched pages in the directory
+    <root>, indexed by URL and date. Safe to add to from the scraper's worker threads
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        self.index_dir = os.path.join(root, 'index')
+        self.lock = threading.Lock()
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def add(self, kind, url, date, html):
+        '''
+        Archive the <html> of <url>, fetched for <date>. <kind> is LISTING or EVENT
+        '''
+        content_hash = hashlib.sha1(html.encode('utf-8')).hexdigest()
+        path = self._object_path(content_hash)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written under a temporary name first, so a crash never leaves half a page
+            tmp_path = '%s.%i.%i.tmp' % (path, os.getpid(), threading.get_ident())
+            with gzip.open(tmp_path, 'wb') as f:
+                f.write(html.encode('utf-8'))
+            os.replace(tmp_path, path)
+
+        entry = json.dumps({
+            'kind' : kind,
+            'url' : url,
+            'date' : date.isoformat(),
+            'hash' : content_hash,
+            'fetched_at' : datetime.datetime.utcnow().isoformat()
+        })
+
+        with self.lock:
+            with open(self._index_path(date), 'a') as f:
+                f.write(entry + '\n')
+
+        return content_hash
+
+    def load(self, content_hash):
+        '''
+        The text of the archived page with <content_hash>
+        '''
+        with gzip.open(self._object_path(content_hash), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def latest_hashes(self, start_date, end_date):
+        '''
+        Generator of (date, {(kind, url) : hash of its latest fetch}) for every
+        date between <start_date> and <end_date> that has archived pages, in order.
+        Only one month of the index is read into memory at a time
+        '''
+        month = datetime.date(start_date.year, start_date.month, 1)
+
+        while month <= end_date:
+            by_date = {}
+            index_path = self._index_path(month)
+
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        d = datetime.datetime.strptime(entry['date'], '%Y-%m-%d').date()
+                        if start_date <= d <= end_date:
+                            # Later lines are later fetches
+                            by_date.setdefault(d, {})[(entry['kind'], entry['url'])] = entry['hash']
+
+            for d in sorted(by_date):
+                yield d, by_date[d]
+
+            month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+    def event_pages(self, start_date, end_date, parse_listing_html):
+        '''
+        Generator of (html, url, date) for the event pages on the latest archived
+        listing of each date between <start_date> and <end_date>, in the same order
+        a scrape visits them. <parse_listing_html> turns a listing's html into its
+        event URLs (e.g. EventScraper.parse_listing_html)
+        '''
+        for d, hashes in self.latest_hashes(start_date, end_date):
+            listing_hashes = [h for (kind, url), h in hashes.items() if kind == LISTING]
+            if len(listing_hashes) == 0:
+                log.warning('No listing archived for %s', d)
+                continue
+
+            for url in parse_listing_html(self.load(listing_hashes[0])):
+                event_hash = hashes.get((EVENT, url))
+                if event_hash is None:
+                    log.warning('Event page %s for %s was never archived', url, d)
+                    continue
+
+                yield self.load(event_hash), url, d
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.objects_dir, content_hash[:2], content_hash[2:] + '.gz')
+
+    def _index_path(self, date):
+        return os.path.join(self.index_dir, '%04i-%02i.jsonl' % (date.year, date.month))
+
+
+if __name__ == '__main__':
+    # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/commandline.html#writing-a-script
+    # for explanation -- we want to access the same Mongo config data that our app uses.
+    from carltour.event_db_updater import BulkEventWriter
+    from carltour.event_scraper import EventScraper
+    from carltour.response_cache import bump_version
+
+    arg_parser = argparse.ArgumentParser(description='Re-parse archived pages into the events collection')
+    arg_parser.add_argument('archive', help='archive directory')
+    arg_parser.add_argument('start_date', help='YYYY-MM-DD')
+    arg_parser.add_argument('end_date', help='YYYY-MM-DD')
+    arg_parser.add_argument('--dry-run', action='store_true', help='only count the events, write nothing')
+    args = arg_parser.parse_args()
+
+    start_date = datetime.datetime.strptime(args.start_date, '%Y-%m-%d').date()
+    end_date = datetime.datetime.strptime(args.end_date, '%Y-%m-%d').date()
+
+    env = bootstrap('../development.ini')
+    db = env['request'].db
+
+    scraper = EventScraper(list(db['buildings'].find()))
+    writer = BulkEventWriter(db['events'])
+    replayed = 0
+
+    for event in scraper.replay_events(PageArchive(args.archive), start_date, end_date):
+        replayed += 1
+        if not args.dry_run:
+            writer.add(event)
+    writer.flush()
+
+    if writer.counts['inserted'] > 0 or writer.counts['updated'] > 0:
+        bump_version(db)
+
+    print('Replayed %i events: inserted %i, updated %i, unchanged %i' % (replayed, writer.counts['inserted'],
+        writer.counts['updated'], writer.counts['unchanged']))
@@ -0,0 +1,76 @@
+import datetime
+import hashlib
+
+# One document per (url, date) scraped:
+# {'url' : ..., 'date' : '2014-05-21', 'etag' : ..., 'last_modified' : ...,
+#  'content_hash' : ..., 'scraped_at' : datetime, ...}
+# Day listings also keep the 'event_urls' found on them
+PAGES_COLLECTION = 'scraped_pages'
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class PageStore:
+    '''
+    Remembers the HTTP validators (ETag/Last-Modified) and a hash of the content of
+    every page scraped, so the next scrape can ask for (and skip) only pages that
+    changed. Used by EventScraper for incremental scrapes
+    '''
+
+    def __init__(self, db, collection_name=PAGES_COLLECTION):
+        self.collection = db[collection_name]
+
+    def get(self, url, date):
+        '''
+        Returns what was stored about <url> scraped for <date>, or None
+        '''
+        return self.collection.find_one({'url' : url, 'date' : date.isoformat()})
+
+    def fetch_if_changed(self, session, url, date, params=None):
+        '''
+        GET <url> (for <date>) with <session>, conditionally if it was scraped before.
+        Returns (response, page_state): <response> is None if the page hasn't changed,
+        and <page_state> is what to pass to save() once the page has been handled
+        '''
+        state = self.get(url, date)
+        headers = {}
+
+        if state is not None:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+
+        response = session.get(url, params=params, headers=headers)
+        if response.status_code == 304:
+            return None, state
+
+        # Plenty of servers don't send validators, so compare the content too
+        new_hash = content_hash(response.text)
+        if state is not None and state['content_hash'] == new_hash:
+            return None, state
+
+        return response, {
+            'url' : url,
+            'date' : date.isoformat(),
+            'etag' : response.headers.get('ETag'),
+            'last_modified' : response.headers.get('Last-Modified'),
+            'content_hash' : new_hash
+        }
+
+    def save(self, page_state, **extra):
+        '''
+        Store <page_state> (from fetch_if_changed), along with any <extra> fields
+        '''
+        doc = dict(page_state, scraped_at=datetime.datetime.utcnow(), **extra)
+        doc.pop('_id', None)
+
+        self.collection.update({'url' : doc['url'], 'date' : doc['date']}, {'$set' : doc}, upsert=True)
+
+    def forget(self, urls):
+        '''
+        Drop what was stored about every page in <urls> (for any date), so the next
+        incremental scrape fetches and parses them again whether they changed or not
+        '''
+        if len(urls) > 0:
+            self.collection.remove({'url' : {'$in' : list(urls)}})
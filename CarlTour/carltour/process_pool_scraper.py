@@ -0,0 +1,118 @@
+import datetime
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from carltour.event_scraper import EventScraper, BASE_EVENTS_URL
+from carltour.page_archive import EVENT, LISTING
+
+# Pages handed to a worker process at a time
+DEFAULT_CHUNK_SIZE = 8
+
+# Each worker process gets its own scraper (built once, in _init_worker) to parse
+# pages and match buildings with. Its building callback just collects the
+# matches, which are sent back with the event for the real callback
+_worker_scraper = None
+_worker_matches = []
+
+def _init_worker(building_dicts, parser):
+    global _worker_scraper
+    _worker_scraper = EventScraper(building_dicts, building_callback=_collect_match, parser=parser)
+
+def _collect_match(full_input_str, best_match_str, best_match_score):
+    _worker_matches.append((full_input_str, best_match_str, best_match_score))
+
+def _parse_in_worker(html, url, date):
+    del _worker_matches[:]
+    event = _worker_scraper.parse_event_html(html, url, date)
+
+    return event, list(_worker_matches)
+
+def _listing_in_worker(html):
+    return _worker_scraper.parse_listing_html(html)
+
+class ProcessPoolEventScraper(EventScraper):
+    '''
+    An EventScraper that only fetches pages itself (on <workers> threads), and leaves
+    the CPU-bound part -- parsing, and matching buildings -- to a pool of <processes>
+    worker processes (one per core if None), so it isn't all stuck on one core.
+
+    <building_callback> is still called once per matched building, in the same
+    order as the serial scraper, from this process. Location caching and
+    incremental scraping aren't done by the worker processes
+    '''
+
+    def __init__(self, building_dicts, building_callback=None, processes=None, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        EventScraper.__init__(self, building_dicts, building_callback, **kwargs)
+
+        if self.page_store is not None or self.location_cache is not None:
+            raise ValueError('ProcessPoolEventScraper does not do location caching or incremental scrapes')
+
+        self.processes = processes or os.cpu_count()
+        self.chunk_size = chunk_size
+
+    def make_pool(self):
+        '''
+        A process pool whose workers have been given our buildings
+        '''
+        return ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+            initargs=(self.buildings, self.parser))
+
+    def parse_pages(self, pages, pool=None):
+        '''
+        Parses <pages>, an iterable of (html, url, date) for event pages, in the worker
+        processes of <pool> (a new one from make_pool if None).
+        Returns the events (None for unparsable ones) in the order of <pages>
+        '''
+        if pool is None:
+            with self.make_pool() as pool:
+                return self.parse_pages(pages, pool)
+
+        pages = list(pages)
+        if len(pages) == 0:
+            return []
+
+        htmls, urls, dates = zip(*pages)
+        results = pool.map(_parse_in_worker, htmls, urls, dates, chunksize=self.chunk_size)
+
+        return self._collect(results)
+
+    def get_events_for_dates(self, start_date, end_date):
+        '''
+        Same as EventScraper.get_events_for_dates. Each day's pages are sent to the
+        pool as soon as they're fetched, so fetching and parsing overlap
+        '''
+        all_dates = []
+        cur_date = start_date
+        while cur_date <= end_date:
+            all_dates.append(cur_date)
+            cur_date += datetime.timedelta(days=1)
+
+        with self.make_pool() as pool:
+            listing_htmls = self._map(self._get_html, [LISTING] * len(all_dates), [BASE_EVENTS_URL] * len(all_dates), all_dates)
+            urls_per_date = list(pool.map(_listing_in_worker, listing_htmls))
+            # So callers can tell which stored events are no longer listed
+            self.event_urls_by_date = dict(zip(all_dates, urls_per_date))
+
+            pending = []
+            for d, urls in zip(all_dates, urls_per_date):
+                htmls = self._map(self._get_html, [EVENT] * len(urls), urls, [d] * len(urls))
+                pending.append(pool.map(_parse_in_worker, htmls, urls, [d] * len(urls), chunksize=self.chunk_size))
+
+            # Some events will simply be None if they were unparsable
+            return [e for results in pending for e in self._collect(results) if e is not None]
+
+    def _collect(self, results):
+        '''
+        Unpacks (event, matches) results from the workers, passing the
+        matches to the building callback
+        '''
+        events = []
+
+        for event, matches in results:
+            if self.building_callback is not None:
+                for match in matches:
+                    self.building_callback(*match)
+            events.append(event)
+
+        return events
@@ -0,0 +1,265 @@
+import datetime
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from pyramid.paster import bootstrap
+
+from carltour.building_matcher import BuildingMatcher
+from carltour.change_log import CHANGE_SEQ_FIELD, DELETED_FIELD, change_sequence
+from carltour.event_index import MODIFIED_FIELD
+from carltour.location_cache import LOCATIONS_COLLECTION, alias_could_change, location_doc
+from carltour.response_cache import bump_version
+
+log = logging.getLogger(__name__)
+
+# Number of finished jobs a ReresolveJobTracker keeps around to report on
+DEFAULT_JOBS_KEPT = 20
+
+class ReresolveJob:
+    '''
+    After <aliases> were added to buildings, finds the stored events whose building
+    they could change and resolves them again against the current buildings.
+
+    Only distinct full_location strings are looked at: each is resolved once
+    (with BuildingMatcher.match_many), and the results are written with one bulk
+    operation over the events (and one over the remembered location matches).
+    Events whose building was set by hand (see UpdateBuilding) are left alone,
+    and so are ones that ended before <since>, if given (by default, every
+    stored event is looked at, past ones included).
+
+    Progress and how long each step took are kept in <self.status>
+    '''
+
+    def __init__(self, db, aliases, events_collection='events', buildings_collection='buildings',
+                 locations_collection=LOCATIONS_COLLECTION, events_version=None, since=None):
+        self.id = uuid.uuid4().hex
+        self.db = db
+        self.aliases = [a for a in aliases if a]
+        self.events_collection = db[events_collection]
+        self.buildings_collection = db[buildings_collection]
+        self.locations_collection = db[locations_collection]
+        # The app's VersionCache, if run by it, so it sees the change at once
+        self.events_version = events_version
+        # Times are local, like the events'
+        self.since = since
+
+        self.status = {
+            'id' : self.id,
+            'aliases' : self.aliases,
+            'state' : 'pending',
+            'created' : datetime.datetime.utcnow(),
+            # distinct locations looked at / affected by the aliases / resolved so far
+            'locations' : 0,
+            'affected' : 0,
+            'resolved' : 0,
+            'events_updated' : 0,
+            # seconds spent on each step
+            'timings' : {},
+        }
+
+    def run(self):
+        self.status['state'] = 'running'
+        start = time.perf_counter()
+
+        try:
+            locations = self._timed('find_locations', self.find_locations)
+            self.status['locations'] = len(locations)
+
+            affected = self._timed('filter_affected', self.filter_affected, locations)
+            self.status['affected'] = len(affected)
+
+            matches = self._timed('resolve', self.resolve, affected)
+            self.status['resolved'] = len(matches)
+
+            self.status['events_updated'] = self._timed('write', self.write, affected, matches)
+        except Exception:
+            self.status['state'] = 'failed'
+            log.exception('Re-resolution job %s failed', self.id)
+            raise
+        finally:
+            self.status['timings']['total'] = time.perf_counter() - start
+
+        self.status['state'] = 'finished'
+        log.debug('Re-resolved %i of %i locations for aliases %s in %.3fs (%i events updated)',
+            self.status['affected'], self.status['locations'], self.aliases,
+            self.status['timings']['total'], self.status['events_updated'])
+
+    def find_locations(self):
+        '''
+        Distinct full_location strings of the events that could be re-resolved.
+        Which of them the aliases affect is up to filter_affected
+        '''
+        return self.events_collection.find(self._events_spec()).distinct('full_location')
+
+    def _events_spec(self):
+        '''
+        Query for the events this job may change. With <since>, served by the
+        (start_datetime, end_datetime) index, like the events API
+        '''
+        spec = {
+            'building_set_by_hand' : {'$ne' : True},
+            DELETED_FIELD : {'$ne' : True}
+        }
+        if self.since is not None:
+            spec['end_datetime'] = {'$gte' : self.since}
+
+        return spec
+
+    def filter_affected(self, locations):
+        '''
+        The <locations> one of our aliases could match differently. Remembered matches
+        (from LocationCache) say how well a location matches now; locations without
+        one have to be resolved again to find out
+        '''
+        scores = dict((doc['full_location'], doc['score']) for doc in self.locations_collection.find(
+            spec={'full_location' : {'$in' : locations}},
+            fields={'full_location' : True, 'score' : True, '_id' : False}
+        ))
+
+        return [l for l in locations if l not in scores or
+                any(alias_could_change(l, alias, scores[l]) for alias in self.aliases)]
+
+    def resolve(self, locations):
+        '''
+        Returns an (official_name, matched_str, score, margin) match for each of <locations>
+        '''
+        matcher = BuildingMatcher(list(self.buildings_collection.find()))
+        matches = []
+
+        # In chunks, so the status shows progress while a long job runs
+        for chunk_start in range(0, len(locations), 100):
+            chunk = locations[chunk_start:chunk_start + 100]
+            for location_str, match in zip(chunk, matcher.match_many(chunk)):
+                matches.append(match + (matcher.margin(location_str, match),))
+            self.status['resolved'] = len(matches)
+
+        return matches
+
+    def write(self, locations, matches):
+        '''
+        Store the new building (and match score) of each location on its events, and
+        remember the matches. Returns the number of events whose match changed
+        '''
+        if len(locations) == 0:
+            return 0
+
+        now = datetime.datetime.utcnow()
+        locations_bulk = self.locations_collection.initialize_unordered_bulk_op()
+
+        with change_sequence(self.db) as seq:
+            events_bulk = self.events_collection.initialize_unordered_bulk_op()
+
+            for location_str, (official_name, matched_str, score, margin) in zip(locations, matches):
+                spec = dict(self._events_spec(), full_location=location_str)
+                spec['$or'] = [
+                    {'building' : {'$ne' : official_name}},
+                    {'match_score' : {'$ne' : score}},
+                    {'match_margin' : {'$ne' : margin}}
+                ]
+                events_bulk.find(spec).update({'$set' : {
+                    'building' : official_name,
+                    'match_score' : score,
+                    'matched_alias' : matched_str,
+                    'match_margin' : margin,
+                    MODIFIED_FIELD : now,
+                    CHANGE_SEQ_FIELD : seq
+                }})
+
+                # Same fields LocationCache.set stores
+                locations_bulk.find({'full_location' : location_str}).upsert().update({
+                    '$set' : location_doc((official_name, matched_str, score, margin))
+                })
+
+            result = events_bulk.execute()
+        locations_bulk.execute()
+
+        if result['nMatched'] > 0:
+            if self.events_version is not None:
+                self.events_version.bump(self.db)
+            else:
+                bump_version(self.db)
+
+        return result['nMatched']
+
+    def _timed(self, step, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.status['timings'][step] = time.perf_counter() - start
+
+class ReresolveJobTracker:
+    '''
+    Runs ReresolveJobs one after another on a background thread, and keeps
+    the status of the last <jobs_kept> of them
+    '''
+
+    def __init__(self, jobs_kept=DEFAULT_JOBS_KEPT):
+        self.jobs_kept = jobs_kept
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.queue = []
+
+    def start(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.jobs_kept:
+                self.jobs.popitem(last=False)
+
+            self.queue.append(job)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run_queue, name='reresolve', daemon=True)
+                self.thread.start()
+
+        return job.id
+
+    def wait(self):
+        '''
+        Block until every job started so far has finished
+        '''
+        while True:
+            with self.lock:
+                thread = self.thread
+            if thread is None:
+                return
+            thread.join()
+
+    def statuses(self):
+        with self.lock:
+            return [dict(job.status, timings=dict(job.status['timings'])) for job in self.jobs.values()]
+
+    def _run_queue(self):
+        while True:
+            with self.lock:
+                if len(self.queue) == 0:
+                    self.thread = None
+                    return
+                job = self.queue.pop(0)
+
+            try:
+                job.run()
+            except Exception:
+                # Already logged and recorded in the job's status
+                pass
+
+
+if __name__ == '__main__':
+    # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/commandline.html#writing-a-script
+    # for explanation -- we want to access the same Mongo config data that our app uses.
+    # "bootstrapping" gives us access to a "typical" pyramid environment without
+    # an actual request having been made.
+    # This way, we're hitting the same DB as the requests Pyramid receives will hit
+    import sys
+
+    env = bootstrap('../development.ini')
+    db = env['request'].db
+
+    # Re-resolve for the aliases given on the command line, or all of them
+    aliases = sys.argv[1:] or [a for b in db['buildings'].find() for a in b['aliases']]
+    job = ReresolveJob(db, aliases)
+    job.run()
+    print(job.status)
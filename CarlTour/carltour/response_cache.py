@@ -0,0 +1,121 @@
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# One document per kind of data, counting how many times it has changed:
+# {'_id' : 'events', 'version' : 12, 'modified' : datetime}
+VERSIONS_COLLECTION = 'versions'
+EVENTS_VERSION = 'events'
+
+# Max number of rendered responses kept in memory
+DEFAULT_CACHE_SIZE = 256
+
+# Seconds a process goes on using the version it last read, see VersionCache
+DEFAULT_VERSION_TTL = 1.0
+
+CachedResponse = namedtuple('CachedResponse', ['version', 'body', 'etag', 'last_modified'])
+
+def bump_version(db, name=EVENTS_VERSION):
+    '''
+    Record that the data <name> stands for changed, so everything cached
+    from the old version is stale
+    '''
+    db[VERSIONS_COLLECTION].update({'_id' : name}, {
+        '$inc' : {'version' : 1},
+        # HTTP dates only go down to the second
+        '$set' : {'modified' : datetime.datetime.utcnow().replace(microsecond=0)}
+    }, upsert=True)
+
+def get_version(db, name=EVENTS_VERSION):
+    '''
+    Returns (version, modified datetime) of the data <name> stands for.
+    Data that has never been bumped is version 0, with no modified time
+    '''
+    doc = db[VERSIONS_COLLECTION].find_one({'_id' : name})
+
+    if doc is None:
+        return 0, None
+    return doc['version'], doc['modified']
+
+class VersionCache:
+    '''
+    The version of the data <name> (see get_version) as last read from Mongo, read
+    again at most every <ttl> seconds, so requests answered from a ResponseCache
+    don't each cost a round-trip. Changes made by other processes (the scraper,
+    the daemon) are noticed within <ttl>; ones made through bump() at once
+    '''
+
+    def __init__(self, ttl=DEFAULT_VERSION_TTL, name=EVENTS_VERSION):
+        self.ttl = ttl
+        self.name = name
+        self.lock = threading.Lock()
+        self.read_at = None
+        self.version = None
+
+    def get(self, db):
+        '''
+        Returns (version, modified datetime), like get_version
+        '''
+        now = time.monotonic()
+
+        with self.lock:
+            if self.read_at is not None and now - self.read_at < self.ttl:
+                return self.version
+
+        version = get_version(db, self.name)
+
+        with self.lock:
+            self.version = version
+            self.read_at = now
+
+        return version
+
+    def bump(self, db):
+        '''
+        bump_version, and read the new version on the next get
+        '''
+        bump_version(db, self.name)
+
+        with self.lock:
+            self.read_at = None
+
+class ResponseCache:
+    '''
+    Bounded, thread safe LRU of rendered response bodies. Each entry remembers the
+    data version it was rendered from, and is only handed out for that version
+    '''
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        '''
+        Returns the CachedResponse for <key> if it was rendered from <version>, else None
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.version != version:
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, version, body, last_modified):
+        '''
+        Remember <body> (bytes) as the response for <key> at <version>.
+        Returns the new CachedResponse, whose ETag is a hash of <body>
+        '''
+        entry = CachedResponse(version, body, hashlib.sha1(body).hexdigest(), last_modified)
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return entry
@@ -0,0 +1,302 @@
+# Long-running ingest service: keeps the events of a rolling window of dates
+# (today through DEFAULT_DAYS_AHEAD days out) fresh in the DB.
+#
+# Each date is scraped on its own (with update_db_for_dates), whenever it has gone
+# longer than its refresh interval without a scrape: near dates more often than
+# far ones, and dates clients have just asked for (see DemandRecorder) as often as
+# today. When each date was last scraped is kept in Mongo, so a restarted
+# daemon picks up where it left off.
+#
+# Run from this directory:
+#     python scrape_daemon.py --days-ahead 14
+import argparse
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+from pyramid.paster import bootstrap
+
+from carltour.event_db_updater import SCRAPE_WORKERS, make_scraper, update_db_for_dates
+from carltour.page_archive import PageArchive
+
+log = logging.getLogger(__name__)
+
+# One document per date looked after:
+# {'date' : '2014-05-21', 'last_scraped' : datetime, 'counts' : {...},
+#  'last_requested' : datetime, 'last_failed' : datetime, 'last_error' : ...}
+SCRAPE_DATES_COLLECTION = 'scrape_dates'
+
+DEFAULT_DAYS_AHEAD = 14
+
+# (days ahead, refresh interval): dates less than that many days ahead are
+# re-scraped once they're older than the interval
+REFRESH_INTERVALS = [
+    (1, datetime.timedelta(hours=1)),
+    (3, datetime.timedelta(hours=3)),
+    (7, datetime.timedelta(hours=12)),
+]
+FAR_REFRESH_INTERVAL = datetime.timedelta(hours=24)
+
+# Dates clients asked for this recently are kept as fresh as today
+DEMAND_WINDOW = datetime.timedelta(hours=6)
+# Asked for dates past the rolling window are looked after too, up to this far out
+MAX_REQUESTED_DAYS_AHEAD = 60
+
+# Seconds the app buffers the dates clients ask for before writing them out, see DemandRecorder
+DEFAULT_DEMAND_FLUSH_INTERVAL = 60.0
+
+# How long to wait before trying a date whose scrape failed again
+RETRY_DELAY = datetime.timedelta(minutes=10)
+# Longest the daemon sleeps between looking for due dates, so new demand is noticed
+MAX_SLEEP_SECONDS = 60
+
+def refresh_interval(days_ahead, requested=False):
+    '''
+    How stale the events of a date <days_ahead> days from today may get
+    before it is scraped again. <requested> dates are treated like today
+    '''
+    if requested:
+        days_ahead = 0
+
+    for max_days_ahead, interval in REFRESH_INTERVALS:
+        if days_ahead < max_days_ahead:
+            return interval
+
+    return FAR_REFRESH_INTERVAL
+
+def requested_dates(first_datetime, final_datetime, today=None):
+    '''
+    The dates between <first_datetime> and <final_datetime> the daemon could
+    look after: none before today, nor past MAX_REQUESTED_DAYS_AHEAD days out
+    '''
+    if today is None:
+        today = datetime.date.today()
+
+    first_date = max(first_datetime.date(), today)
+    final_date = min(final_datetime.date(), today + datetime.timedelta(days=MAX_REQUESTED_DAYS_AHEAD))
+
+    dates = []
+    cur_date = first_date
+    while cur_date <= final_date:
+        dates.append(cur_date)
+        cur_date += datetime.timedelta(days=1)
+
+    return dates
+
+def record_demand(db, dates, requested_at=None, collection_name=SCRAPE_DATES_COLLECTION):
+    '''
+    Note that clients asked for the events of <dates> at <requested_at> (default:
+    now), so the daemon keeps those dates fresher
+    '''
+    if len(dates) == 0:
+        return
+    if requested_at is None:
+        requested_at = datetime.datetime.now()
+
+    bulk = db[collection_name].initialize_unordered_bulk_op()
+    for d in dates:
+        bulk.find({'date' : d.isoformat()}).upsert().update({'$set' : {'last_requested' : requested_at}})
+    bulk.execute()
+
+class DemandRecorder:
+    '''
+    Collects the dates clients ask the app for in memory, and writes them out with
+    record_demand at most every <flush_interval> seconds, so answering a request
+    doesn't cost a Mongo write. Dates are recorded as asked for when they're
+    written, which is close enough next to DEMAND_WINDOW.
+    Safe to share between the app's request threads
+    '''
+
+    def __init__(self, flush_interval=DEFAULT_DEMAND_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.dates = set()
+        self.flushed_at = time.monotonic()
+
+    def add(self, db, first_datetime, final_datetime):
+        '''
+        Note that a client asked for the events between <first_datetime> and
+        <final_datetime>. Writes out what has been collected if it's time to
+        '''
+        with self.lock:
+            self.dates.update(requested_dates(first_datetime, final_datetime))
+            if time.monotonic() - self.flushed_at < self.flush_interval:
+                return
+
+        self.flush(db)
+
+    def flush(self, db):
+        '''
+        Write out the dates collected so far
+        '''
+        with self.lock:
+            dates, self.dates = self.dates, set()
+            self.flushed_at = time.monotonic()
+
+        record_demand(db, sorted(dates))
+
+class ScrapeDaemon:
+    '''
+    Scrapes each date from today to <days_ahead> days out (plus dates clients asked
+    for) whenever it is due, according to refresh_interval. Dates are taken from a
+    queue ordered by when they fell due, and scraped incrementally if <incremental>
+    (see PageStore), with <workers> threads. Fetched pages are saved to
+    <page_archive> (a PageArchive) if given
+    '''
+
+    def __init__(self, db, days_ahead=DEFAULT_DAYS_AHEAD, workers=SCRAPE_WORKERS, incremental=True,
+                 collection_name=SCRAPE_DATES_COLLECTION, page_archive=None):
+        self.db = db
+        self.collection = db[collection_name]
+        self.days_ahead = days_ahead
+        self.workers = workers
+        self.incremental = incremental
+        self.page_archive = page_archive
+
+    def watched_dates(self, now):
+        '''
+        Returns {date : requested} for every date looked after at <now>
+        '''
+        today = now.date()
+        dates = dict((today + datetime.timedelta(days=i), False) for i in range(self.days_ahead))
+
+        requested_docs = self.collection.find(spec={
+            'last_requested' : {'$gte' : now - DEMAND_WINDOW},
+            'date' : {
+                '$gte' : today.isoformat(),
+                '$lte' : (today + datetime.timedelta(days=MAX_REQUESTED_DAYS_AHEAD)).isoformat()
+            }
+        }, fields={'date' : True, '_id' : False})
+
+        for doc in requested_docs:
+            dates[datetime.datetime.strptime(doc['date'], '%Y-%m-%d').date()] = True
+
+        return dates
+
+    def plan(self, now):
+        '''
+        The work queue: a heap of (due datetime, date) for every watched date
+        '''
+        dates = self.watched_dates(now)
+        docs = self.collection.find(spec={'date' : {'$in' : [d.isoformat() for d in dates]}})
+        freshness = dict((doc['date'], doc) for doc in docs)
+
+        queue = []
+        for d, requested in dates.items():
+            doc = freshness.get(d.isoformat(), {})
+
+            if doc.get('last_scraped') is None:
+                due = datetime.datetime.min
+            else:
+                due = doc['last_scraped'] + refresh_interval((d - now.date()).days, requested)
+
+            # Don't keep hammering a date that just failed
+            if doc.get('last_failed') is not None and (doc.get('last_scraped') is None or doc['last_failed'] > doc['last_scraped']):
+                due = max(due, doc['last_failed'] + RETRY_DELAY)
+
+            queue.append((due, d))
+
+        heapq.heapify(queue)
+        return queue
+
+    def run_once(self, now=None):
+        '''
+        Scrapes every date due at <now> (default: the current time), most overdue
+        first. Returns a list of (date, counts) for the dates scraped successfully
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+
+        queue = self.plan(now)
+        scraped = []
+        # Made once per cycle, on the first due date: the buildings, matcher,
+        # session and location cache are the same for every date
+        scraper = None
+
+        while len(queue) > 0 and queue[0][0] <= now:
+            due, d = heapq.heappop(queue)
+            if scraper is None:
+                scraper = make_scraper(self.db, workers=self.workers, incremental=self.incremental,
+                    page_archive=self.page_archive)
+            counts = self.scrape_date(d, scraper)
+            if counts is not None:
+                scraped.append((d, counts))
+
+        return scraped
+
+    def scrape_date(self, d, scraper=None):
+        '''
+        Scrape the events of the date <d> into the DB (with <scraper>, from
+        make_scraper, if given) and record when. Returns the counts from
+        update_db_for_dates, or None if the scrape failed
+        '''
+        start = datetime.datetime.now()
+
+        try:
+            counts = update_db_for_dates(d, d, self.db, workers=self.workers, incremental=self.incremental,
+                page_archive=self.page_archive, scraper=scraper)
+        except Exception as e:
+            log.exception('Scraping %s failed', d)
+            self.collection.update({'date' : d.isoformat()}, {
+                '$set' : {'last_failed' : start, 'last_error' : str(e)}
+            }, upsert=True)
+            return None
+
+        # The scrape started at <start>, so that's how fresh its events are
+        self.collection.update({'date' : d.isoformat()}, {
+            '$set' : {'last_scraped' : start, 'counts' : counts}
+        }, upsert=True)
+        log.info('Scraped %s in %.1fs: inserted %i, updated %i, unchanged %i, removed %i', d,
+            (datetime.datetime.now() - start).total_seconds(), counts['inserted'], counts['updated'], counts['unchanged'],
+            counts['removed'])
+
+        return counts
+
+    def seconds_until_next(self, now=None):
+        '''
+        Seconds until the next date falls due, at most MAX_SLEEP_SECONDS
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+
+        queue = self.plan(now)
+        if len(queue) == 0:
+            return MAX_SLEEP_SECONDS
+
+        return max(0, min(MAX_SLEEP_SECONDS, (queue[0][0] - now).total_seconds()))
+
+    def run_forever(self):
+        while True:
+            self.run_once()
+            time.sleep(self.seconds_until_next())
+
+
+if __name__ == '__main__':
+    # See http://docs.pylonsproject.org/projects/pyramid/en/latest/narr/commandline.html#writing-a-script
+    # for explanation -- we want to access the same Mongo config data that our app uses.
+    # "bootstrapping" gives us access to a "typical" pyramid environment without
+    # an actual request having been made.
+    # This way, we're hitting the same DB as the requests Pyramid receives will hit
+    arg_parser = argparse.ArgumentParser(description='Keep the events of the coming days scraped')
+    arg_parser.add_argument('--days-ahead', type=int, default=DEFAULT_DAYS_AHEAD, help='size of the rolling window')
+    arg_parser.add_argument('--workers', type=int, default=SCRAPE_WORKERS)
+    arg_parser.add_argument('--full', action='store_true', help='re-fetch pages even if they have not changed')
+    arg_parser.add_argument('--archive', help='directory to archive fetched pages in (see page_archive.py)')
+    arg_parser.add_argument('--once', action='store_true', help='scrape the due dates, then exit')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    env = bootstrap('../development.ini')
+    page_archive = PageArchive(args.archive) if args.archive else None
+    daemon = ScrapeDaemon(env['request'].db, args.days_ahead, args.workers, incremental=not args.full,
+        page_archive=page_archive)
+
+    if args.once:
+        for d, counts in daemon.run_once():
+            print('%s: inserted %i, updated %i, unchanged %i, removed %i' % (d, counts['inserted'], counts['updated'],
+                counts['unchanged'], counts['removed']))
+    else:
+        daemon.run_forever()
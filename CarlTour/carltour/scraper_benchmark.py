@@ -0,0 +1,179 @@
+# Offline benchmark of the event scraper.
+#
+# Pages come from the recorded Carleton calendar pages in fixtures/ (served by
+# FixtureSession instead of the live site), so runs are repeatable and can be
+# compared before and after parser, matcher or concurrency changes.
+#
+# Run from this directory:
+#     python scraper_benchmark.py --days 7 --workers 8 --parser lxml
+import argparse
+import datetime
+import json
+import os
+import re
+import time
+
+from carltour.add_buildings_to_db import read_buildings_file
+from carltour.event_scraper import (EventScraper, BASE_EVENTS_URL, DEFAULT_PARSER, DEFAULT_WORKERS, PARSERS,
+    EVENT_PAGE_STRAINER, make_soup, make_datetime_obj)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+BUILDINGS_FILE = os.path.join(os.path.dirname(__file__), 'buildings.txt')
+
+EVENT_ID_RE = r'event_id=([0-9]+)'
+
+class FixtureResponse:
+    def __init__(self, text):
+        self.text = text
+        self.status_code = 200
+        self.headers = {}
+
+class FixtureSession:
+    '''
+    Stands in for the requests.Session EventScraper fetches with, answering from
+    the recorded pages in <fixtures_dir>:
+        listing_<date>.html for the day listing of <date> (or the first
+            listing recorded, for dates that weren't)
+        event_<event_id>.html for event pages
+    <latency> seconds are slept per GET, to mimic the network
+    '''
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR, latency=0):
+        self.latency = latency
+        self.pages = {}
+
+        for name in sorted(os.listdir(fixtures_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(fixtures_dir, name)) as f:
+                    self.pages[name[:-len('.html')]] = f.read()
+
+        self.default_listing = min(name for name in self.pages if name.startswith('listing_'))
+
+    def get(self, url, params=None, headers=None):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if url == BASE_EVENTS_URL and params is not None:
+            page = self.pages.get('listing_%s' % params['date'], self.pages[self.default_listing])
+        else:
+            event_id = re.search(EVENT_ID_RE, url).group(1)
+            page = self.pages['event_%s' % event_id]
+
+        return FixtureResponse(page)
+
+def percentile(sorted_values, pct):
+    '''
+    Nearest-rank <pct> percentile of a non-empty sorted list
+    '''
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+def summarize(latencies):
+    '''
+    Count and p50/p95/p99/max (in milliseconds) of a list of <latencies> in seconds
+    '''
+    values = sorted(latencies)
+    summary = {'count' : len(values)}
+
+    for name, pct in [('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)]:
+        summary[name + '_ms'] = percentile(values, pct) * 1000
+
+    return summary
+
+def time_calls(func, args_list, repeat):
+    '''
+    Calls <func> with each of <args_list>, <repeat> times over.
+    Returns the latency of every call
+    '''
+    latencies = []
+
+    for i in range(repeat):
+        for args in args_list:
+            start = time.perf_counter()
+            func(*args)
+            latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+def load_building_dicts(buildings_file=BUILDINGS_FILE):
+    return read_buildings_file(buildings_file)
+
+def run_benchmark(days=7, repeat=20, parser=DEFAULT_PARSER, workers=DEFAULT_WORKERS, latency=0):
+    '''
+    Times each stage of the scraper separately over the fixture pages, then a whole
+    scrape of <days> days. Returns a dictionary of results
+    '''
+    session = FixtureSession(latency=0)
+    scraper = EventScraper(load_building_dicts(), session=session, parser=parser)
+    date = datetime.date(2014, 5, 21)
+
+    event_urls = scraper.get_all_event_urls(BASE_EVENTS_URL, date)
+    soups = [make_soup(url, session=session, parser=parser, parse_only=EVENT_PAGE_STRAINER) for url in event_urls]
+
+    locations = []
+    times = []
+    for soup in soups:
+        location, start_datetime, end_datetime = scraper._parse_loc_start_end(soup, date)
+        if location:
+            locations.append(location)
+        for row in soup.find_all('tr'):
+            tds = [td.text.strip() for td in row.find_all('td')]
+            if len(tds) == 2 and tds[0] == 'Time:':
+                times.append(tds[1])
+
+    stages = {
+        'get_all_event_urls' : time_calls(scraper.get_all_event_urls, [(BASE_EVENTS_URL, date)], repeat),
+        'make_soup' : time_calls(make_soup, [(url, None, session, parser, EVENT_PAGE_STRAINER) for url in event_urls], repeat),
+        '_parse_title' : time_calls(scraper._parse_title, [(s,) for s in soups], repeat),
+        '_parse_description' : time_calls(scraper._parse_description, [(s,) for s in soups], repeat),
+        '_parse_more_info_url' : time_calls(scraper._parse_more_info_url, [(s,) for s in soups], repeat),
+        '_parse_loc_start_end' : time_calls(scraper._parse_loc_start_end, [(s, date) for s in soups], repeat),
+        '_parse_all' : time_calls(scraper._parse_all, [(s, date) for s in soups], repeat),
+        'make_datetime_obj' : time_calls(make_datetime_obj, [(date, t) for t in times + [None]], repeat),
+        'parse_building' : time_calls(scraper.parse_building, [(l,) for l in locations], repeat),
+    }
+
+    # And the whole thing, end to end
+    end_to_end_scraper = EventScraper(load_building_dicts(), session=FixtureSession(latency=latency),
+        parser=parser, workers=workers)
+    start = time.perf_counter()
+    events = end_to_end_scraper.get_events_for_dates(date, date + datetime.timedelta(days=days - 1))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'parser' : parser,
+        'workers' : workers,
+        'latency_ms' : latency * 1000,
+        'days' : days,
+        'events' : len(events),
+        'seconds' : elapsed,
+        'events_per_second' : len(events) / elapsed if elapsed > 0 else 0,
+        'stages' : dict((name, summarize(latencies)) for name, latencies in stages.items()),
+    }
+
+def print_report(results):
+    print('parser=%(parser)s workers=%(workers)i latency=%(latency_ms).1fms' % results)
+    print('%(events)i events over %(days)i days in %(seconds).3fs (%(events_per_second).1f events/s)' % results)
+    print()
+    print('%-22s %7s %10s %10s %10s %10s' % ('stage', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+
+    for name, s in sorted(results['stages'].items()):
+        print('%-22s %7i %10.3f %10.3f %10.3f %10.3f' % (name, s['count'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Benchmark the event scraper against recorded pages')
+    arg_parser.add_argument('--days', type=int, default=7, help='days scraped end to end')
+    arg_parser.add_argument('--repeat', type=int, default=20, help='times each stage is run over the fixtures')
+    arg_parser.add_argument('--parser', choices=PARSERS, default=DEFAULT_PARSER)
+    arg_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    arg_parser.add_argument('--latency', type=float, default=0, help='simulated seconds per fetch, end to end only')
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = arg_parser.parse_args()
+
+    results = run_benchmark(args.days, args.repeat, args.parser, args.workers, args.latency)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_report(results)
@@ -1,32 +1,83 @@
+// The correction a row of the events table describes
+function rowCorrection(row) {
+    return {
+        'full_location' : row.children(".full_location_cell").text(),
+        'old_location' : row.children(".building_cell").text(),
+        'new_location' : row.find(".new_building_select").val(),
+        'new_alias' : row.find(".new_alias_text").val()
+    };
+}
+
+// Show the row as fixed: its building is now <new_location>
+function markRowFixed(row, new_location) {
+    row.children(".building_cell").text(new_location);
+    row.find(".new_alias_text").val('');
+    row.removeClass("pending_fix");
+}
+
 $(document).ready(function() {
-    $('.new_alias_submit').click(function () {
-        var new_alias_cell = $(this).siblings(".new_alias_text");
-        var new_alias = new_alias_cell.val();
-        var parent = $(this).parent();
+    // The building list is only in the page once (in the filter form), so copy it
+    // into each row's select, starting on the row's current building
+    var buildingOptions = $('#building_filter option').slice(1);
+    $('.new_building_select').each(function () {
+        var row = $(this).closest("tr");
+        $(this).append(buildingOptions.clone().removeAttr("selected"));
+        $(this).val(row.children(".building_cell").text());
+    });
 
-        var old_location_cell = parent.siblings(".building_cell");
-        var old_location = old_location_cell.text();
+    // Rows whose building was changed or got an alias typed in are pending fixes
+    $('.new_building_select, .new_alias_text').change(function () {
+        var row = $(this).closest("tr");
+        var correction = rowCorrection(row);
+        var pending = correction.new_location != correction.old_location || correction.new_alias != '';
 
-        var new_location_cell = parent.siblings(".new_building_cell");
-        var new_location = new_location_cell.children(".new_building_select").val();
+        row.toggleClass("pending_fix", pending);
+    });
 
+    $('.new_alias_submit').click(function () {
+        var row = $(this).closest("tr");
         // Need the full location as well so backend knows what events to update
-        var full_location = parent.siblings(".full_location_cell").text();
-        
-        var locationUpdates = {
-            'full_location' : full_location,
-            'old_location' : old_location,
-            'new_location' : new_location,
-            'new_alias' : new_alias
-        };
+        var locationUpdates = rowCorrection(row);
         console.log(locationUpdates);
 
         $.post('api/v1.0/update_building_alias', locationUpdates, function(data) {
             // highlight this row, or something
             // actually, update all the rows with the same old_location
-            old_location_cell.text(new_location);
-            new_alias_cell.val('');
-            alert('Successful update. Sorry for the popup!')
+            markRowFixed(row, locationUpdates.new_location);
+            $('.alert strong').text('Successful update');
+            $('.alert').show();
+        });
+    });
+
+    // Send every pending fix in one request
+    $('#submit_all_fixes').click(function () {
+        var rows = $('tr.pending_fix');
+        var corrections = rows.map(function () { return rowCorrection($(this)); }).get();
+
+        if (corrections.length == 0) {
+            return;
+        }
+
+        $.ajax({
+            url : 'api/v1.0/update_building_aliases',
+            type : 'POST',
+            contentType : 'application/json',
+            data : JSON.stringify(corrections),
+            success : function(data) {
+                var failed = 0;
+
+                $.each(data.results, function(i, result) {
+                    if (result.Success) {
+                        markRowFixed(rows.eq(i), corrections[i].new_location);
+                    } else {
+                        failed += 1;
+                        console.log(corrections[i], result.error);
+                    }
+                });
+
+                $('.alert strong').text('Updated ' + (corrections.length - failed) + ' of ' + corrections.length + ' rows');
+                $('.alert').show();
+            }
         });
     });
-});
\ No newline at end of file
+});
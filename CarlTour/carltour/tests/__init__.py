@@ -0,0 +1,1328 @@
+import unittest
+
+from pyramid import testing
+
+
+class MockMongoTestCase(unittest.TestCase):
+    '''
+    Tests that need Mongo get it from mock_db(), an in-memory database (see
+    mock_mongo). They are skipped if mongomock isn't installed
+    '''
+
+    def skip_without_mongomock(self):
+        from .mock_mongo import mongomock
+
+        if mongomock is None:
+            self.skipTest('mongomock is not installed')
+
+    def mock_db(self):
+        from .mock_mongo import MockMongoClient
+
+        self.skip_without_mongomock()
+        return MockMongoClient()['carltour_test']
+
+
+class ViewTests(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_my_view(self):
+        from ..views import my_view
+        request = testing.DummyRequest()
+        info = my_view(request)
+        self.assertEqual(info['project'], 'CarlTour')
+
+
+class EventScraperTests(unittest.TestCase):
+    def test_concurrent_scrape_keeps_order(self):
+        import datetime
+        import random
+        import time
+        from ..event_scraper import EventScraper
+
+        class FakeScraper(EventScraper):
+            def get_all_event_urls(self, event_page_url, date):
+                return ['%s/%i' % (date, i) for i in range(10)]
+
+            def scrape_one_event(self, url, date):
+                time.sleep(random.random() / 100)
+                return {'url' : url}
+
+        start = datetime.date(2014, 5, 19)
+        end = datetime.date(2014, 5, 21)
+        serial = FakeScraper([]).get_events_for_dates(start, end)
+        concurrent = FakeScraper([], workers=8).get_events_for_dates(start, end)
+
+        self.assertEqual(len(serial), 30)
+        self.assertEqual(serial, concurrent)
+
+
+class BuildingMatcherTests(unittest.TestCase):
+    def setUp(self):
+        import random
+        from ..add_buildings_to_db import read_buildings_file
+        from ..scraper_benchmark import BUILDINGS_FILE
+
+        names = [b['name'] for b in read_buildings_file(BUILDINGS_FILE)]
+
+        # Build a big alias list out of pieces of the real building names
+        rand = random.Random(1)
+        self.building_dicts = []
+        for name in names:
+            words = name.split()
+            aliases = [' '.join(rand.sample(words, rand.randint(1, len(words)))) for i in range(4)]
+            aliases += [''.join(w[0] for w in words), name.lower()]
+            self.building_dicts.append({'name' : name, 'aliases' : aliases})
+
+        self.locations = [
+            'Weitz Center 236', 'Sayles-Hill Campus Center', 'CMC 206', 'Skinner Memorial Chapel',
+            'Great Hall', 'Library Athenaeum', 'Recreation Center Field House', '', 'x',
+            'Boliou 104', 'Concert Hall, Weitz Center for Creativity',
+        ]
+        for i in range(40):
+            words = rand.choice(names).split()
+            self.locations.append(' '.join(rand.sample(words, rand.randint(1, len(words)))) + ' %i' % rand.randint(1, 400))
+
+    def test_parity_with_brute_force(self):
+        from ..building_matcher import BuildingMatcher, brute_force_match
+
+        matcher = BuildingMatcher(self.building_dicts)
+        for loc in self.locations:
+            self.assertEqual(matcher.match(loc), brute_force_match(self.building_dicts, loc), loc)
+
+    def test_match_many_parity(self):
+        from ..building_matcher import BuildingMatcher
+
+        matcher = BuildingMatcher(self.building_dicts)
+        self.assertEqual(matcher.match_many(self.locations), [matcher.match(l) for l in self.locations])
+
+    def test_margin_over_other_buildings(self):
+        from ..building_matcher import BuildingMatcher, brute_force_match
+
+        matcher = BuildingMatcher(self.building_dicts)
+        for loc in self.locations[:15]:
+            match = matcher.match(loc)
+            others = [b for b in self.building_dicts if b['name'] != match[0]]
+            expected = match[2] - brute_force_match(others, loc)[2] if match[0] else 0
+            self.assertEqual(matcher.margin(loc, match), expected, loc)
+
+
+class EventDBUpdaterTests(MockMongoTestCase):
+    def test_event_key(self):
+        import datetime
+        from ..event_db_updater import make_event_key
+
+        event = {
+            'title' : 'Convocation',
+            'start_datetime' : datetime.datetime(2014, 5, 21, 10, 50),
+            'full_location' : 'Skinner Memorial Chapel',
+            'event_url' : 'http://apps.carleton.edu/calendar/?event_id=1'
+        }
+        moved = dict(event, start_datetime=datetime.datetime(2014, 5, 21, 11), title='Convo')
+        next_day = dict(event, start_datetime=datetime.datetime(2014, 5, 22, 10, 50))
+
+        self.assertEqual(make_event_key(event), make_event_key(moved))
+        self.assertNotEqual(make_event_key(event), make_event_key(next_day))
+
+    def test_rescrape_keeps_hand_fixed_building(self):
+        import datetime
+        from ..event_db_updater import BulkEventWriter
+
+        events = self.mock_db()['events']
+
+        def scraped(event_id, description):
+            return {
+                'title' : 'Event %i' % event_id,
+                'description' : description,
+                'start_datetime' : datetime.datetime(2014, 5, 21, 10 + event_id),
+                'full_location' : 'Weitz 236',
+                'event_url' : 'http://apps.carleton.edu/calendar/?event_id=%i' % event_id,
+                'building' : 'Myers Hall',
+                'match_score' : 60,
+            }
+
+        writer = BulkEventWriter(events)
+        writer.add(scraped(1, 'Old'))
+        writer.add(scraped(2, 'Old'))
+        writer.flush()
+
+        events.update({'title' : 'Event 1'}, {'$set' : {'building' : 'Weitz Center for Creativity', 'building_set_by_hand' : True}})
+
+        writer = BulkEventWriter(events)
+        writer.add(scraped(1, 'New'))
+        writer.add(dict(scraped(2, 'New'), building='Olin Hall'))
+        writer.flush()
+        self.assertEqual(writer.counts, {'inserted' : 0, 'updated' : 2, 'unchanged' : 0})
+
+        fixed = events.find_one({'title' : 'Event 1'})
+        self.assertEqual((fixed['building'], fixed['description']), ('Weitz Center for Creativity', 'New'))
+        self.assertEqual(events.find_one({'title' : 'Event 2'})['building'], 'Olin Hall')
+
+        # Nothing changed apart from what the hand fix decides
+        writer = BulkEventWriter(events)
+        writer.add(scraped(1, 'New'))
+        writer.flush()
+        self.assertEqual(writer.counts['unchanged'], 1)
+
+    def test_duplicates_and_unkeyed_events(self):
+        import datetime
+        from ..change_log import CHANGE_SEQ_FIELD, UNKEYED_PREFIX, sync_key
+        from ..event_db_updater import BulkEventWriter, remove_unkeyed_events
+
+        events = self.mock_db()['events']
+
+        # Stored before events had keys
+        start = datetime.datetime(2014, 5, 21, 11)
+        events.insert({'title' : 'Convocation', 'start_datetime' : start, 'full_location' : 'Skinner Memorial Chapel'})
+        events.insert({'title' : 'Next week', 'start_datetime' : start + datetime.timedelta(days=7)})
+
+        url = 'http://apps.carleton.edu/calendar/?event_id=1'
+        event = {'title' : 'Convocation', 'start_datetime' : start, 'full_location' : 'Skinner Memorial Chapel',
+                 'event_url' : url}
+        writer = BulkEventWriter(events)
+        writer.add(event)
+        writer.add(dict(event, title='Convo'))
+        writer.flush()
+        self.assertEqual(writer.counts, {'inserted' : 1, 'updated' : 0, 'unchanged' : 0})
+
+        self.assertEqual(remove_unkeyed_events(events, {start.date() : [url]}), 1)
+        self.assertEqual(sorted(e['title'] for e in events.find({'deleted' : {'$ne' : True}})), ['Convo', 'Next week'])
+
+        # Kept as a tombstone sync clients can match up with what they were sent
+        tombstone = events.find_one({'deleted' : True})
+        self.assertEqual(tombstone['title'], 'Convocation')
+        self.assertTrue(CHANGE_SEQ_FIELD in tombstone)
+        self.assertEqual(sync_key(tombstone), UNKEYED_PREFIX + str(tombstone['_id']))
+        self.assertEqual(remove_unkeyed_events(events, {start.date() : [url]}), 0)
+
+    def test_removed_events_pages_are_forgotten(self):
+        import datetime
+        from ..event_db_updater import remove_unlisted_events
+        from ..page_store import PageStore
+
+        db = self.mock_db()
+        page_store = PageStore(db)
+
+        date = datetime.date(2014, 5, 21)
+        urls = ['http://apps.carleton.edu/calendar/?event_id=%i' % i for i in range(2)]
+        for i, url in enumerate(urls):
+            db['events'].insert({'event_url' : url, 'start_datetime' : datetime.datetime(2014, 5, 21, 10 + i)})
+            page_store.save({'url' : url, 'date' : date.isoformat(), 'content_hash' : 'abc'})
+
+        self.assertEqual(remove_unlisted_events(db['events'], {date : urls[:1]}, page_store), 1)
+        self.assertEqual(db['events'].find_one({'event_url' : urls[1]})['deleted'], True)
+
+        # The removed event's page has to be parsed again if it's listed again
+        self.assertIsNotNone(page_store.get(urls[0], date))
+        self.assertIsNone(page_store.get(urls[1], date))
+
+
+class LocationCacheTests(MockMongoTestCase):
+    def setUp(self):
+        self.db = self.mock_db()
+
+    def test_get_set(self):
+        from ..location_cache import LocationCache
+
+        cache = LocationCache(self.db, max_size=1)
+        self.assertEqual(cache.get('CMC 206'), None)
+
+        cache.set('CMC 206', ('Center for Math and Computing', 'CMC', 100, 40))
+        cache.set('Olin 101', ('Olin Hall', 'Olin', 100, 30))
+        self.assertEqual(len(cache.lru), 1)
+
+        # Out of the LRU, but still in Mongo
+        self.assertEqual(LocationCache(self.db).get('CMC 206'), ('Center for Math and Computing', 'CMC', 100, 40))
+
+    def test_invalidate_only_locations_alias_could_change(self):
+        from ..location_cache import LocationCache, invalidate_locations_for_aliases
+
+        cache = LocationCache(self.db)
+        cache.set('CMC 206', ('Center for Math and Computing', 'CMC', 90, 40))
+        cache.set('Olin 101', ('Olin Hall', 'Olin', 95, 30))
+        cache.set('Somewhere odd', ('Myers Hall', 'Myers', 40, 2))
+        cache.set('Weitz 236', ('Weitz Center for Creativity', 'Weitz', 95, 50))
+        # A good match, but the alias is in the middle of a word
+        cache.set('AnderCMC Hall', ('Anderson Hall', 'Ander', 100, 20))
+
+        stale = invalidate_locations_for_aliases(self.db, ['CMC'], ['Weitz 236'])
+        self.assertEqual(sorted(stale), ['AnderCMC Hall', 'CMC 206', 'Weitz 236'])
+        self.assertEqual(sorted(doc['full_location'] for doc in self.db['building_locations'].find()),
+                         ['Olin 101', 'Somewhere odd'])
+
+
+class ReresolveTests(MockMongoTestCase):
+    def setUp(self):
+        import datetime
+        from ..location_cache import LocationCache
+
+        self.db = self.mock_db()
+
+        self.db['buildings'].insert([
+            {'name' : 'Center for Math and Computing', 'aliases' : ['CMC']},
+            {'name' : 'Myers Hall', 'aliases' : []},
+        ])
+        self.since = datetime.datetime(2014, 5, 21)
+
+        def event(title, full_location, day, **fields):
+            start = datetime.datetime(2014, 5, day, 10)
+            return dict({
+                'title' : title,
+                'full_location' : full_location,
+                'start_datetime' : start,
+                'end_datetime' : start + datetime.timedelta(hours=1),
+                'building' : 'Myers Hall',
+                'match_score' : 40,
+            }, **fields)
+
+        self.db['events'].insert([
+            event('Wrong building', 'CMC 206', 21),
+            event('Fixed by hand', 'CMC 206', 21, building='Olin Hall', building_set_by_hand=True),
+            event('Already past', 'CMC 206', 1),
+            event('Not affected', 'Myers Hall 130', 22, match_score=100),
+        ])
+        # 'CMC 206' was invalidated when the alias was added, 'Myers Hall 130' wasn't
+        LocationCache(self.db).set('Myers Hall 130', ('Myers Hall', 'Myers Hall', 100, 60))
+
+    def test_only_affected_events_rewritten(self):
+        from ..change_log import CHANGE_SEQ_FIELD
+        from ..event_index import MODIFIED_FIELD
+        from ..reresolve import ReresolveJob
+
+        job = ReresolveJob(self.db, ['CMC'], since=self.since)
+        self.assertEqual(sorted(job.find_locations()), ['CMC 206', 'Myers Hall 130'])
+        self.assertEqual(job.filter_affected(job.find_locations()), ['CMC 206'])
+
+        job.run()
+        self.assertEqual((job.status['state'], job.status['locations'], job.status['affected'],
+                          job.status['resolved'], job.status['events_updated']), ('finished', 2, 1, 1, 1))
+
+        events = dict((e['title'], e) for e in self.db['events'].find())
+        fixed = events['Wrong building']
+        self.assertEqual((fixed['building'], fixed['matched_alias'], fixed['match_score']),
+                         ('Center for Math and Computing', 'CMC', 100))
+        self.assertEqual(fixed[CHANGE_SEQ_FIELD], 1)
+        self.assertTrue(MODIFIED_FIELD in fixed)
+
+        self.assertEqual(events['Fixed by hand']['building'], 'Olin Hall')
+        for title in ['Fixed by hand', 'Already past', 'Not affected']:
+            self.assertFalse(CHANGE_SEQ_FIELD in events[title], title)
+
+        remembered = self.db['building_locations'].find_one({'full_location' : 'CMC 206'})
+        self.assertEqual((remembered['building'], remembered['score']), ('Center for Math and Computing', 100))
+
+        # Nothing left to change
+        again = ReresolveJob(self.db, ['CMC'], since=self.since)
+        again.run()
+        self.assertEqual(again.status['events_updated'], 0)
+
+    def test_past_events_rewritten_without_since(self):
+        from ..reresolve import ReresolveJob
+
+        job = ReresolveJob(self.db, ['CMC'])
+        job.run()
+        self.assertEqual(job.status['events_updated'], 2)
+
+        events = dict((e['title'], e) for e in self.db['events'].find())
+        for title in ['Wrong building', 'Already past']:
+            self.assertEqual(events[title]['building'], 'Center for Math and Computing', title)
+        self.assertEqual(events['Fixed by hand']['building'], 'Olin Hall')
+
+    def test_tracker(self):
+        from ..reresolve import ReresolveJob, ReresolveJobTracker
+
+        tracker = ReresolveJobTracker(jobs_kept=1)
+        tracker.start(ReresolveJob(self.db, ['CMC'], since=self.since))
+        job_id = tracker.start(ReresolveJob(self.db, ['Myers'], since=self.since))
+        tracker.wait()
+
+        statuses = tracker.statuses()
+        self.assertEqual([s['id'] for s in statuses], [job_id])
+        self.assertEqual(statuses[0]['state'], 'finished')
+        self.assertEqual(sorted(statuses[0]['timings']), ['filter_affected', 'find_locations', 'resolve', 'total', 'write'])
+
+
+class IndexTests(MockMongoTestCase):
+    '''
+    Most of these run against mock_db(), which can't say whether a query uses an
+    index. The explain() check needs a real mongod: the one at the
+    CARLTOUR_TEST_MONGO_URI environment variable, where it fails rather than
+    skips if it can't connect. Without that variable it tries localhost and is
+    skipped if nothing is there, so the query plan isn't enforced by default
+    '''
+
+    def test_specs_cover_queries(self):
+        from ..change_log import CHANGE_SEQ_FIELD
+        from ..indexes import INDEXES
+
+        def keys(collection_name):
+            return dict((tuple(field for field, direction in key), options) for key, options in INDEXES[collection_name])
+
+        events = keys('events')
+        # make_window_spec, the paged and building filtered sorts, and EventsSyncAPI
+        for fields in [('start_datetime', 'end_datetime'), ('start_datetime', '_id'),
+                       ('building', 'start_datetime', '_id'), (CHANGE_SEQ_FIELD, '_id')]:
+            self.assertIn(fields, events)
+        # Events stored before they had keys don't have one
+        self.assertEqual(events[('event_key',)], {'unique' : True, 'sparse' : True})
+        self.assertEqual(keys('buildings')[('name',)], {'unique' : True})
+
+    def test_ensure_indexes(self):
+        from pymongo.errors import DuplicateKeyError
+        from ..indexes import INDEXES, ensure_indexes
+
+        db = self.mock_db()
+        names = ensure_indexes(db)
+        self.assertEqual(len(names), sum(len(indexes) for indexes in INDEXES.values()))
+
+        # Names come back in the order of INDEXES
+        created = iter(names)
+        for collection_name, indexes in INDEXES.items():
+            info = db[collection_name].index_information()
+            self.assertEqual(len(info), len(indexes) + 1)
+            for key, options in indexes:
+                index = info[next(created)]
+                self.assertEqual(index['key'], key)
+                self.assertEqual(dict((option, index.get(option)) for option in options), options)
+
+        # Run again on every start, so it has to be harmless on existing indexes
+        self.assertEqual(ensure_indexes(db), names)
+
+        db['events'].insert([{'title' : 'Unkeyed'}, {'title' : 'Also unkeyed'}, {'event_key' : 'a'}])
+        self.assertRaises(DuplicateKeyError, db['events'].insert, {'event_key' : 'a'})
+
+    def test_events_window_query_uses_index(self):
+        import datetime
+        import os
+        import socket
+        from pymongo import MongoClient
+        from ..indexes import ensure_indexes
+        from ..views import make_window_spec
+
+        mongo_uri = os.environ.get('CARLTOUR_TEST_MONGO_URI')
+        if mongo_uri is None:
+            try:
+                socket.create_connection(('localhost', 27017), timeout=0.5).close()
+            except socket.error:
+                self.skipTest('No mongod running on localhost (set CARLTOUR_TEST_MONGO_URI to require one)')
+            mongo_uri = 'mongodb://localhost'
+
+        client = MongoClient(mongo_uri)
+        self.addCleanup(client.drop_database, 'carltour_test')
+        db = client['carltour_test']
+
+        ensure_indexes(db)
+        start = datetime.datetime(2014, 5, 1)
+        db['events'].insert([{
+            'start_datetime' : start + datetime.timedelta(hours=i),
+            'end_datetime' : start + datetime.timedelta(hours=i + 2),
+        } for i in range(100)])
+
+        spec = make_window_spec(start, start + datetime.timedelta(hours=48))
+        plan = str(db['events'].find(spec).explain())
+
+        # BtreeCursor on servers before 3.0, IXSCAN after
+        self.assertTrue('BtreeCursor' in plan or 'IXSCAN' in plan, plan)
+
+
+class ResponseCacheTests(MockMongoTestCase):
+    def test_entries_only_served_for_their_version(self):
+        from ..response_cache import ResponseCache
+
+        cache = ResponseCache(max_size=2)
+        entry = cache.set('a', 1, b'{}', None)
+
+        self.assertEqual(cache.get('a', 1), entry)
+        self.assertIsNone(cache.get('a', 2))
+
+        cache.set('b', 1, b'[]', None)
+        cache.set('c', 1, b'[]', None)
+        self.assertIsNone(cache.get('a', 1))
+
+    def test_version_read_again_after_ttl_or_bump(self):
+        from ..response_cache import VersionCache, bump_version
+
+        db = self.mock_db()
+
+        versions = VersionCache(ttl=60)
+        self.assertEqual(versions.get(db), (0, None))
+
+        # Another process's change isn't seen until the TTL runs out...
+        bump_version(db)
+        self.assertEqual(versions.get(db)[0], 0)
+        self.assertEqual(VersionCache(ttl=0).get(db)[0], 1)
+
+        # ...but this one's are
+        versions.bump(db)
+        self.assertEqual(versions.get(db)[0], 2)
+
+
+class EventPagingTests(MockMongoTestCase):
+    def setUp(self):
+        import datetime
+        from bson.objectid import ObjectId
+
+        start = datetime.datetime(2014, 5, 21, 8)
+        self.events = [{
+            '_id' : ObjectId(),
+            'title' : 'Event %i' % i,
+            'start_datetime' : start + datetime.timedelta(minutes=i),
+        } for i in range(250)]
+
+    def test_page_token_round_trip(self):
+        from ..views import encode_page_token, decode_page_token
+
+        event = self.events[3]
+        self.assertEqual(decode_page_token(encode_page_token(event)), (event['start_datetime'], event['_id']))
+        self.assertRaises(ValueError, decode_page_token, 'not a token')
+
+    def test_forged_tokens(self):
+        import base64
+        import json
+        from ..views import decode_page_token, decode_sync_token
+
+        def token(value):
+            return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+        for forged in [[1, 2], [None, '53b1f0a2e138230a4c0d0b1e'], ['2014-05-21T08:00:00', ['x']], {'a' : 1}, 7]:
+            self.assertRaises(ValueError, decode_page_token, token(forged))
+        for forged in [['12', None], [True, None], [-1, None], [1.5, None], [12, 34], [12, 'nope']]:
+            self.assertRaises(ValueError, decode_sync_token, token(forged))
+
+    def test_stream_matches_rendered_page(self):
+        import json
+        from ..views import stream_events, strip_paging_fields, next_page_token, json_default
+
+        for limit in [None, 250, 300]:
+            streamed = b''.join(stream_events(iter(self.events), ('title',), limit))
+            rendered = {'events' : [strip_paging_fields(e, ('title',)) for e in self.events]}
+            if limit is not None:
+                rendered['next'] = next_page_token(self.events, limit)
+
+            self.assertEqual(streamed.decode('utf-8'), json.dumps(rendered, default=json_default))
+
+    def test_pages_carry_full_events(self):
+        import datetime
+        import json
+        from pyramid import testing
+        from pyramid.renderers import JSON
+        from ..response_cache import ResponseCache, VersionCache
+        from ..scrape_daemon import DemandRecorder
+        from ..views import UpcomingEventsAPI
+
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        json_renderer = JSON()
+        json_renderer.add_adapter(datetime.datetime, lambda obj, request: obj.isoformat())
+        config.add_renderer('json', json_renderer)
+        config.registry.events_cache = ResponseCache()
+        config.registry.events_version = VersionCache()
+        config.registry.event_index = None
+        config.registry.demand = DemandRecorder()
+
+        db = self.mock_db()
+        start = datetime.datetime(2014, 5, 21, 8)
+        db['events'].insert([{
+            'title' : 'Event %i' % i,
+            'building' : 'Myers Hall',
+            'start_datetime' : start + datetime.timedelta(hours=i),
+            'end_datetime' : start + datetime.timedelta(hours=i + 1),
+        } for i in range(5)])
+
+        pages = []
+        after = None
+        while True:
+            params = {'start_date' : '2014-05-21', 'end_date' : '2014-05-22', 'limit' : '2'}
+            if after is not None:
+                params['after'] = after
+            request = testing.DummyRequest(params=params)
+            request.db = db
+            page = json.loads(UpcomingEventsAPI(request).get().body.decode('utf-8'))
+            pages.append(page['events'])
+
+            after = page['next']
+            if after is None:
+                break
+
+        self.assertEqual([len(p) for p in pages], [2, 2, 1])
+        events = [e for p in pages for e in p]
+        self.assertEqual([e['title'] for e in events], ['Event %i' % i for i in range(5)])
+        for e in events:
+            self.assertEqual(sorted(e), ['building', 'end_datetime', 'start_datetime', 'title'])
+
+
+class NearEventsTests(MockMongoTestCase):
+    '''
+    UpcomingEventsAPI with near=. mongomock has no $nearSphere, so
+    nearest_buildings is stubbed out
+    '''
+    def setUp(self):
+        import datetime
+        from collections import OrderedDict
+        from unittest import mock
+        from pyramid import testing
+        from pyramid.renderers import JSON
+        from ..response_cache import VersionCache
+        from ..scrape_daemon import DemandRecorder
+
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        json_renderer = JSON()
+        json_renderer.add_adapter(datetime.datetime, lambda obj, request: obj.isoformat())
+        self.config.add_renderer('json', json_renderer)
+        self.config.registry.events_version = VersionCache()
+        self.config.registry.demand = DemandRecorder()
+
+        self.db = self.mock_db()
+        # Tomorrow, so the event index's window covers it too
+        self.day = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+        self.db['events'].insert([{
+            'title' : title,
+            'building' : building,
+            'start_datetime' : self.day + datetime.timedelta(hours=hour),
+            'end_datetime' : self.day + datetime.timedelta(hours=hour + 1),
+        } for title, building, hour in [
+            ('Talk', 'Myers Hall', 9), ('Concert', 'Weitz Center', 20), ('Lunch', 'Myers Hall', 12),
+            ('Far away', 'Olin Hall', 10), ('Next week', 'Weitz Center', 24 * 7),
+        ]])
+
+        distances = OrderedDict([('Weitz Center', 50.04), ('Myers Hall', 210.0)])
+        patcher = mock.patch('carltour.views.nearest_buildings', return_value=distances)
+        self.nearest_buildings = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        import datetime
+        import json
+        from pyramid import testing
+        from ..response_cache import ResponseCache
+        from ..views import UpcomingEventsAPI
+
+        self.config.registry.events_cache = ResponseCache()
+        params = dict({'start_date' : self.day.date().isoformat(),
+                       'end_date' : (self.day + datetime.timedelta(days=1)).date().isoformat(),
+                       'near' : '44.4606,-93.1536', 'fields' : 'title'}, **params)
+        request = testing.DummyRequest(params=params)
+        request.db = self.db
+        return json.loads(UpcomingEventsAPI(request).get().body.decode('utf-8'))['events']
+
+    def test_nearest_buildings_first(self):
+        from ..event_index import EventIntervalIndex
+
+        expected = [{'title' : 'Concert', 'distance' : 50.0}, {'title' : 'Talk', 'distance' : 210.0},
+                    {'title' : 'Lunch', 'distance' : 210.0}]
+
+        self.config.registry.event_index = None
+        self.assertEqual(self.get(radius='300'), expected)
+        self.assertEqual(self.nearest_buildings.call_args[0][1:], (44.4606, -93.1536, 300.0))
+
+        # Same answer from the in-memory index
+        self.config.registry.event_index = EventIntervalIndex()
+        self.assertEqual(self.get(radius='300'), expected)
+
+    def test_bad_near_requests(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        self.config.registry.event_index = None
+        for params in [{'limit' : '2'}, {'after' : 'abc'}, {'stream' : 'true'}, {'near' : 'here'},
+                       {'near' : '91,0'}, {'radius' : '0'}, {'radius' : '100000'}]:
+            self.assertRaises(HTTPBadRequest, self.get, **params)
+
+
+class ParserEquivalenceTests(unittest.TestCase):
+    '''
+    Every parser backend (with the event page strainer and the one-pass _parse_all)
+    has to get the same thing out of the recorded pages in fixtures/ as
+    html5lib and the _parse_* helpers did
+    '''
+    def setUp(self):
+        from ..scraper_benchmark import FIXTURES_DIR
+        self.fixtures_dir = FIXTURES_DIR
+
+    def read_fixtures(self, prefix):
+        import os
+        for name in sorted(os.listdir(self.fixtures_dir)):
+            if name.startswith(prefix):
+                with open(os.path.join(self.fixtures_dir, name)) as f:
+                    yield name, f.read()
+
+    def available_parsers(self):
+        import importlib
+        from ..event_scraper import PARSERS
+
+        for parser in PARSERS:
+            try:
+                importlib.import_module(parser)
+            except ImportError:
+                continue
+            yield parser
+
+    def test_event_pages(self):
+        import datetime
+        from ..event_scraper import EventScraper, make_soup_from_html, EVENT_PAGE_STRAINER
+
+        scraper = EventScraper([])
+        date = datetime.date(2014, 5, 21)
+
+        for name, html in self.read_fixtures('event_'):
+            soup = make_soup_from_html(html, 'html5lib')
+            expected = (
+                scraper._parse_title(soup),
+                scraper._parse_description(soup),
+                scraper._parse_more_info_url(soup),
+            ) + scraper._parse_loc_start_end(soup, date)
+
+            for parser in self.available_parsers():
+                soup = make_soup_from_html(html, parser, EVENT_PAGE_STRAINER)
+                self.assertEqual(scraper._parse_all(soup, date), expected, (name, parser))
+
+    def test_listing_pages(self):
+        from ..event_scraper import parse_event_urls, make_soup_from_html
+
+        for name, html in self.read_fixtures('listing_'):
+            expected = parse_event_urls(make_soup_from_html(html, 'html5lib'))
+            self.assertTrue(len(expected) > 0)
+
+            for parser in self.available_parsers():
+                self.assertEqual(parse_event_urls(make_soup_from_html(html, parser)), expected, (name, parser))
+
+
+class ScraperBenchmarkTests(unittest.TestCase):
+    def test_fixture_scrape(self):
+        from ..scraper_benchmark import run_benchmark
+
+        results = run_benchmark(days=2, repeat=1)
+
+        # Every recorded event page with a location, on both days
+        self.assertEqual(results['events'], 8)
+        self.assertEqual(results['stages']['_parse_all']['count'], 5)
+
+
+class AsyncEventScraperTests(unittest.TestCase):
+    def test_same_events_as_serial_scrape(self):
+        import datetime
+        from ..async_scraper import AsyncEventScraper
+        from ..event_scraper import EventScraper
+        from ..scraper_benchmark import FixtureSession, load_building_dicts
+
+        start = datetime.date(2014, 5, 21)
+        end = datetime.date(2014, 5, 23)
+        serial = EventScraper(load_building_dicts(), session=FixtureSession()).get_events_for_dates(start, end)
+        concurrent = AsyncEventScraper(load_building_dicts(), session=FixtureSession(), concurrency=4,
+            requests_per_second=1000).get_events_for_dates(start, end)
+
+        self.assertEqual(len(serial), 12)
+        self.assertEqual(serial, concurrent)
+
+    def test_failed_page_is_left_out(self):
+        import datetime
+        import requests
+        from ..async_scraper import AsyncEventScraper
+        from ..event_scraper import EventScraper
+        from ..scraper_benchmark import FixtureSession, load_building_dicts
+
+        class FlakySession(FixtureSession):
+            def get(self, url, params=None, headers=None):
+                if url.endswith('1141270'):
+                    raise requests.ConnectionError('Connection reset')
+                return FixtureSession.get(self, url, params, headers)
+
+        start = datetime.date(2014, 5, 21)
+        end = datetime.date(2014, 5, 22)
+        serial_scraper = EventScraper(load_building_dicts(), session=FixtureSession())
+        serial = serial_scraper.get_events_for_dates(start, end)
+        scraper = AsyncEventScraper(load_building_dicts(), session=FlakySession(), retries=0, requests_per_second=1000)
+        concurrent = scraper.get_events_for_dates(start, end)
+
+        self.assertEqual(concurrent, [e for e in serial if not e['event_url'].endswith('1141270')])
+        self.assertTrue(len(concurrent) < len(serial))
+        self.assertEqual(scraper.event_urls_by_date, serial_scraper.event_urls_by_date)
+
+
+class ProcessPoolEventScraperTests(unittest.TestCase):
+    def test_same_events_and_callbacks_as_serial_scrape(self):
+        import datetime
+        from ..event_scraper import EventScraper
+        from ..process_pool_scraper import ProcessPoolEventScraper
+        from ..scraper_benchmark import FixtureSession, load_building_dicts
+
+        start = datetime.date(2014, 5, 21)
+        end = datetime.date(2014, 5, 22)
+        serial_matches = []
+        pool_matches = []
+
+        serial_scraper = EventScraper(load_building_dicts(), lambda *m: serial_matches.append(m), session=FixtureSession())
+        serial = serial_scraper.get_events_for_dates(start, end)
+        pool_scraper = ProcessPoolEventScraper(load_building_dicts(), lambda *m: pool_matches.append(m),
+            processes=2, session=FixtureSession())
+        pooled = pool_scraper.get_events_for_dates(start, end)
+
+        self.assertEqual(len(serial), 8)
+        self.assertEqual(serial, pooled)
+        self.assertEqual(serial_matches, pool_matches)
+        # update_db_for_dates removes the stored events that aren't in here
+        self.assertEqual(pool_scraper.event_urls_by_date, serial_scraper.event_urls_by_date)
+
+
+class AliasCorrectionTests(MockMongoTestCase):
+    def test_check_correction(self):
+        from ..views import check_correction
+
+        known = set(['Weitz Center'])
+        good = {'full_location' : 'WCC 236', 'old_location' : 'Sayles Hill',
+                'new_location' : 'Weitz Center', 'new_alias' : 'WCC'}
+
+        self.assertIsNone(check_correction(good, known))
+        self.assertIsNone(check_correction(dict(good, new_alias=''), known))
+        self.assertEqual(check_correction(dict(good, new_location='Nowhere'), known), "Unknown building 'Nowhere'")
+        self.assertEqual(check_correction(dict(good, full_location=None), known), 'Missing full_location')
+        self.assertEqual(check_correction(['WCC'], known), 'Not an object')
+
+    def test_apply_corrections(self):
+        import datetime
+        from pyramid import testing
+        from ..change_log import CHANGE_SEQ_FIELD
+        from ..location_cache import LocationCache
+        from ..reresolve import ReresolveJobTracker
+        from ..response_cache import VersionCache
+        from ..views import UpdateBuilding
+
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        config.registry.events_version = VersionCache(ttl=0)
+        config.registry.reresolve_jobs = ReresolveJobTracker()
+
+        db = self.mock_db()
+        db['buildings'].insert([
+            {'name' : 'Weitz Center for Creativity', 'aliases' : ['Weitz']},
+            {'name' : 'Myers Hall', 'aliases' : []},
+        ])
+        start = datetime.datetime(2014, 5, 21, 10)
+        db['events'].insert([
+            {'title' : 'Talk', 'full_location' : 'WCC 236', 'building' : 'Myers Hall', 'start_datetime' : start},
+            {'title' : 'Film', 'full_location' : 'WCC 236', 'building' : 'Myers Hall', 'start_datetime' : start},
+            {'title' : 'Recital', 'full_location' : 'Concert Hall', 'building' : 'Myers Hall', 'start_datetime' : start},
+        ])
+        LocationCache(db).set('WCC 236', ('Myers Hall', 'Myers Hall', 40, 5))
+        LocationCache(db).set('Olin 101', ('Myers Hall', 'Myers Hall', 95, 30))
+
+        correction = {'full_location' : 'WCC 236', 'old_location' : 'Myers Hall',
+                      'new_location' : 'Weitz Center for Creativity', 'new_alias' : 'WCC'}
+        request = testing.DummyRequest()
+        request.db = db
+        results, job_id = UpdateBuilding(request).apply_corrections([
+            correction,
+            correction,
+            dict(correction, new_location='Nowhere'),
+        ])
+        config.registry.reresolve_jobs.wait()
+
+        self.assertEqual(results, [{'Success' : 1}, {'Success' : 1}, {'Success' : 0, 'error' : "Unknown building 'Nowhere'"}])
+        self.assertIsNotNone(job_id)
+        self.assertEqual(db['buildings'].find_one({'name' : 'Weitz Center for Creativity'})['aliases'], ['Weitz', 'WCC'])
+
+        events = dict((e['title'], e) for e in db['events'].find())
+        for title in ['Talk', 'Film']:
+            self.assertEqual((events[title]['building'], events[title]['building_set_by_hand'], events[title][CHANGE_SEQ_FIELD]),
+                             ('Weitz Center for Creativity', True, 1))
+        self.assertEqual(events['Recital']['building'], 'Myers Hall')
+
+        # The corrected location's remembered match is dropped, and cached responses are stale
+        self.assertEqual([doc['full_location'] for doc in db['building_locations'].find()], ['Olin 101'])
+        self.assertEqual(config.registry.events_version.get(db)[0], 1)
+
+        # Nothing valid to apply
+        results, job_id = UpdateBuilding(request).apply_corrections([dict(correction, full_location=None)])
+        self.assertEqual((results, job_id), ([{'Success' : 0, 'error' : 'Missing full_location'}], None))
+
+
+class EventViewerTests(MockMongoTestCase):
+    def test_filters_make_spec(self):
+        import datetime
+        from pyramid import testing
+        from ..views import EventViewer
+
+        request = testing.DummyRequest(params={'start_date' : '2014-05-21', 'end_date' : '2014-05-22',
+                                               'building' : 'Weitz Center'})
+        viewer = EventViewer(request)
+        spec = viewer._make_spec(viewer._requested_filters())
+
+        self.assertEqual(spec, {
+            'end_datetime' : {'$gte' : datetime.datetime(2014, 5, 21)},
+            'start_datetime' : {'$lt' : datetime.datetime(2014, 5, 23)},
+            'building' : 'Weitz Center',
+            'deleted' : {'$ne' : True}
+        })
+
+    def test_show_events_pages_through_filtered_events(self):
+        import datetime
+        from unittest import mock
+        from urllib.parse import parse_qsl, urlparse
+        from pyramid import testing
+        from pyramid.interfaces import IRoutesMapper
+        from pyramid.renderers import render
+        from ..views import EventViewer
+
+        config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        config.include('pyramid_jinja2')
+        config.add_route('events_view', 'events')
+
+        db = self.mock_db()
+        db['buildings'].insert([{'name' : 'Myers Hall', 'aliases' : []}, {'name' : 'Weitz Center', 'aliases' : []}])
+        start = datetime.datetime(2014, 5, 21, 8)
+        events = []
+        for i in range(8):
+            events.append({
+                'title' : 'Event %i' % i,
+                'building' : 'Myers Hall' if i == 7 else 'Weitz Center',
+                'full_location' : 'Weitz 236',
+                'start_datetime' : start + datetime.timedelta(hours=i),
+                'end_datetime' : start + datetime.timedelta(hours=i + 1),
+                'match_score' : 40 if i % 2 == 0 else 100,
+                'match_margin' : 10,
+            })
+        events[6]['building_set_by_hand'] = True
+        events.append(dict(events[0], title='Removed', deleted=True))
+        db['events'].insert(events)
+
+        def show(params):
+            request = testing.DummyRequest(params=params)
+            request.db = db
+            request.matched_route = config.registry.getUtility(IRoutesMapper).get_route('events_view')
+            with mock.patch('carltour.views.EVENTS_PAGE_SIZE', 2):
+                result = EventViewer(request).show_events()
+            return result, render('carltour:templates/events_table.jinja2', result, request=request)
+
+        params = {'start_date' : '2014-05-21', 'end_date' : '2014-05-21', 'building' : 'Weitz Center', 'low_score' : 'true'}
+        first, html = show(params)
+        self.assertEqual([e['title'] for e in first['events']], ['Event 0', 'Event 2'])
+        self.assertEqual(first['buildings'], ['Myers Hall', 'Weitz Center'])
+        self.assertTrue('Event 2' in html and 'Event 4' not in html)
+        self.assertTrue('Next page' in html)
+
+        # The next page link keeps the filters
+        next_params = dict(parse_qsl(urlparse(first['next_url']).query))
+        self.assertEqual(dict((k, v) for k, v in next_params.items() if k != 'after'), params)
+
+        second, html = show(next_params)
+        self.assertEqual([e['title'] for e in second['events']], ['Event 4'])
+        self.assertIsNone(second['next_url'])
+        self.assertTrue('Next page' not in html)
+
+
+class SyncTokenTests(unittest.TestCase):
+    def test_round_trip(self):
+        from bson.objectid import ObjectId
+        from ..views import decode_sync_token, encode_sync_token
+
+        event_id = ObjectId()
+        self.assertEqual(decode_sync_token(encode_sync_token(12, event_id)), (12, event_id))
+        self.assertEqual(decode_sync_token(encode_sync_token(12, None)), (12, None))
+
+    def test_bad_token(self):
+        from ..views import decode_sync_token, encode_page_token
+        import datetime
+        from bson.objectid import ObjectId
+
+        page_token = encode_page_token({'start_datetime' : datetime.datetime(2014, 5, 21), '_id' : ObjectId()})
+        self.assertRaises(ValueError, decode_sync_token, page_token)
+        self.assertRaises(ValueError, decode_sync_token, 'not a token')
+
+
+class ChangeLogTests(MockMongoTestCase):
+    def setUp(self):
+        self.db = self.mock_db()
+
+    def test_settled_sequence(self):
+        import datetime
+        from ..change_log import PENDING_TIMEOUT, finish_sequence, reserve_sequence, settled_sequence
+
+        self.assertEqual(settled_sequence(self.db), 0)
+        first = reserve_sequence(self.db)
+        second = reserve_sequence(self.db)
+        self.assertEqual((first, second), (1, 2))
+
+        # Nothing past a write still going is settled, even if later ones are done
+        self.assertEqual(settled_sequence(self.db), 0)
+        finish_sequence(self.db, second)
+        self.assertEqual(settled_sequence(self.db), 0)
+        finish_sequence(self.db, first)
+        self.assertEqual(settled_sequence(self.db), 2)
+
+        # A write that never finished is given up on after PENDING_TIMEOUT
+        third = reserve_sequence(self.db)
+        self.assertEqual(settled_sequence(self.db), 2)
+        died_at = datetime.datetime.utcnow() - PENDING_TIMEOUT - datetime.timedelta(minutes=1)
+        self.db['sequences'].update({'_id' : 'events'}, {'$set' : {'pending' : [{'seq' : third, 'at' : died_at}]}})
+        self.assertEqual(settled_sequence(self.db), 3)
+
+    def test_stamp_unsequenced_events(self):
+        from ..change_log import CHANGE_SEQ_FIELD, stamp_unsequenced_events
+
+        events = self.db['events']
+        events.insert([{'title' : 'Old'}, {'title' : 'Also old'}, {'title' : 'New', CHANGE_SEQ_FIELD : 7}])
+
+        self.assertEqual(stamp_unsequenced_events(events), 2)
+        self.assertEqual(sorted((e['title'], e[CHANGE_SEQ_FIELD]) for e in events.find()),
+                         [('Also old', 1), ('New', 7), ('Old', 1)])
+        self.assertEqual(stamp_unsequenced_events(events), 0)
+
+
+class EventsSyncTests(MockMongoTestCase):
+    def setUp(self):
+        import datetime
+        from pyramid import testing
+        from ..change_log import CHANGE_SEQ_FIELD, change_sequence
+
+        testing.setUp()
+        self.addCleanup(testing.tearDown)
+        self.db = self.mock_db()
+
+        start = datetime.datetime(2014, 5, 21, 8)
+        self.titles = ['Event %i' % i for i in range(4)]
+        # Three events written by one scrape, one by the next
+        for titles in [self.titles[:3], self.titles[3:]]:
+            with change_sequence(self.db) as seq:
+                for title in titles:
+                    self.db['events'].insert({'title' : title, 'event_key' : title, 'start_datetime' : start,
+                                              CHANGE_SEQ_FIELD : seq})
+
+    def sync(self, since=None, limit=None):
+        from pyramid import testing
+        from ..views import EventsSyncAPI
+
+        params = {}
+        if since is not None:
+            params['since'] = since
+        if limit is not None:
+            params['limit'] = str(limit)
+        request = testing.DummyRequest(params=params)
+        request.db = self.db
+        return EventsSyncAPI(request).get()
+
+    def test_pages_stop_at_settled_sequence(self):
+        from ..change_log import CHANGE_SEQ_FIELD, finish_sequence, reserve_sequence
+
+        # A write still in progress
+        seq = reserve_sequence(self.db)
+        self.db['events'].insert({'title' : 'Event 4', 'event_key' : 'Event 4', CHANGE_SEQ_FIELD : seq})
+
+        first = self.sync(limit=2)
+        self.assertEqual(([e['title'] for e in first['changed']], first['more']), (self.titles[:2], True))
+        second = self.sync(first['next'], limit=2)
+        self.assertEqual(([e['title'] for e in second['changed']], second['more']), (self.titles[2:], False))
+        self.assertEqual(self.sync(second['next'])['changed'], [])
+
+        finish_sequence(self.db, seq)
+        third = self.sync(second['next'])
+        self.assertEqual([e['title'] for e in third['changed']], ['Event 4'])
+        self.assertEqual(third['removed'], [])
+
+    def test_tombstones(self):
+        from ..change_log import CHANGE_SEQ_FIELD, DELETED_FIELD, change_sequence
+
+        synced = self.sync()
+        self.assertEqual(len(synced['changed']), 4)
+
+        with change_sequence(self.db) as seq:
+            self.db['events'].update({'title' : 'Event 1'}, {'$set' : {DELETED_FIELD : True, CHANGE_SEQ_FIELD : seq}})
+
+        update = self.sync(synced['next'])
+        self.assertEqual((update['changed'], update['removed']), ([], ['Event 1']))
+
+        # A first sync has nothing to remove
+        fresh = self.sync()
+        self.assertEqual((len(fresh['changed']), fresh['removed']), (3, []))
+
+    def test_unkeyed_events_synced_by_id(self):
+        from ..change_log import CHANGE_SEQ_FIELD, DELETED_FIELD, UNKEYED_PREFIX, change_sequence
+
+        with change_sequence(self.db) as seq:
+            event_id = self.db['events'].insert({'title' : 'From before keys', CHANGE_SEQ_FIELD : seq})
+        synced = self.sync()
+        self.assertEqual([e['event_key'] for e in synced['changed'] if e['title'] == 'From before keys'],
+                         [UNKEYED_PREFIX + str(event_id)])
+
+        with change_sequence(self.db) as seq:
+            self.db['events'].update({'_id' : event_id}, {'$set' : {DELETED_FIELD : True, CHANGE_SEQ_FIELD : seq}})
+        self.assertEqual(self.sync(synced['next'])['removed'], [UNKEYED_PREFIX + str(event_id)])
+
+
+class BuildingLocationTests(unittest.TestCase):
+    def test_read_buildings_file(self):
+        import os
+        import tempfile
+        from ..add_buildings_to_db import read_buildings_file
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('Myers Hall\n')
+            f.write('Weitz Center for Creativity\t44.4584,-93.1569\n')
+        try:
+            buildings = read_buildings_file(f.name)
+        finally:
+            os.remove(f.name)
+
+        self.assertEqual(buildings, [
+            {'name' : 'Myers Hall', 'aliases' : []},
+            {'name' : 'Weitz Center for Creativity', 'aliases' : [],
+             'location' : {'type' : 'Point', 'coordinates' : [-93.1569, 44.4584]}},
+        ])
+
+    def test_distance(self):
+        from ..geo import distance_meters
+
+        self.assertEqual(distance_meters(44.46, -93.15, 44.46, -93.15), 0)
+        # A thousandth of a degree of latitude is about 111 meters
+        self.assertAlmostEqual(distance_meters(44.460, -93.15, 44.461, -93.15), 111.2, places=1)
+
+
+class MatchEvaluatorTests(unittest.TestCase):
+    def test_report(self):
+        from ..match_evaluator import evaluate_matcher, load_labeled_locations
+
+        building_dicts = [
+            {'name' : 'Center for Math and Computing', 'aliases' : ['CMC']},
+            {'name' : 'Weitz Center for Creativity', 'aliases' : []},
+            {'name' : 'Myers Hall', 'aliases' : []},
+        ]
+        labeled = [
+            ('CMC 206', 'Center for Math and Computing'),
+            ('Weitz Center 236', 'Weitz Center for Creativity'),
+            ('Concert Hall, Weitz Center', 'Weitz Center for Creativity'),
+        ]
+        results = evaluate_matcher(building_dicts, labeled, repeat=2)
+
+        self.assertEqual(results['correct'], 2)
+        self.assertEqual(results['match']['count'], 6)
+        self.assertEqual(results['confusions'], [{'expected' : 'Weitz Center for Creativity', 'matched' : 'Myers Hall',
+                                                  'count' : 1, 'locations' : ['Concert Hall, Weitz Center']}])
+        self.assertTrue(len(load_labeled_locations()) > 0)
+
+
+class ScrapeDaemonTests(MockMongoTestCase):
+    def test_near_and_requested_dates_refresh_more_often(self):
+        from ..scrape_daemon import refresh_interval
+
+        intervals = [refresh_interval(days_ahead) for days_ahead in range(14)]
+
+        self.assertEqual(intervals, sorted(intervals))
+        self.assertTrue(intervals[0] < intervals[-1])
+        self.assertEqual(refresh_interval(13, requested=True), intervals[0])
+
+    def test_demand_buffered_until_flush(self):
+        import datetime
+        from ..scrape_daemon import DemandRecorder
+
+        db = self.mock_db()
+
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        demand = DemandRecorder(flush_interval=3600)
+        demand.add(db, today, today + datetime.timedelta(days=1))
+        demand.add(db, today - datetime.timedelta(days=3), today)
+        self.assertEqual(len(list(db['scrape_dates'].find())), 0)
+
+        demand.flush(db)
+        self.assertEqual(sorted(doc['date'] for doc in db['scrape_dates'].find()),
+                         [today.date().isoformat(), (today + datetime.timedelta(days=1)).date().isoformat()])
+        self.assertEqual(demand.dates, set())
+
+    def test_failed_date_pages_not_saved_with_next_date(self):
+        import datetime
+        from unittest import mock
+        from ..event_db_updater import BulkEventWriter
+        from ..event_scraper import BASE_EVENTS_URL, EventScraper
+        from ..page_store import PageStore
+        from ..scrape_daemon import ScrapeDaemon
+        from ..scraper_benchmark import FixtureSession, load_building_dicts
+
+        db = self.mock_db()
+        scraper = EventScraper(load_building_dicts(), session=FixtureSession(), page_store=PageStore(db))
+        flush = BulkEventWriter.flush
+        flushes = []
+
+        def flaky_flush(writer):
+            flushes.append(writer)
+            if len(flushes) == 1:
+                raise RuntimeError('Write failed')
+            return flush(writer)
+
+        daemon = ScrapeDaemon(db, days_ahead=2, workers=1)
+        with mock.patch('carltour.scrape_daemon.make_scraper', return_value=scraper), \
+                mock.patch.object(BulkEventWriter, 'flush', flaky_flush):
+            scraped = daemon.run_once(datetime.datetime(2014, 5, 21, 12))
+
+        self.assertEqual([d for d, counts in scraped], [datetime.date(2014, 5, 22)])
+
+        def saved_event_pages(d):
+            return list(db['scraped_pages'].find({'date' : d.isoformat(), 'url' : {'$ne' : BASE_EVENTS_URL}}))
+
+        # The failed date's events were never written, so its pages have to be parsed again
+        self.assertEqual(saved_event_pages(datetime.date(2014, 5, 21)), [])
+        self.assertTrue(len(saved_event_pages(datetime.date(2014, 5, 22))) > 0)
+
+
+class MetricsTests(MockMongoTestCase):
+    def test_route_latencies_and_mongo_stats(self):
+        from ..metrics import Metrics, MongoStats
+
+        metrics = Metrics()
+        mongo_stats = MongoStats()
+        mongo_stats.add('events', 40, 3.0)
+        mongo_stats.add('versions', 1, 0.5)
+
+        for ms in [3, 4, 30, 700]:
+            metrics.record_request('upcoming_events', 200, ms / 1000.0, mongo_stats)
+        metrics.record_request('upcoming_events', 500, 0.001, MongoStats())
+
+        route = metrics.snapshot()['routes']['upcoming_events']
+        self.assertEqual(route['count'], 5)
+        self.assertEqual(route['errors'], 1)
+        self.assertEqual(route['p50_ms'], 5)
+        self.assertEqual(route['p99_ms'], 1000)
+        self.assertEqual(route['mongo'], {'commands' : 8, 'documents' : 164, 'ms' : 14.0})
+
+    def test_timed_database(self):
+        from ..metrics import Metrics, MongoStats, TimedDatabase, _current
+
+        metrics = Metrics()
+        db = TimedDatabase(self.mock_db(), metrics)
+
+        _current.mongo_stats = MongoStats()
+        self.addCleanup(setattr, _current, 'mongo_stats', None)
+
+        db['events'].insert([{'title' : 'Event %i' % i} for i in range(5)])
+        self.assertEqual(len(list(db['events'].find().sort('title').limit(3))), 3)
+        self.assertEqual(db['events'].find_one({'title' : 'Event 1'})['title'], 'Event 1')
+        bulk = db['events'].initialize_unordered_bulk_op()
+        bulk.find({'title' : 'Event 1'}).update({'$set' : {'building' : 'Myers Hall'}})
+        bulk.execute()
+        db['events'].database['versions'].find_one({'_id' : 'events'})
+
+        events = metrics.snapshot()['collections']['events']
+        self.assertEqual((events['commands'], events['documents']), (4, 5 + 3 + 1 + 1))
+        self.assertEqual(metrics.snapshot()['collections']['versions']['documents'], 0)
+        self.assertEqual(_current.mongo_stats.totals()['commands'], 5)
+
+
+class PageArchiveTests(unittest.TestCase):
+    def test_replay_matches_scrape(self):
+        import datetime
+        import os
+        import tempfile
+        from ..event_scraper import EventScraper
+        from ..page_archive import PageArchive
+        from ..scraper_benchmark import FixtureSession, load_building_dicts
+
+        start = datetime.date(2014, 5, 21)
+        end = datetime.date(2014, 5, 22)
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            archive = PageArchive(archive_dir)
+            scraped = EventScraper(load_building_dicts(), session=FixtureSession(), workers=4,
+                page_archive=archive).get_events_for_dates(start, end)
+
+            # Both days have the same listing and event pages, so each is only stored once
+            objects = [f for d, dirs, files in os.walk(archive.objects_dir) for f in files]
+            self.assertEqual(len(objects), 6)
+
+            replayed = list(EventScraper(load_building_dicts(), session=object()).replay_events(archive, start, end))
+
+        self.assertEqual(len(scraped), 8)
+        self.assertEqual(scraped, replayed)
+
+
+class EventIntervalIndexTests(MockMongoTestCase):
+    def test_find_matches_overlap_scan(self):
+        import datetime
+        import random
+        from bson.objectid import ObjectId
+        from ..event_index import EventIntervalIndex
+
+        rand = random.Random(2)
+        start = datetime.datetime(2014, 5, 21)
+        events = []
+        for i in range(300):
+            event_start = start + datetime.timedelta(minutes=rand.randint(0, 14 * 24 * 60))
+            events.append({
+                '_id' : ObjectId(),
+                'start_datetime' : event_start,
+                'end_datetime' : event_start + datetime.timedelta(minutes=rand.choice([0, 30, 60, 600, 3000])),
+            })
+        events.sort(key=lambda e: (e['start_datetime'], e['_id']))
+
+        index = EventIntervalIndex()
+        index.snapshot = index._make_snapshot(start, start + datetime.timedelta(days=14), 1, 0, events)
+
+        for hours in range(0, 14 * 24, 13):
+            first = start + datetime.timedelta(hours=hours)
+            final = first + datetime.timedelta(hours=48)
+            expected = [e for e in events if e['start_datetime'] <= final and e['end_datetime'] >= first]
+            self.assertEqual(index.find(first, final), expected)
+
+    def test_merge_picks_up_slow_writes(self):
+        import datetime
+        from ..change_log import CHANGE_SEQ_FIELD, finish_sequence, reserve_sequence
+        from ..event_index import MODIFIED_FIELD, EventIntervalIndex
+
+        db = self.mock_db()
+        now = datetime.datetime(2014, 5, 21, 12)
+        index = EventIntervalIndex()
+        index.refresh(db, 0, now)
+
+        def write(title, seq, modified_at):
+            db['events'].insert({'title' : title, 'start_datetime' : now, 'end_datetime' : now + datetime.timedelta(hours=1),
+                                 MODIFIED_FIELD : modified_at, CHANGE_SEQ_FIELD : seq})
+            finish_sequence(db, seq)
+
+        # A scrape stamps its batch first, but a quicker alias fix lands before it
+        slow = reserve_sequence(db)
+        quick = reserve_sequence(db)
+        write('Quick', quick, now + datetime.timedelta(minutes=1))
+        index.refresh(db, 1, now)
+        self.assertEqual(index.find(now, now), [])
+
+        write('Slow', slow, now)
+        index.refresh(db, 2, now)
+        self.assertEqual(sorted(e['title'] for e in index.find(now, now)), ['Quick', 'Slow'])
+
+
+class LoadTestTests(MockMongoTestCase):
+    def test_seeded_requests_repeat(self):
+        from .load_harness import make_requests, seed_db
+
+        db = self.mock_db()
+        data = seed_db(db, events=200, days=10, seed=3)
+        self.assertEqual(len(list(db['events'].find())), 200)
+
+        # Same seed, same requests, so runs can be compared
+        for scenario in ['upcoming_events', 'events_view', 'update_building_alias']:
+            self.assertEqual(make_requests(scenario, data, 20, seed=3), make_requests(scenario, data, 20, seed=3))
+
+        first_dates = set(params['start_date'] for method, path, params in make_requests('upcoming_events', data, 50))
+        self.assertTrue(len(first_dates) > 1)
+
+    def test_requests_through_app(self):
+        import json
+        from webob import Request
+        from .load_harness import SCENARIOS, InProcessClient, make_app, make_requests, seed_db
+
+        self.skip_without_mongomock()
+        app, db = make_app()
+        data = seed_db(db, events=100, days=5, seed=1)
+        client = InProcessClient(app)
+
+        for scenario in SCENARIOS:
+            for method, path, params in make_requests(scenario, data, 3, seed=1):
+                self.assertEqual(client.send(method, path, params), 200, (scenario, params))
+        app.registry.reresolve_jobs.wait()
+
+        # Events come back in full from the seeded DB
+        first_date = data['first_date'].isoformat()
+        response = Request.blank('/api/v1.0/events?start_date=%s&end_date=2099-01-01' % first_date).get_response(app)
+        events = json.loads(response.body.decode('utf-8'))['events']
+        self.assertEqual(len(events), 100)
+        self.assertTrue(all('title' in e and 'building' in e for e in events))
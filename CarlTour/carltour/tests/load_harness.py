@@ -0,0 +1,390 @@
+# Load test of the whole app (carltour:main): seeds a Mongo stand-in with
+# synthetic buildings and events, then drives upcoming_events, events_view and
+# update_building_alias at the concurrency levels asked for, and reports
+# throughput, p50/p95/p99 latency and memory for each.
+#
+# The stand-in is mongomock by default (through carltour.tests.mock_mongo, which lets
+# it take the pymongo 2.x calls the app makes), or a local mongod with
+# --mongo-uri (its events, buildings and bookkeeping collections are dropped and
+# re-seeded, so point it at a scratch DB). Requests go straight to the WSGI app in this
+# process, or through waitress over HTTP with --waitress.
+#
+# Synthetic data and request mixes come from --seed, so runs with the same
+# arguments send the same requests and can be compared before and after a change.
+# Each run starts with an empty response cache; alias fixes stay in the DB.
+# add_building_alias also adds aliases, and the re-resolution jobs those start
+# in the background are waited for (and timed) after each run.
+#
+# Needs the packages in requirements-dev.txt. Run from the CarlTour directory:
+#     python -m carltour.tests.load_harness --events 100000 --concurrency 1,8,32
+#     python -m carltour.tests.load_harness --events 1000000 --mongo-uri mongodb://localhost/carltour_loadtest --waitress
+import argparse
+import datetime
+import gc
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from webob import Request
+
+import carltour
+from carltour.add_buildings_to_db import read_buildings_file
+from carltour.change_log import CHANGE_SEQ_FIELD, SEQUENCES_COLLECTION
+from carltour.event_db_updater import make_event_key
+from carltour.event_index import MODIFIED_FIELD
+from carltour.location_cache import LOCATIONS_COLLECTION
+from carltour.response_cache import ResponseCache, VERSIONS_COLLECTION
+from carltour.scrape_daemon import SCRAPE_DATES_COLLECTION
+from carltour.scraper_benchmark import BUILDINGS_FILE, summarize
+
+from carltour.tests.mock_mongo import MockMongoClient, mongomock
+
+try:
+    import requests
+    import waitress
+except ImportError:
+    waitress = None
+
+# Peak memory; Unix only
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SCRATCH_DB = 'carltour_loadtest'
+
+SEED_BATCH_SIZE = 10000
+
+# Campus center, the synthetic buildings are scattered around it
+CAMPUS_LAT = 44.4615
+CAMPUS_LNG = -93.1545
+
+def seed_db(db, events=10000, days=30, buildings_file=BUILDINGS_FILE, seed=0):
+    '''
+    Replace the events and buildings in <db> with <events> synthetic events
+    spread over <days> days from yesterday, held in the buildings of
+    <buildings_file>. The same <seed> makes the same data (relative to today).
+    Returns a dictionary describing the data, for make_requests
+    '''
+    rand = random.Random(seed)
+
+    for collection_name in ['events', 'buildings', LOCATIONS_COLLECTION, VERSIONS_COLLECTION,
+                            SEQUENCES_COLLECTION, SCRAPE_DATES_COLLECTION]:
+        db[collection_name].drop()
+
+    building_dicts = read_buildings_file(buildings_file)
+    for b_dict in building_dicts:
+        if 'location' not in b_dict:
+            b_dict['location'] = {'type' : 'Point', 'coordinates' : [
+                CAMPUS_LNG + rand.uniform(-.004, .004), CAMPUS_LAT + rand.uniform(-.003, .003)]}
+    db['buildings'].insert(building_dicts)
+    names = [b['name'] for b in building_dicts]
+
+    first_date = datetime.date.today() - datetime.timedelta(days=1)
+    first_datetime = datetime.datetime.combine(first_date, datetime.time())
+    now = datetime.datetime.utcnow()
+    locations = []
+
+    batch = []
+    for i in range(events):
+        building = rand.choice(names)
+        start = first_datetime + datetime.timedelta(days=rand.randrange(days), hours=rand.randint(8, 21),
+            minutes=rand.choice([0, 15, 30, 45]))
+        full_location = '%s %i' % (building, rand.randint(100, 400))
+        if i < 1000:
+            locations.append((full_location, building))
+
+        event = {
+            'title' : 'Synthetic event %i' % i,
+            'description' : 'Load test event %i. ' % i * rand.randint(1, 10),
+            'building' : building,
+            'full_location' : full_location,
+            'start_datetime' : start,
+            'end_datetime' : start + datetime.timedelta(minutes=rand.choice([30, 60, 90, 120, 180])),
+            'event_url' : 'https://apps.carleton.edu/calendar/?event_id=%i' % i,
+            'match_score' : rand.randint(50, 100),
+            'matched_alias' : building,
+            'match_margin' : rand.randint(0, 50),
+        }
+        event['event_key'] = make_event_key(event)
+        event[MODIFIED_FIELD] = now
+        event[CHANGE_SEQ_FIELD] = 1
+        batch.append(event)
+
+        if len(batch) == SEED_BATCH_SIZE:
+            db['events'].insert(batch)
+            batch = []
+    if len(batch) > 0:
+        db['events'].insert(batch)
+
+    return {'first_date' : first_date, 'days' : days, 'buildings' : names, 'locations' : locations}
+
+def upcoming_events_request(rand, data):
+    start = data['first_date'] + datetime.timedelta(days=rand.randrange(data['days']))
+    end = start + datetime.timedelta(days=rand.choice([1, 2]))
+    return 'GET', '/api/v1.0/events', {'start_date' : start.isoformat(), 'end_date' : end.isoformat()}
+
+def events_view_request(rand, data):
+    start = data['first_date'] + datetime.timedelta(days=rand.randrange(data['days']))
+    params = {'start_date' : start.isoformat(), 'end_date' : start.isoformat()}
+    if rand.random() < .5:
+        params['building'] = rand.choice(data['buildings'])
+    return 'GET', '/events', params
+
+def update_building_alias_request(rand, data):
+    # Without new_alias, so no re-resolution jobs run in the background
+    full_location, building = rand.choice(data['locations'])
+    return 'POST', '/api/v1.0/update_building_alias', {
+        'full_location' : full_location,
+        'old_location' : building,
+        'new_location' : rand.choice(data['buildings'])
+    }
+
+def add_building_alias_request(rand, data):
+    # With the location as the new alias, like fixes made on the review page, so
+    # remembered matches are invalidated and a re-resolution job is started
+    method, path, params = update_building_alias_request(rand, data)
+    params['new_alias'] = params['full_location']
+    return method, path, params
+
+# scenario name -> function of (random.Random, seeded data) making one (method, path, params)
+SCENARIOS = OrderedDict([
+    ('upcoming_events', upcoming_events_request),
+    ('events_view', events_view_request),
+    ('update_building_alias', update_building_alias_request),
+    ('add_building_alias', add_building_alias_request),
+])
+
+def make_requests(scenario, data, count, seed=0):
+    rand = random.Random('%s %s' % (scenario, seed))
+    return [SCENARIOS[scenario](rand, data) for i in range(count)]
+
+class InProcessClient:
+    '''
+    Sends requests straight to the WSGI <app>, without a server in between
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    def send(self, method, path, params):
+        if method == 'GET':
+            request = Request.blank(path + '?' + urlencode(params))
+        else:
+            request = Request.blank(path, POST=params)
+        return request.get_response(self.app).status_int
+
+    def close(self):
+        pass
+
+class WaitressClient:
+    '''
+    Serves <app> with waitress (with <threads> threads) on a free local port,
+    and sends requests to it over HTTP, one connection per sending thread
+    '''
+
+    def __init__(self, app, threads):
+        self.server = waitress.create_server(app, host='127.0.0.1', port=0, threads=threads)
+        self.base_url = 'http://127.0.0.1:%s' % self.server.effective_port
+        self.sessions = threading.local()
+
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+
+    def send(self, method, path, params):
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+
+        if method == 'GET':
+            response = session.get(self.base_url + path, params=params)
+        else:
+            response = session.post(self.base_url + path, data=params)
+        return response.status_code
+
+    def close(self):
+        self.server.close()
+
+def memory_mb():
+    '''
+    Returns (current, peak) resident memory of this process in MB. Either is
+    None where it can't be found out
+    '''
+    current = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2.0 ** 20
+    except (IOError, OSError, ValueError):
+        pass
+
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        peak = peak / 2.0 ** 20 if peak > 2 ** 32 else peak / 2.0 ** 10
+        # The two are counted differently, and the peak shouldn't read below the current
+        if current is not None:
+            peak = max(peak, current)
+
+    return current, peak
+
+def run_scenario(client, request_list, concurrency, warmup=0):
+    '''
+    Sends the first <warmup> of <request_list> one at a time, then the rest from
+    <concurrency> threads. Returns throughput, latency and memory of the rest
+    '''
+    for method, path, params in request_list[:warmup]:
+        client.send(method, path, params)
+    timed_requests = request_list[warmup:]
+
+    def timed_send(req):
+        start = time.perf_counter()
+        status = client.send(*req)
+        return time.perf_counter() - start, status
+
+    gc.collect()
+    memory_before, _ = memory_mb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_send, timed_requests))
+    elapsed = time.perf_counter() - start
+    memory_after, memory_peak = memory_mb()
+
+    latencies = [r[0] for r in results]
+    return dict(summarize(latencies),
+        concurrency=concurrency,
+        errors=sum(1 for r in results if r[1] >= 400),
+        seconds=elapsed,
+        requests_per_second=len(results) / elapsed if elapsed > 0 else 0,
+        rss_mb=memory_after,
+        rss_growth_mb=None if memory_before is None else memory_after - memory_before,
+        peak_rss_mb=memory_peak)
+
+def make_app(mongo_uri=None, event_index=True):
+    '''
+    The app as carltour:main makes it, on a mongod at <mongo_uri>, or on a fresh
+    mongomock DB if None. Returns (app, db)
+    '''
+    settings = {
+        'mongo_uri' : mongo_uri or 'mongodb://localhost/%s' % SCRATCH_DB,
+        'carltour.event_index' : 'true' if event_index else 'false',
+        # Seeding drops the collections, so indexes are made after it
+        'carltour.ensure_indexes' : 'false',
+    }
+
+    if mongo_uri is not None:
+        app = carltour.main({}, **settings)
+    else:
+        if mongomock is None:
+            raise RuntimeError('mongomock is not installed; pass --mongo-uri to use a local mongod')
+        # main() connects with carltour.MongoClient; have it make a mongomock client instead
+        mongo_client = carltour.MongoClient
+        carltour.MongoClient = MockMongoClient
+        try:
+            app = carltour.main({}, **settings)
+        finally:
+            carltour.MongoClient = mongo_client
+
+    db_name = settings['mongo_uri'].rsplit('/', 1)[1]
+    return app, app.registry.db[db_name]
+
+def run_load_test(events=10000, days=30, scenarios=list(SCENARIOS), concurrency_levels=[1, 8], requests_per_run=500,
+                  warmup=50, mongo_uri=None, use_waitress=False, event_index=True, response_cache=True, seed=0):
+    '''
+    Seeds the DB (see seed_db), then runs each of <scenarios> at each of
+    <concurrency_levels> with <requests_per_run> requests. Returns a dictionary of results
+    '''
+    app, db = make_app(mongo_uri, event_index)
+
+    start = time.perf_counter()
+    data = seed_db(db, events, days, seed=seed)
+    seed_seconds = time.perf_counter() - start
+    if mongo_uri is not None:
+        from carltour.indexes import ensure_indexes
+        ensure_indexes(db)
+
+    if use_waitress:
+        if waitress is None:
+            raise RuntimeError('--waitress needs waitress and requests installed')
+        client = WaitressClient(app, max(concurrency_levels))
+    else:
+        client = InProcessClient(app)
+
+    runs = []
+    try:
+        for scenario in scenarios:
+            request_list = make_requests(scenario, data, warmup + requests_per_run, seed)
+            for concurrency in concurrency_levels:
+                # Every run starts from an empty cache, so earlier runs don't warm it up for later ones
+                app.registry.events_cache = ResponseCache() if response_cache else ResponseCache(max_size=0)
+                result = run_scenario(client, request_list, concurrency, warmup)
+
+                # Re-resolution jobs started by alias fixes finish in the background
+                start = time.perf_counter()
+                app.registry.reresolve_jobs.wait()
+                runs.append(dict(result, scenario=scenario, reresolve_seconds=time.perf_counter() - start))
+    finally:
+        client.close()
+
+    return {
+        'events' : events,
+        'days' : days,
+        'buildings' : len(data['buildings']),
+        'backend' : 'mongod' if mongo_uri is not None else 'mongomock',
+        'server' : 'waitress' if use_waitress else 'in-process',
+        'event_index' : event_index,
+        'response_cache' : response_cache,
+        'seed' : seed,
+        'seed_seconds' : seed_seconds,
+        'runs' : runs,
+    }
+
+def print_report(results):
+    print('%(events)i events over %(days)i days, %(buildings)i buildings, on %(backend)s, %(server)s '
+          '(seeded in %(seed_seconds).1fs)' % results)
+    print('event_index=%(event_index)s response_cache=%(response_cache)s seed=%(seed)i' % results)
+    print()
+    print('%-22s %5s %8s %7s %9s %9s %9s %9s %8s %8s %11s' % ('scenario', 'conc', 'requests', 'errors', 'req/s',
+        'p50 ms', 'p95 ms', 'p99 ms', 'rss MB', 'peak MB', 'reresolve s'))
+
+    for r in results['runs']:
+        print('%-22s %5i %8i %7i %9.1f %9.2f %9.2f %9.2f %8s %8s %11.2f' % (r['scenario'], r['concurrency'], r['count'],
+            r['errors'], r['requests_per_second'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            '-' if r['rss_mb'] is None else '%.1f' % r['rss_mb'],
+            '-' if r['peak_rss_mb'] is None else '%.1f' % r['peak_rss_mb'], r['reresolve_seconds']))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Load test the app against a seeded Mongo stand-in')
+    arg_parser.add_argument('--events', type=int, default=10000, help='synthetic events to seed')
+    arg_parser.add_argument('--days', type=int, default=30, help='days the events are spread over')
+    arg_parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated, from: %s' % ', '.join(SCENARIOS))
+    arg_parser.add_argument('--concurrency', default='1,8', help='comma separated numbers of concurrent clients')
+    arg_parser.add_argument('--requests', type=int, default=500, help='timed requests per scenario and concurrency')
+    arg_parser.add_argument('--warmup', type=int, default=50, help='untimed requests sent first')
+    arg_parser.add_argument('--mongo-uri', help='scratch DB on a local mongod to use instead of mongomock')
+    arg_parser.add_argument('--waitress', action='store_true', help='send requests over HTTP to waitress')
+    arg_parser.add_argument('--no-event-index', action='store_true', help='turn off carltour.event_index')
+    arg_parser.add_argument('--no-response-cache', action='store_true', help="don't cache rendered event responses")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = arg_parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    for s in scenarios:
+        if s not in SCENARIOS:
+            arg_parser.error('Unknown scenario %s' % s)
+
+    results = run_load_test(args.events, args.days, scenarios, [int(c) for c in args.concurrency.split(',')],
+        args.requests, args.warmup, args.mongo_uri, args.waitress, not args.no_event_index,
+        not args.no_response_cache, args.seed)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_report(results)
@@ -0,0 +1,81 @@
+# In-memory stand-in for a mongod, for the load test and the tests. Needs the
+# mongomock pinned in requirements-dev.txt.
+#
+# The app is written against pymongo 2.x (find(spec=..., fields=...),
+# find_one(spec_or_id, fields=...)). mongomock only has bulk operations from 3.x
+# on, and 3.x only takes the pymongo 3 names, filter and projection. Those come
+# in the same order, so the wrappers here pass them on positionally. Everything
+# else (insert, update, remove, bulk ops, ...) goes straight to mongomock, which
+# falls back to its own copies of the pymongo 3 classes it can't import from
+# pymongo 2.7.
+#
+# mongomock isn't safe to use from several threads, so every call into it (and
+# every iteration of one of its cursors) holds a lock shared by the whole client.
+# Concurrent requests against it are served one DB operation at a time.
+import threading
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+class _Locked:
+    '''
+    Proxy calling the methods of the mongomock object <obj> with <lock> held.
+    Cursors and bulk operations they return are wrapped the same way
+    '''
+
+    def __init__(self, obj, lock):
+        self._obj = obj
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def locked_call(*args, **kwargs):
+            with self._lock:
+                return self._wrap(attr(*args, **kwargs))
+        return locked_call
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._obj))
+
+    def _wrap(self, result):
+        if type(result).__module__.startswith('mongomock'):
+            return _Locked(result, self._lock)
+        return result
+
+class MockMongoClient:
+    '''
+    Takes the place of pymongo.MongoClient. Connection options are ignored
+    '''
+
+    def __init__(self, host=None, **kwargs):
+        self.client = mongomock.MongoClient()
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name):
+        return MockDatabase(self.client[name], self.lock)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+class MockDatabase(_Locked):
+    def __getitem__(self, name):
+        return MockCollection(self._obj[name], self._lock)
+
+class MockCollection(_Locked):
+    @property
+    def database(self):
+        return MockDatabase(self._obj.database, self._lock)
+
+    def find(self, spec=None, fields=None, **kwargs):
+        with self._lock:
+            return _Locked(self._obj.find(spec, fields, **kwargs), self._lock)
+
+    def find_one(self, spec_or_id=None, fields=None, **kwargs):
+        with self._lock:
+            return self._obj.find_one(spec_or_id, fields, **kwargs)
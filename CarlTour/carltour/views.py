@@ -1,24 +1,260 @@
 from pyramid.view import view_defaults
 from pyramid.view import view_config
+from pyramid.renderers import render
+from pyramid.settings import asbool
+from pyramid.httpexceptions import HTTPBadRequest
+from pymongo import ASCENDING
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+import base64
+import binascii
 import datetime
+import json
 import logging
 
+from collections import OrderedDict
+
+from carltour.building_matcher import LOW_SCORE_THRESHOLD
+from carltour.change_log import CHANGE_SEQ_FIELD, DELETED_FIELD, change_sequence, settled_sequence, sync_key
+from carltour.event_index import MODIFIED_FIELD, project_event
+from carltour.geo import nearest_buildings
+from carltour.location_cache import invalidate_locations_for_aliases
+from carltour.reresolve import ReresolveJob
+
 log = logging.getLogger(__name__)
 
 DEFAULT_TIME_DELTA = 48
 
+# Events shown per page of EventViewer
+EVENTS_PAGE_SIZE = 50
+
+# How many streamed events are joined into one chunk of the response
+STREAM_CHUNK_SIZE = 100
+
+# Most changes EventsSyncAPI returns at once
+SYNC_PAGE_SIZE = 500
+
+# Meters around the point a "near" query looks, by default and at most
+DEFAULT_NEAR_RADIUS = 400
+MAX_NEAR_RADIUS = 5000
+
+def make_window_spec(first_requested_datetime, final_requested_datetime):
+    '''
+    Query for events overlapping the window between <first_requested_datetime> and
+    <final_requested_datetime>. Served by the (start_datetime, end_datetime) index
+    that carltour.indexes sets up
+    '''
+    return {
+        "$and" : [
+            # Event starts before last desired time
+            {"start_datetime" : {"$lte": final_requested_datetime}},
+            # Event ends after first desired time
+            {"end_datetime": {"$gte" : first_requested_datetime}},
+            # Events no longer listed are only kept for EventsSyncAPI
+            {DELETED_FIELD : {"$ne" : True}}
+        ]
+    }
+
+def encode_page_token(event):
+    '''
+    Opaque token pointing just past <event> (which has _id and start_datetime)
+    in events sorted by (start_datetime, _id)
+    '''
+    token = json.dumps([event['start_datetime'].isoformat(), str(event['_id'])])
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+def decode_page_token(token):
+    '''
+    Returns the (start_datetime, _id) that <token> points past.
+    Raises ValueError if it isn't a token encode_page_token made
+    '''
+    try:
+        start, event_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (TypeError, binascii.Error, UnicodeError) as e:
+        raise ValueError(str(e))
+
+    # Anyone can send us a token, so it may hold anything JSON can
+    if not isinstance(start, str) or not isinstance(event_id, str):
+        raise ValueError('Bad page token %r' % token)
+    try:
+        event_id = ObjectId(event_id)
+    except InvalidId as e:
+        raise ValueError(str(e))
+
+    # isoformat() leaves off the microseconds when there aren't any
+    time_format = '%Y-%m-%dT%H:%M:%S.%f' if '.' in start else '%Y-%m-%dT%H:%M:%S'
+    return datetime.datetime.strptime(start, time_format), event_id
+
+def encode_sync_token(seq, event_id):
+    '''
+    Opaque token pointing just past the event with <event_id> among those changed
+    by <seq>, in events sorted by (change_seq, _id). With no <event_id>, it
+    points past every change up to <seq>
+    '''
+    token = json.dumps([seq, None if event_id is None else str(event_id)])
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+def decode_sync_token(token):
+    '''
+    Returns the (change_seq, _id or None) that <token> points past.
+    Raises ValueError if it isn't a token encode_sync_token made
+    '''
+    try:
+        seq, event_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (TypeError, binascii.Error, UnicodeError) as e:
+        raise ValueError(str(e))
+
+    # Anyone can send us a token, so it may hold anything JSON can (and
+    # True and False are ints too)
+    if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+        raise ValueError('Bad sequence number %r' % seq)
+    if event_id is not None and not isinstance(event_id, str):
+        raise ValueError('Bad sync token %r' % token)
+    if event_id is not None:
+        try:
+            event_id = ObjectId(event_id)
+        except InvalidId as e:
+            raise ValueError(str(e))
+
+    return seq, event_id
+
+def next_page_token(page, limit):
+    '''
+    The token for the page after <page> (a list of events still carrying their
+    _id and start_datetime), or None if it was the last one
+    '''
+    if len(page) < limit:
+        return None
+    return encode_page_token(page[-1])
+
+def strip_paging_fields(event, fields):
+    '''
+    Paged queries need _id and start_datetime for the 'next' token, but only
+    the fields asked for are returned
+    '''
+    if '_id' not in event:
+        return event
+
+    event = dict(event)
+    del event['_id']
+    if fields is not None and 'start_datetime' not in fields:
+        del event['start_datetime']
+
+    return event
+
+def stream_events(cursor, fields, limit):
+    '''
+    Generator writing out the same JSON UpcomingEventsAPI would render, one chunk
+    of events at a time as <cursor> yields them
+    '''
+    yield b'{"events": ['
+
+    prefix = ''
+    chunk = []
+    page = []
+    for e in cursor:
+        if limit is not None:
+            page.append(e)
+        chunk.append(json.dumps(strip_paging_fields(e, fields), default=json_default))
+
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield (prefix + ', '.join(chunk)).encode('utf-8')
+            prefix = ', '
+            chunk = []
+
+    tail = prefix + ', '.join(chunk) + ']' if len(chunk) > 0 else ']'
+    if limit is not None:
+        tail += ', "next": ' + json.dumps(next_page_token(page, limit))
+
+    yield (tail + '}').encode('utf-8')
+
+def json_default(obj):
+    '''
+    Same serialization as the app's json renderer (see carltour.main)
+    '''
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % obj)
+
 @view_defaults(route_name='upcoming_events')
 class UpcomingEventsAPI(object):
+    '''
+    Events overlapping a window (start_date/end_date, default: the next 48 hours).
+    Optional parameters:
+        fields: comma separated event fields to return, e.g. fields=title,building
+        limit: return at most this many events, plus a 'next' token for the next page
+        after: a 'next' token from a previous page
+        stream: if true, events are written out as they come back from Mongo
+                instead of building the whole response first (not cached)
+        near: latitude,longitude. Only events in the buildings nearest that point
+              are returned, nearest first, each with its 'distance' in meters
+        radius: how far (in meters) from <near> to look, default DEFAULT_NEAR_RADIUS
+    '''
     def __init__(self, request):
         self.request = request
 
-    @view_config(request_method='GET', renderer='json')
+    @view_config(request_method='GET')
     def get(self):
+        first_requested_datetime, final_requested_datetime = self._requested_window()
+        fields = self._requested_fields()
+        limit = self._requested_limit()
+        after = self.request.params.get('after')
+        stream = asbool(self.request.params.get('stream', False))
+        near = self._requested_near()
+
+        # Pages are ordered by start time, and near events by distance
+        if near is not None and (limit is not None or after is not None or stream):
+            raise HTTPBadRequest("near can't be combined with limit, after or stream")
+
+        # Rendered responses are cached until the events change (the updater and
+        # alias fixes bump the version), and sent with an ETag and Last-Modified
+        # so clients that already have them get a 304
+        cache = self.request.registry.events_cache
+        cache_key = (first_requested_datetime, final_requested_datetime, fields, limit, after, near)
+        version, last_modified = self.request.registry.events_version.get(self.request.db)
+        cached = None if stream else cache.get(cache_key, version)
+
+        response = self.request.response
+        response.content_type = 'application/json'
+
+        if cached is None:
+            # Has the scrape daemon keep these dates fresher. Only on misses, since
+            # the dates of a cached response have already been asked for
+            self.request.registry.demand.add(self.request.db, first_requested_datetime, final_requested_datetime)
+
+            if near is not None:
+                event_dict = {'events' : self._find_near_events(first_requested_datetime, final_requested_datetime,
+                    fields, version, near)}
+            else:
+                cursor = self._find_events(first_requested_datetime, final_requested_datetime, fields, limit, after, version)
+
+                if stream:
+                    response.app_iter = stream_events(cursor, fields, limit)
+                    return response
+
+                page = list(cursor)
+                event_dict = {'events' : [strip_paging_fields(e, fields) for e in page]}
+                if limit is not None:
+                    event_dict['next'] = next_page_token(page, limit)
+
+            body = render('json', event_dict, request=self.request).encode('utf-8')
+            cached = cache.set(cache_key, version, body, last_modified)
+
+        response.body = cached.body
+        response.etag = cached.etag
+        response.last_modified = cached.last_modified
+        response.conditional_response = True
+
+        return response
+
+    def _requested_window(self):
         start_date_arg = self.request.params.get('start_date')
         end_date_arg = self.request.params.get('end_date')
 
         if start_date_arg is None:
-            first_requested_datetime = datetime.datetime.now()
+            # Only down to the minute, so clients polling the default window
+            # within the same minute share a cached response
+            first_requested_datetime = datetime.datetime.now().replace(second=0, microsecond=0)
         else:
             first_requested_datetime = datetime.datetime.strptime(start_date_arg, '%Y-%m-%d')
         if end_date_arg is None:
@@ -26,19 +262,243 @@ class UpcomingEventsAPI(object):
         else:
             final_requested_datetime = datetime.datetime.strptime(end_date_arg, '%Y-%m-%d')
 
-        event_collection = self.request.db['events']
-        # Exclude the _id field, but return everything else
-        all_events = list(event_collection.find(fields={'_id' : False}, spec={
-            "$and" : [
-                # Event starts before last desired time
-                {"start_datetime" : {"$lte": final_requested_datetime}},
-                # Event ends after first desired time
-                {"end_datetime": {"$gte" : first_requested_datetime}}
-            ]
-        }))
-        
-        event_dict = {'events' : all_events}
-        return event_dict
+        return first_requested_datetime, final_requested_datetime
+
+    def _requested_fields(self):
+        '''
+        Returns a tuple of the fields asked for, or None for all of them
+        '''
+        fields_arg = self.request.params.get('fields')
+        if not fields_arg:
+            return None
+
+        return tuple(sorted(set(f.strip() for f in fields_arg.split(',') if f.strip())))
+
+    def _requested_limit(self):
+        limit_arg = self.request.params.get('limit')
+        if not limit_arg:
+            return None
+
+        try:
+            limit = int(limit_arg)
+        except ValueError:
+            raise HTTPBadRequest('limit must be a number')
+        if limit <= 0:
+            raise HTTPBadRequest('limit must be positive')
+
+        return limit
+
+    def _requested_near(self):
+        '''
+        Returns (latitude, longitude, radius in meters) of a near query, or None
+        '''
+        near_arg = self.request.params.get('near')
+        if not near_arg:
+            return None
+
+        try:
+            lat, lng = [float(c) for c in near_arg.split(',')]
+        except ValueError:
+            raise HTTPBadRequest('near must be latitude,longitude')
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            raise HTTPBadRequest('near is not a point on Earth')
+
+        try:
+            radius = float(self.request.params.get('radius') or DEFAULT_NEAR_RADIUS)
+        except ValueError:
+            raise HTTPBadRequest('radius must be a number')
+        if not 0 < radius <= MAX_NEAR_RADIUS:
+            raise HTTPBadRequest('radius must be between 0 and %i meters' % MAX_NEAR_RADIUS)
+
+        return lat, lng, radius
+
+    def _find_near_events(self, first_requested_datetime, final_requested_datetime, fields, version, near):
+        '''
+        The events in the window held in the buildings nearest <near> (see _requested_near),
+        sorted by distance and then start time, each with its 'distance' in meters
+        '''
+        lat, lng, radius = near
+        distances = nearest_buildings(self.request.db, lat, lng, radius)
+        if len(distances) == 0:
+            return []
+
+        # Sorting needs these, whether or not they were asked for
+        query_fields = None if fields is None else tuple(sorted(set(fields) | set(['building', 'start_datetime'])))
+        events = list(self._find_events(first_requested_datetime, final_requested_datetime, query_fields, None, None,
+            version, buildings=list(distances)))
+        events.sort(key=lambda e: (distances[e['building']], e['start_datetime']))
+
+        near_events = []
+        for e in events:
+            distance = round(distances[e['building']], 1)
+            if fields is not None:
+                e = dict((f, e[f]) for f in fields if f in e)
+            e['distance'] = distance
+            near_events.append(e)
+
+        return near_events
+
+    def _find_events(self, first_requested_datetime, final_requested_datetime, fields, limit, after, version,
+                     buildings=None):
+        '''
+        Returns a cursor (or list) over the events in the window. Paged requests come back
+        ordered by (start_datetime, _id), which is what the 'next' token points into.
+        If <buildings> is given, only events in those buildings are returned.
+        Windows the in-memory event index (if the app has one) covers are answered
+        from it, after bringing it up to <version>
+        '''
+        paged = limit is not None or after is not None
+
+        if after is not None:
+            try:
+                last_start, last_id = decode_page_token(after)
+            except ValueError:
+                raise HTTPBadRequest('Bad after token')
+
+        event_index = getattr(self.request.registry, 'event_index', None)
+        if event_index is not None:
+            event_index.refresh(self.request.db, version)
+
+            if event_index.covers(first_requested_datetime, final_requested_datetime):
+                events = event_index.find(first_requested_datetime, final_requested_datetime)
+                if buildings is not None:
+                    building_set = set(buildings)
+                    events = [e for e in events if e.get('building') in building_set]
+                if after is not None:
+                    events = [e for e in events if (e['start_datetime'], e['_id']) > (last_start, last_id)]
+                if limit is not None:
+                    events = events[:limit]
+
+                return [project_event(e, fields, paged) for e in events]
+
+        spec = make_window_spec(first_requested_datetime, final_requested_datetime)
+
+        if buildings is not None:
+            spec = {'$and' : [spec, {'building' : {'$in' : buildings}}]}
+
+        if after is not None:
+            spec = {'$and' : [spec, {'$or' : [
+                {'start_datetime' : {'$gt' : last_start}},
+                {'start_datetime' : last_start, '_id' : {'$gt' : last_id}}
+            ]}]}
+
+        if fields is None:
+            # Exclude the _id field, but return everything else. Paged requests
+            # need the _id, and {'_id' : True} on its own would return only that
+            projection = None if paged else {'_id' : False}
+        else:
+            projection = dict((f, True) for f in fields)
+            projection['_id'] = paged
+            if paged:
+                projection['start_datetime'] = True
+
+        cursor = self.request.db['events'].find(fields=projection, spec=spec)
+        if paged:
+            cursor = cursor.sort([('start_datetime', ASCENDING), ('_id', ASCENDING)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        return cursor
+
+@view_defaults(route_name='events_sync', renderer='json')
+class EventsSyncAPI(object):
+    '''
+    What changed in the events since a client last synced, so it can keep its
+    own copy up to date instead of downloading every event again.
+    Optional parameters:
+        since: the 'next' token from the last sync. Without it, every event is returned
+        limit: return at most this many changes (default SYNC_PAGE_SIZE)
+        fields: as for UpcomingEventsAPI. event_key is always returned (see sync_key
+        for events stored before they had one)
+    Returns {'changed' : [events], 'removed' : [event_keys], 'next' : token, 'more' : bool}.
+    Clients should ask again with 'next' while 'more' is true, and keep it for next time
+    '''
+    def __init__(self, request):
+        self.request = request
+
+    @view_config(request_method='GET')
+    def get(self):
+        since = self.request.params.get('since')
+        # Same parameters as UpcomingEventsAPI's
+        events_api = UpcomingEventsAPI(self.request)
+        fields = events_api._requested_fields()
+        limit = events_api._requested_limit() or SYNC_PAGE_SIZE
+
+        last_seq, last_id = 0, None
+        if since:
+            try:
+                last_seq, last_id = decode_sync_token(since)
+            except ValueError:
+                raise HTTPBadRequest('Bad since token')
+
+        # Changes past a write still in progress are held back, or a client could
+        # skip over the events that write is about to stamp with a lower number
+        settled = settled_sequence(self.request.db)
+
+        if last_id is None:
+            position = {CHANGE_SEQ_FIELD : {'$gt' : last_seq}}
+        else:
+            position = {'$or' : [
+                {CHANGE_SEQ_FIELD : {'$gt' : last_seq}},
+                {CHANGE_SEQ_FIELD : last_seq, '_id' : {'$gt' : last_id}}
+            ]}
+        spec = {'$and' : [position, {CHANGE_SEQ_FIELD : {'$lte' : settled}}]}
+        if not since:
+            # A first sync has nothing to remove
+            spec['$and'].append({DELETED_FIELD : {'$ne' : True}})
+
+        projection = None
+        if fields is not None:
+            projection = dict((f, True) for f in fields)
+            projection.update({'event_key' : True, CHANGE_SEQ_FIELD : True, DELETED_FIELD : True})
+
+        # One more than asked for, to tell whether there are more
+        cursor = self.request.db['events'].find(fields=projection, spec=spec)
+        page = list(cursor.sort([(CHANGE_SEQ_FIELD, ASCENDING), ('_id', ASCENDING)]).limit(limit + 1))
+        more = len(page) > limit
+        page = page[:limit]
+
+        changed = []
+        removed = []
+        for e in page:
+            if e.get(DELETED_FIELD):
+                removed.append(sync_key(e))
+            else:
+                e = dict(e, event_key=sync_key(e))
+                del e['_id']
+                e.pop(DELETED_FIELD, None)
+                if fields is not None and CHANGE_SEQ_FIELD not in fields:
+                    del e[CHANGE_SEQ_FIELD]
+                changed.append(e)
+
+        if more:
+            next_token = encode_sync_token(page[-1][CHANGE_SEQ_FIELD], page[-1]['_id'])
+        else:
+            next_token = encode_sync_token(max(settled, last_seq), None)
+
+        return {'changed' : changed, 'removed' : removed, 'next' : next_token, 'more' : more}
+
+# What each alias correction posted to UpdateBuilding has
+CORRECTION_KEYS = ['full_location', 'old_location', 'new_location', 'new_alias']
+
+def check_correction(correction, known_buildings):
+    '''
+    Returns what's wrong with an alias <correction>, or None if it can be applied.
+    <known_buildings> are the building names it may set
+    '''
+    if not isinstance(correction, dict):
+        return 'Not an object'
+
+    for key in ['full_location', 'old_location', 'new_location']:
+        if not isinstance(correction.get(key), str):
+            return 'Missing %s' % key
+
+    if correction['new_location'] not in known_buildings:
+        return "Unknown building '%s'" % correction['new_location']
+    if not isinstance(correction.get('new_alias', ''), (str, type(None))):
+        return 'new_alias must be a string'
+
+    return None
 
 @view_defaults(renderer='json')
 class UpdateBuilding(object):
@@ -47,39 +507,151 @@ class UpdateBuilding(object):
 
     @view_config(request_method='POST', route_name='update_building_alias')
     def add_alias_to_building(self):
-        full_location = self.request.params.get('full_location')
-        old_location = self.request.params.get('old_location')
-        new_location = self.request.params.get('new_location')
-        alias = self.request.params.get('new_alias')
-        
+        correction = dict((key, self.request.params.get(key)) for key in CORRECTION_KEYS)
+        results, job_id = self.apply_corrections([correction])
+
+        if not results[0]['Success']:
+            self.request.response.status = 400
+            return results[0]
+
+        return {'Success' : 1, 'reresolve_job' : job_id}
+
+    @view_config(request_method='POST', route_name='update_building_aliases')
+    def add_aliases_to_buildings(self):
+        '''
+        Batch version of add_alias_to_building. The body is a JSON list of
+        {full_location, old_location, new_location, new_alias} corrections;
+        the response has a result for each, in the same order
+        '''
+        try:
+            corrections = self.request.json_body
+        except ValueError:
+            raise HTTPBadRequest('Body must be a JSON list of corrections')
+        if not isinstance(corrections, list):
+            raise HTTPBadRequest('Body must be a JSON list of corrections')
+
+        results, job_id = self.apply_corrections(corrections)
+
+        return {'results' : results, 'reresolve_job' : job_id}
+
+    def apply_corrections(self, corrections):
+        '''
+        For each correction (a dict of CORRECTION_KEYS): store the new (correct)
+        <new_location> as the building of every event with <full_location> and
+        <old_location>, and add <new_alias> (if any) to <new_location>'s aliases.
+        All of it goes to Mongo as one bulk write per collection.
+
+        Returns a result for each correction, and the id of the re-resolution job
+        started for the new aliases (None if there were none)
+        '''
         # (nj) we make this call a lot (since we're only using 2 collections)
         # is there a way to cache it? or just store it in request?
         building_collection = self.request.db['buildings']
         event_collection = self.request.db['events']
 
-        # Update any event with <full_location> and <old_location> to store the 
-        # new (correct) <new_location> as its building
-        event_updates = event_collection.update({'building' : old_location, 'full_location' : full_location}, {
-            '$set' : {
-                'building' : new_location
-            }
-        })
-
-        # Add an alias <alias> to the building document with name <new_location>
-        building_updates = building_collection.update({'name' : new_location}, {
-                '$addToSet' : {
-                    'aliases' : alias
-                }
-            }
-        )
-        log.debug("Set official location to '%s' for '%s' (previous/incorrect location: '%s').", 
-            new_location, full_location, old_location)
-        log.debug("Added alias: '%s' for '%s'", alias, new_location)
-        
-        return {'Success' : 1}
+        new_locations = set(c.get('new_location') for c in corrections if isinstance(c, dict))
+        known_buildings = set(b['name'] for b in building_collection.find(
+            spec={'name' : {'$in' : list(new_locations)}}, fields={'name' : True, '_id' : False}))
+
+        results = []
+        now = datetime.datetime.utcnow()
+        # building name -> new aliases for it, without repeats
+        aliases_by_building = OrderedDict()
+        # Corrections that passed check_correction, written together below
+        event_fixes = []
+
+        for correction in corrections:
+            error = check_correction(correction, known_buildings)
+            if error is not None:
+                results.append({'Success' : 0, 'error' : error})
+                continue
+
+            event_fixes.append(correction)
+
+            alias = correction.get('new_alias')
+            if alias:
+                building_aliases = aliases_by_building.setdefault(correction['new_location'], [])
+                if alias not in building_aliases:
+                    building_aliases.append(alias)
+
+            results.append({'Success' : 1})
+            log.debug("Set official location to '%s' for '%s' (previous/incorrect location: '%s').", 
+                correction['new_location'], correction['full_location'], correction['old_location'])
+
+        if len(event_fixes) == 0:
+            return results, None
+
+        with change_sequence(self.request.db) as seq:
+            event_bulk = event_collection.initialize_unordered_bulk_op()
+            for correction in event_fixes:
+                # Update any event with <full_location> and <old_location> to store the 
+                # new (correct) <new_location> as its building
+                event_bulk.find({'building' : correction['old_location'], 'full_location' : correction['full_location']}).update({
+                    '$set' : {
+                        'building' : correction['new_location'],
+                        # So re-resolution doesn't undo the fix
+                        'building_set_by_hand' : True,
+                        MODIFIED_FIELD : now,
+                        CHANGE_SEQ_FIELD : seq
+                    }
+                })
+            event_bulk.execute()
+
+        if len(aliases_by_building) > 0:
+            # Add the aliases to the building documents with name <new_location>
+            building_bulk = building_collection.initialize_unordered_bulk_op()
+            for building, aliases in aliases_by_building.items():
+                building_bulk.find({'name' : building}).update({'$addToSet' : {'aliases' : {'$each' : aliases}}})
+                log.debug("Added aliases: %s for '%s'", aliases, building)
+            building_bulk.execute()
+
+        # Remembered location -> building matches the aliases could change have to be redone
+        all_aliases = [a for aliases in aliases_by_building.values() for a in aliases]
+        corrected_locations = [c['full_location'] for c, r in zip(corrections, results) if r['Success']]
+        invalidate_locations_for_aliases(self.request.db, all_aliases, corrected_locations)
+
+        # Cached event responses may have the old building
+        self.request.registry.events_version.bump(self.request.db)
+
+        # Other stored events the aliases now match get fixed in the background
+        job_id = None
+        if len(all_aliases) > 0:
+            job_id = self.request.registry.reresolve_jobs.start(ReresolveJob(self.request.db, all_aliases,
+                events_version=self.request.registry.events_version))
+
+        return results, job_id
+
+    @view_config(request_method='GET', route_name='reresolve_jobs')
+    def reresolve_jobs(self):
+        '''
+        Progress and timings of recent re-resolution jobs
+        '''
+        return {'jobs' : self.request.registry.reresolve_jobs.statuses()}
+
+@view_defaults(route_name='metrics', renderer='json')
+class MetricsAPI(object):
+    '''
+    Per-route request latency histograms and per-collection Mongo stats
+    (see carltour.metrics), since the app started
+    '''
+    def __init__(self, request):
+        self.request = request
+
+    @view_config(request_method='GET')
+    def get(self):
+        return self.request.registry.metrics.snapshot()
 
 @view_defaults(renderer='templates/events_table.jinja2')
 class EventViewer(object):
+    '''
+    Page for reviewing (and fixing) the buildings events were matched to, a page
+    of EVENTS_PAGE_SIZE events at a time. Optional filters:
+        start_date/end_date: only events overlapping these days (YYYY-MM-DD)
+        building: only events matched to this building
+        low_score: if true, only events whose location matched with a score
+                   below LOW_SCORE_THRESHOLD
+        after: a page token, from the page's 'Next page' link
+    '''
     def __init__(self, request):
         self.request = request
 
@@ -88,12 +660,84 @@ class EventViewer(object):
         event_collection = self.request.db['events']
         building_collection = self.request.db['buildings']
 
-        all_events = list(event_collection.find(fields={'_id' : False}).sort('start_datetime'))
+        filters = self._requested_filters()
+        spec = self._make_spec(filters)
+
+        after = self.request.params.get('after')
+        if after:
+            try:
+                last_start, last_id = decode_page_token(after)
+            except ValueError:
+                raise HTTPBadRequest('Bad after token')
+
+            spec['$or'] = [
+                {'start_datetime' : {'$gt' : last_start}},
+                {'start_datetime' : last_start, '_id' : {'$gt' : last_id}}
+            ]
+
+        page = list(event_collection.find(spec=spec).sort(
+            [('start_datetime', ASCENDING), ('_id', ASCENDING)]).limit(EVENTS_PAGE_SIZE))
+
         official_building_name_docs = building_collection.find(
             fields={'name' : True, '_id' : False}
         ).sort('name')
 
         official_building_names = [e['name'] for e in official_building_name_docs]
 
-        return {'events' : all_events, 'buildings' : official_building_names}
+        next_url = None
+        token = next_page_token(page, EVENTS_PAGE_SIZE)
+        if token is not None:
+            query = dict((k, v) for k, v in filters.items() if v)
+            query['after'] = token
+            next_url = self.request.current_route_url(_query=query)
+
+        return {
+            'events' : page,
+            'buildings' : official_building_names,
+            'filters' : filters,
+            'next_url' : next_url
+        }
+
+    def _requested_filters(self):
+        params = self.request.params
+
+        filters = {
+            'start_date' : params.get('start_date', ''),
+            'end_date' : params.get('end_date', ''),
+            'building' : params.get('building', ''),
+            'low_score' : 'true' if asbool(params.get('low_score', False)) else ''
+        }
+
+        for key in ['start_date', 'end_date']:
+            if filters[key]:
+                try:
+                    datetime.datetime.strptime(filters[key], '%Y-%m-%d')
+                except ValueError:
+                    raise HTTPBadRequest('%s must be YYYY-MM-DD' % key)
+
+        return filters
+
+    def _make_spec(self, filters):
+        '''
+        Query for the events passing <filters> (see _requested_filters)
+        '''
+        spec = {}
+
+        if filters['start_date']:
+            spec['end_datetime'] = {'$gte' : datetime.datetime.strptime(filters['start_date'], '%Y-%m-%d')}
+        if filters['end_date']:
+            # Through the end of that day
+            end_day = datetime.datetime.strptime(filters['end_date'], '%Y-%m-%d')
+            spec['start_datetime'] = {'$lt' : end_day + datetime.timedelta(days=1)}
+
+        if filters['building']:
+            spec['building'] = filters['building']
+
+        if filters['low_score']:
+            # Hand fixed events are as sure as they get, whatever they scored
+            spec['match_score'] = {'$lt' : LOW_SCORE_THRESHOLD}
+            spec['building_set_by_hand'] = {'$ne' : True}
+
+        spec[DELETED_FIELD] = {'$ne' : True}
 
+        return spec